@@ -23,12 +23,26 @@ const main = async (opts) => {
     let choid_id, song_id, part_id
     [choid_id, song_id, part_id] = stem.split("+")
 
-    // delete in converted bucket
-    await cos.deleteObject({
-        Bucket:opts.converted_bucket,
-        Key: `${choid_id}+${song_id}+${part_id}.nut`
-    }).promise()
-    
+    // delete in converted bucket: the part, its metadata, and the features
+    // and alignment results stored beside it, which all share the prefix
+    const prefix = `${choid_id}+${song_id}+${part_id}.`
+    let token
+    do {
+	const listing = await cos.listObjectsV2({
+	    Bucket: opts.converted_bucket,
+	    Prefix: prefix,
+	    ContinuationToken: token
+	}).promise()
+	if (listing.Contents.length > 0) {
+	    await cos.deleteObjects({
+		Bucket: opts.converted_bucket,
+		Delete: { Objects: listing.Contents.map(o => ({ Key: o.Key })) }
+	    }).promise()
+	}
+	token = listing.IsTruncated ? listing.NextContinuationToken : undefined
+    } while (token)
+
+
     // delete in snapshot bucket
     await cos.deleteObject({
         Bucket: opts.snapshots_bucket,
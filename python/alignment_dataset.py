@@ -0,0 +1,134 @@
+import argparse
+import json
+from pathlib import Path
+
+import numpy as np
+
+from choirless_lib import load_audio
+from calculate_alignment import SAMPLE_RATE, MAX_DURATION
+
+INDEX_FILE = 'index.json'
+
+
+def build_dataset(cache_dir, dataset_dir, tune_data='tune_data',
+                  sample_rate=SAMPLE_RATE, duration=MAX_DURATION):
+    """
+    Decode every part described in tune_data once, into a float32 .npy
+    file per part, and write an index of them.
+
+    Parts that are already in the dataset are not decoded again, and parts
+    whose media is missing from cache_dir are left out.
+
+    :param cache_dir: directory of converted .nut files
+    :type cache_dir: str
+    :param dataset_dir: directory to write the dataset to
+    :type dataset_dir: str
+    :param tune_data: directory of render definitions with known offsets
+    :type tune_data: str
+    :param sample_rate: sample rate to decode to
+    :type sample_rate: int
+    :param duration: number of seconds to decode at most
+    :type duration: float
+    :return: the index, as from load_index
+    :rtype: dict
+    """
+    Path(dataset_dir).mkdir(parents=True, exist_ok=True)
+    index = load_index(dataset_dir) if Path(dataset_dir, INDEX_FILE).exists() else {}
+
+    for json_file in sorted(Path(tune_data).glob('*.json')):
+        spec = json.load(json_file.open())
+        choir_id = spec['choir_id']
+        song_id = spec['song_id']
+
+        for part in spec['inputs']:
+            part_id = part['part_id']
+            key = f'{choir_id}+{song_id}+{part_id}'
+
+            entry = {'file': f'{key}.npy',
+                     'sr': sample_rate,
+                     'duration': duration,
+                     'offset': int(part['offset']),
+                     'choir_id': choir_id,
+                     'song_id': song_id,
+                     'part_id': part_id}
+
+            # The offset may have been corrected since, but the audio only
+            # needs decoding again if it was decoded differently
+            existing = index.get(key)
+            if existing and Path(dataset_dir, existing['file']).exists() and \
+               existing['sr'] == sample_rate and existing['duration'] == duration:
+                index[key] = entry
+                continue
+
+            filename = Path(cache_dir, f'{key}.nut')
+            if not filename.exists():
+                print("Missing:", filename)
+                continue
+
+            print("Decoding:", filename)
+            s, sr = load_audio(str(filename),
+                               sample_rate=sample_rate,
+                               duration=duration)
+
+            # Write then rename, so an interrupted build never leaves a
+            # truncated part behind
+            tmp_path = Path(dataset_dir, f'{key}.tmp.npy')
+            np.save(tmp_path, s.astype(np.float32))
+            tmp_path.replace(Path(dataset_dir, entry['file']))
+
+            index[key] = entry
+
+    with Path(dataset_dir, INDEX_FILE).open('w') as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+
+    return index
+
+
+def load_index(dataset_dir):
+    """
+    Load the index of a dataset
+
+    :param dataset_dir: directory of the dataset
+    :type dataset_dir: str
+    :return: dict of choir_id+song_id+part_id -> dict with the part's 'file',
+             'sr', 'duration', ground truth 'offset' in ms, 'choir_id',
+             'song_id' and 'part_id'
+    :rtype: dict
+    """
+    with Path(dataset_dir, INDEX_FILE).open() as f:
+        return json.load(f)
+
+
+def load_part(dataset_dir, entry, duration=None):
+    """
+    Open the decoded audio of a part, memory mapped and read only, so it is
+    shared through the page cache rather than copied into each process
+
+    :param dataset_dir: directory of the dataset
+    :type dataset_dir: str
+    :param entry: the part's entry in the index
+    :type entry: dict
+    :param duration: number of seconds to return at most
+    :type duration: float
+    :return: (samples, sample rate)
+    :rtype: (numpy.ndarray, int)
+    """
+    s = np.load(Path(dataset_dir, entry['file']), mmap_mode='r')
+    if duration is not None:
+        s = s[:int(duration * entry['sr'])]
+    return s, entry['sr']
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Decode the tune_data parts once into a memory mappable dataset")
+    parser.add_argument('cache_dir', help="directory of converted .nut files")
+    parser.add_argument('dataset_dir', help="directory to write the dataset to")
+    parser.add_argument('--tune-data', default='tune_data')
+    parser.add_argument('--sample-rate', type=int, default=SAMPLE_RATE)
+    parser.add_argument('--duration', type=float, default=MAX_DURATION)
+    args = parser.parse_args()
+
+    index = build_dataset(args.cache_dir, args.dataset_dir, args.tune_data,
+                          args.sample_rate, args.duration)
+    print("Parts in dataset:", len(index))
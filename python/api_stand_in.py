@@ -0,0 +1,105 @@
+import argparse
+import json
+import threading
+import time
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+class StandInAPI(ThreadingHTTPServer):
+    """
+    Stand-in for the Choirless API, serving just the calls the pipeline
+    makes. Responses can be delayed and the first few requests failed, to
+    see how the actions cope with a slow or flaky API.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, parts=None, delay=0, failures=0):
+        super().__init__(address, StandInHandler)
+        self.parts = parts or []
+        self.delay = delay
+        self.failures = failures
+        self.hits = Counter()
+        self.posted = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/'
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_request(self, method):
+        url = urlparse(self.path)
+        path = url.path.strip('/')
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length)) if length else None
+
+        with self.server.lock:
+            self.server.hits[(method, path)] += 1
+            failing = self.server.failures > 0
+            if failing:
+                self.server.failures -= 1
+
+        time.sleep(self.server.delay)
+
+        if failing:
+            self.send_json(503, {'ok': False})
+        elif 'apikey' not in query:
+            self.send_json(401, {'ok': False})
+        elif (method, path) == ('GET', 'choir/songparts'):
+            parts = [p for p in self.server.parts
+                     if p['choirId'] == query.get('choirId')
+                     and p['songId'] == query.get('songId')]
+            self.send_json(200, {'ok': True, 'parts': parts})
+        elif (method, path) in [('POST', 'choir/songpart'), ('POST', 'render')]:
+            with self.server.lock:
+                self.server.posted.append((path, body))
+            self.send_json(200, {'ok': True})
+        else:
+            self.send_json(404, {'ok': False})
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stand_in(**kwargs):
+    server = StandInAPI(('127.0.0.1', 0), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Stand-in for the Choirless API")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--parts', help="JSON file of song parts to serve")
+    parser.add_argument('--delay', type=float, default=0, help="seconds to delay each response by")
+    parser.add_argument('--failures', type=int, default=0, help="number of requests to fail with a 503 first")
+    args = parser.parse_args()
+
+    parts = json.load(open(args.parts)) if args.parts else []
+    server = StandInAPI(('127.0.0.1', args.port), parts=parts,
+                        delay=args.delay, failures=args.failures)
+    print(f"Serving stand-in API on {server.url}")
+    server.serve_forever()
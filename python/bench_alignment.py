@@ -0,0 +1,369 @@
+import argparse
+import json
+import multiprocessing
+import platform
+import resource
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import permutations
+from pathlib import Path
+
+import librosa
+import numpy as np
+
+from choirless_lib import available_cpus
+
+from alignment_dataset import build_dataset, load_index, load_part
+from calculate_alignment import calc_alignment, SAMPLE_RATE, PARAMS, FEATURES_VERSION
+
+# Keyword arguments to calc_alignment for each mode, on top of PARAMS' weights
+MODES = {'exhaustive': {'search': 'exhaustive'},
+         'coarse_to_fine': {'search': 'coarse_to_fine'},
+         'adaptive_window': {'search': 'exhaustive', 'window': 'adaptive'},
+         'landmarks': {'engine': 'landmarks'},
+         'parallel': {'search': 'exhaustive', 'execution': 'parallel'},
+         'early_exit': {'search': 'exhaustive', 'early_exit': True}}
+
+# Same criterion as tune_alignment.objective
+SYNC_THRESHOLD_MS = 50
+
+# Injected offsets for synthetic pairs are drawn from inside the window
+# calc_alignment searches
+SYNTHETIC_OFFSET_RANGE_MS = (-80, 580)
+
+
+def find_pairs(cache_dir, tune_data='tune_data'):
+    """
+    Find (reference, part, actual offset) pairs for every song described
+    in tune_data, with the audio for each part in cache_dir.
+
+    :return: list of pair dicts with 'name', 'reference', 'part' and
+             'actual_offset', where reference and part are audio sources
+             for load_source
+    """
+    songs = defaultdict(list)
+    for json_file in sorted(Path(tune_data).glob('*.json')):
+        spec = json.load(json_file.open())
+        choir_id = spec['choir_id']
+        song_id = spec['song_id']
+
+        for part in spec['inputs']:
+            part_id = part['part_id']
+            filename = Path(cache_dir, f'{choir_id}+{song_id}+{part_id}.nut')
+            if not filename.exists():
+                print("Missing:", filename)
+                continue
+
+            songs[f'{choir_id}+{song_id}'].append({'name': filename.name,
+                                                   'source': {'path': str(filename)},
+                                                   'offset': int(part['offset'])})
+
+    return pair_parts(songs)
+
+
+def dataset_pairs(dataset_dir, index):
+    """
+    As find_pairs, but with the audio from a dataset built by
+    alignment_dataset, memory mapped rather than decoded every run
+    """
+    songs = defaultdict(list)
+    for key, entry in sorted(index.items()):
+        songs[f"{entry['choir_id']}+{entry['song_id']}"].append(
+            {'name': f'{key}.nut',
+             'source': {'dataset': dataset_dir, 'entry': entry},
+             'offset': entry['offset']})
+
+    return pair_parts(songs)
+
+
+def pair_parts(songs):
+    # Every part is aligned against each part of its song with no offset
+    pairs = []
+    for song_parts in songs.values():
+        for a, b in permutations(song_parts, 2):
+            if a['offset'] == 0:
+                pairs.append({'name': b['name'],
+                              'reference': a['source'],
+                              'part': b['source'],
+                              'actual_offset': b['offset']})
+
+    return pairs
+
+
+def synthetic_pairs(n, seed=0):
+    """
+    Pairs of synthetic audio where the part is the reference delayed by a
+    known offset, with its own gain and noise.
+    """
+    rng = np.random.default_rng(seed)
+    low, high = SYNTHETIC_OFFSET_RANGE_MS
+
+    pairs = []
+    for i in range(n):
+        offset = int(rng.integers(low, high))
+        pairs.append({'name': f'synthetic-{i}',
+                      'reference': {'synthetic': seed + i},
+                      'part': {'synthetic': seed + i, 'offset': offset},
+                      'actual_offset': offset})
+    return pairs
+
+
+def synth(seconds, sr, seed):
+    # A melody of decaying harmonic notes, loosely like a sung part
+    rng = np.random.default_rng(seed)
+    s = np.zeros(int(seconds * sr), dtype=np.float32)
+
+    pos = 0
+    while pos < len(s):
+        n = int(rng.uniform(0.15, 0.6) * sr)
+        t = np.arange(min(n, len(s) - pos)) / sr
+        f = 110 * 2 ** (rng.integers(0, 36) / 12)
+        note = sum(np.sin(2 * np.pi * f * h * t) / h for h in range(1, 5))
+        s[pos:pos + len(t)] = np.exp(-3 * t) * note
+        pos += n
+
+    s += 0.01 * rng.standard_normal(len(s)).astype(np.float32)
+    return s / np.abs(s).max() * 0.8
+
+
+def load_source(source, duration, sr=SAMPLE_RATE):
+    """
+    Load the audio for one side of a pair
+
+    :param source: {'path': ...} for a media file, {'dataset': ...,
+                   'entry': ...} for a part in a dataset, or
+                   {'synthetic': seed} with an optional 'offset' in ms to
+                   delay it by
+    :param duration: number of seconds to load
+    :return: (samples, sample rate)
+    """
+    if 'dataset' in source:
+        return load_part(source['dataset'], source['entry'], duration)
+
+    if 'path' in source:
+        return librosa.load(source['path'],
+                            sr=sr,
+                            mono=True,
+                            offset=0,
+                            duration=duration)
+
+    s = synth(duration, sr, source['synthetic'])
+
+    offset_ms = source.get('offset')
+    if offset_ms is None:
+        return s, sr
+
+    # Delay (or advance) the reference, and make it a different take
+    shift = int(offset_ms / 1000 * sr)
+    if shift >= 0:
+        s = np.concatenate([np.zeros(shift, dtype=s.dtype), s[:len(s) - shift]])
+    else:
+        s = np.concatenate([s[-shift:], np.zeros(-shift, dtype=s.dtype)])
+
+    rng = np.random.default_rng(source['synthetic'] + 1)
+    s = 0.7 * s + 0.02 * rng.standard_normal(len(s)).astype(np.float32)
+    return s, sr
+
+
+def load_pairs(cache_dir, tune_data='tune_data', duration=180):
+    # Pairs from find_pairs with their audio loaded, for scripts that
+    # run calc_alignment in process
+    pairs = []
+    for pair in find_pairs(cache_dir, tune_data):
+        a = dict(zip(['s', 'sr'], load_source(pair['reference'], duration)))
+        b = dict(zip(['s', 'sr'], load_source(pair['part'], duration)))
+        b['filename'] = pair['name']
+        pairs.append((a, b, pair['actual_offset']))
+    return pairs
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform == 'darwin':
+        rss /= 1024
+    return rss / 1024
+
+
+def run_pair(pair, mode, duration, repeats):
+    """
+    Align one pair with one mode. Run in a fresh process each time so the
+    feature cache is cold and peak RSS belongs to this run alone.
+    """
+    t1 = time.time()
+    s0, sr0 = load_source(pair['reference'], duration)
+    s1, sr1 = load_source(pair['part'], duration)
+    t2 = time.time()
+
+    params = {k: v for k, v in PARAMS.items() if k.endswith('_weight')}
+    params.update(MODES[mode])
+
+    # Features calculated in a pool of processes, as calculate_alignment
+    # does with parallel execution
+    executor = None
+    if params.pop('execution', 'serial') == 'parallel':
+        executor = ProcessPoolExecutor(max_workers=available_cpus())
+        params['executor'] = executor
+
+    try:
+        # First call calculates the features, later ones find them cached
+        alignment = calc_alignment(s0, sr0, s1, sr1, **params)
+        t3 = time.time()
+        for _ in range(repeats):
+            calc_alignment(s0, sr0, s1, sr1, **params)
+        t4 = time.time()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return {'pair': pair['name'],
+            'mode': mode,
+            'actual_offset': pair['actual_offset'],
+            'offset': alignment['offset'],
+            'error': alignment['offset'] - pair['actual_offset'],
+            'confidence': alignment['confidence'],
+            'decode_time': t2 - t1,
+            'time': t3 - t2,
+            'search_time': (t4 - t3) / repeats if repeats else None,
+            'peak_rss_mb': peak_rss_mb()}
+
+
+def run_task(task):
+    return run_pair(*task)
+
+
+def summarise(runs, baseline_runs):
+    times = np.array([r['time'] for r in runs])
+    abs_errors = np.abs([r['error'] for r in runs])
+    baseline_time = np.mean([r['time'] for r in baseline_runs])
+
+    summary = {'pairs': len(runs),
+               'synced': float(np.mean(abs_errors <= SYNC_THRESHOLD_MS)),
+               'agrees_with_baseline': float(np.mean(
+                   [abs(r['offset'] - b['offset']) <= SYNC_THRESHOLD_MS
+                    for r, b in zip(runs, baseline_runs)])),
+               'error_ms': {'mean_abs': float(abs_errors.mean()),
+                            'p50': float(np.percentile(abs_errors, 50)),
+                            'p90': float(np.percentile(abs_errors, 90)),
+                            'max': float(abs_errors.max())},
+               'time_s': {'mean': float(times.mean()),
+                          'p50': float(np.percentile(times, 50)),
+                          'p90': float(np.percentile(times, 90))},
+               'speedup': float(baseline_time / times.mean()),
+               'confidence': {'mean': float(np.mean([r['confidence'] for r in runs])),
+                              'min': float(np.min([r['confidence'] for r in runs]))},
+               'peak_rss_mb': {'mean': float(np.mean([r['peak_rss_mb'] for r in runs])),
+                               'max': float(np.max([r['peak_rss_mb'] for r in runs]))}}
+
+    search_times = [r['search_time'] for r in runs if r['search_time'] is not None]
+    baseline_search_times = [r['search_time'] for r in baseline_runs
+                             if r['search_time'] is not None]
+    if search_times and baseline_search_times:
+        summary['search_time_s'] = {'mean': float(np.mean(search_times))}
+        summary['search_speedup'] = float(np.mean(baseline_search_times) /
+                                          np.mean(search_times))
+
+    return summary
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                              cwd=Path(__file__).parent,
+                              capture_output=True, text=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark calc_alignment accuracy and latency")
+    parser.add_argument('--cache-dir', help="directory of converted .nut files named as in tune_data")
+    parser.add_argument('--dataset-dir', help="dataset built by alignment_dataset, built or updated first if --cache-dir is also given")
+    parser.add_argument('--tune-data', default='tune_data')
+    parser.add_argument('--synthetic', type=int, default=8,
+                        help="number of synthetic pairs to use if no media is found")
+    parser.add_argument('--duration', type=float, default=180)
+    parser.add_argument('--repeats', type=int, default=3,
+                        help="extra calls per run with the features cached, to time the search alone")
+    parser.add_argument('--modes', nargs='+', default=list(MODES), choices=list(MODES))
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    if args.dataset_dir:
+        if args.cache_dir:
+            index = build_dataset(args.cache_dir, args.dataset_dir, args.tune_data,
+                                  duration=args.duration)
+        else:
+            index = load_index(args.dataset_dir)
+        pairs = dataset_pairs(args.dataset_dir, index)
+    elif args.cache_dir:
+        pairs = find_pairs(args.cache_dir, args.tune_data)
+    else:
+        pairs = []
+    source = 'tune_data'
+    if not pairs:
+        print(f"No media found, using {args.synthetic} synthetic pairs")
+        pairs = synthetic_pairs(args.synthetic)
+        source = 'synthetic'
+    print("Number of pairs:", len(pairs))
+
+    tasks = [(pair, mode, args.duration, args.repeats)
+             for pair in pairs for mode in args.modes]
+
+    # One run at a time, each in a new process. Not a multiprocessing.Pool,
+    # as its daemon processes cannot start the parallel mode's workers.
+    runs = []
+    ctx = multiprocessing.get_context('spawn')
+    for task in tasks:
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as executor:
+            run = executor.submit(run_task, task).result()
+            print(f"{run['pair']} {run['mode']:>15}: offset {run['offset']}"
+                  f" actual {run['actual_offset']}"
+                  f" time {run['time']:.2f} s"
+                  f" rss {run['peak_rss_mb']:.0f} MB")
+            runs.append(run)
+
+    by_mode = defaultdict(list)
+    for run in runs:
+        by_mode[run['mode']].append(run)
+
+    baseline = args.modes[0]
+    summary = {mode: summarise(by_mode[mode], by_mode[baseline])
+               for mode in args.modes}
+
+    for mode, s in summary.items():
+        print(f"{mode:>15}: synced {s['synced']:.0%}"
+              f"  agrees with {baseline} {s['agrees_with_baseline']:.0%}"
+              f"  error p50 {s['error_ms']['p50']:.0f} ms p90 {s['error_ms']['p90']:.0f} ms"
+              f"  time mean {s['time_s']['mean']:.2f} s"
+              f"  speedup {s['speedup']:.2f}x"
+              f" (search alone {s.get('search_speedup', 1):.2f}x)"
+              f"  confidence min {s['confidence']['min']:.2f}"
+              f"  peak rss {s['peak_rss_mb']['max']:.0f} MB")
+
+    results = {'meta': {'revision': git_revision(),
+                        'time': int(time.time()),
+                        'python': platform.python_version(),
+                        'numpy': np.__version__,
+                        'librosa': librosa.__version__,
+                        'features_version': FEATURES_VERSION,
+                        'params': PARAMS,
+                        'source': source,
+                        'duration': args.duration,
+                        'repeats': args.repeats,
+                        'baseline': baseline},
+               'summary': summary,
+               'runs': runs}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Results written to:", args.output)
+
+
+if __name__ == '__main__':
+
+    main()
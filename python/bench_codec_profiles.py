@@ -0,0 +1,71 @@
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import ffmpeg
+
+from choirless_lib import CODEC_PROFILES, get_codec_profile
+
+
+def synthetic_input(duration, size, rate):
+    # Moving test pattern with some noise, like a camera's, and a tone
+    video = (ffmpeg.input(f'testsrc2=size={size}:rate={rate}:duration={duration}',
+                          format='lavfi')
+             .filter('noise', alls=8, allf='t'))
+    audio = ffmpeg.input(f'sine=frequency=440:sample_rate=44100:duration={duration}',
+                         format='lavfi')
+    return video, audio
+
+
+def encode(profile, path, duration, size, rate):
+    video, audio = synthetic_input(duration, size, rate)
+    pipeline = ffmpeg.output(video, audio, str(path),
+                             ac=1,
+                             **profile.output_args())
+    pipeline = pipeline.global_args('-nostdin', '-loglevel', 'error')
+    t1 = time.time()
+    pipeline.overwrite_output().run()
+    return time.time() - t1
+
+
+def decode(path):
+    pipeline = (ffmpeg.input(str(path))
+                .output('-', format='null')
+                .global_args('-nostdin', '-loglevel', 'error'))
+    t1 = time.time()
+    pipeline.run()
+    return time.time() - t1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the codec profiles intermediate files can be written with")
+    parser.add_argument('profiles', nargs='*', help="profiles to run, defaults to all")
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--size', default='640x480')
+    parser.add_argument('--rate', type=int, default=25)
+    parser.add_argument('--work-dir', help="directory for the outputs, defaults to a temporary one")
+    args = parser.parse_args()
+
+    profiles = [get_codec_profile(name) for name in args.profiles or CODEC_PROFILES]
+    frames = args.duration * args.rate
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        work_dir = Path(args.work_dir or tmpdir)
+        work_dir.mkdir(parents=True, exist_ok=True)
+
+        print(f"{args.duration:.0f} s of {args.size} at {args.rate} fps")
+        print(f"{'profile':<16}{'encode fps':>12}{'decode fps':>12}{'MB/s':>10}  description")
+        for profile in profiles:
+            path = work_dir / f'{profile.name}.{profile.format}'
+            encode_time = encode(profile, path, args.duration, args.size, args.rate)
+            decode_time = decode(path)
+            # Bytes per second of media, what moving it through COS costs
+            rate = path.stat().st_size / args.duration
+            print(f"{profile.name:<16}{frames / encode_time:>12.1f}{frames / decode_time:>12.1f}"
+                  f"{rate / 1e6:>10.2f}  {profile.description}")
+
+
+if __name__ == '__main__':
+
+    main()
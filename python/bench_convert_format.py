@@ -0,0 +1,100 @@
+import argparse
+import re
+import tempfile
+import time
+from pathlib import Path
+
+import ffmpeg
+
+from choirless_lib import available_cpus
+from convert_format import convert, SEGMENT_SECONDS
+
+# Size of the frames decoded to count them, just big enough to be cheap
+COUNT_SIZE = (16, 12)
+
+
+def make_input(path, duration, size, rate):
+    # Moving test pattern and a tone, encoded as a phone would
+    video = ffmpeg.input(f'testsrc2=size={size}:rate={rate}:duration={duration}',
+                         format='lavfi')
+    audio = ffmpeg.input(f'sine=frequency=440:sample_rate=48000:duration={duration}',
+                         format='lavfi')
+    pipeline = ffmpeg.output(video, audio, str(path),
+                             vcodec='libx264', preset='veryfast',
+                             acodec='aac', ac=2, shortest=None)
+    pipeline.global_args('-loglevel', 'error').overwrite_output().run()
+
+
+def count_frames(path):
+    out, _ = (ffmpeg.input(str(path)).video
+              .filter('scale', *COUNT_SIZE)
+              .output('pipe:', format='rawvideo', pix_fmt='gray')
+              .global_args('-loglevel', 'error')
+              .run(capture_stdout=True))
+    return len(out) // (COUNT_SIZE[0] * COUNT_SIZE[1])
+
+
+def count_samples(path):
+    out, _ = (ffmpeg.input(str(path)).audio
+              .output('pipe:', format='f32le', acodec='pcm_f32le')
+              .global_args('-loglevel', 'error')
+              .run(capture_stdout=True))
+    return len(out) // 4
+
+
+def calc_psnr(path1, path2):
+    # Average PSNR of the video of path2 against path1
+    _, err = (ffmpeg.filter([ffmpeg.input(str(path1)).video,
+                             ffmpeg.input(str(path2)).video], 'psnr')
+              .output('-', format='null')
+              .run(capture_stderr=True))
+    mo = re.search(r'average:(\S+)', err.decode())
+    return mo.groups()[0] if mo else '?'
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark convert_format's serial and segment parallel encodes")
+    parser.add_argument('--durations', type=float, nargs='+', default=[60, 180])
+    parser.add_argument('--size', default='1920x1080')
+    parser.add_argument('--rate', type=int, default=30)
+    parser.add_argument('--max-workers', type=int, default=available_cpus())
+    parser.add_argument('--segment-seconds', type=float, default=SEGMENT_SECONDS)
+    parser.add_argument('--work-dir', help="directory for the inputs and outputs, defaults to a temporary one")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        work_dir = Path(args.work_dir or tmpdir)
+        work_dir.mkdir(parents=True, exist_ok=True)
+
+        print(f"max workers: {args.max_workers}, segment seconds: {args.segment_seconds}")
+        for duration in args.durations:
+            input_path = work_dir / f'input-{duration:.0f}.mp4'
+            if not input_path.exists():
+                make_input(input_path, duration, args.size, args.rate)
+            probe = ffmpeg.probe(str(input_path))
+
+            outputs = {}
+            for execution in ['serial', 'parallel']:
+                output_path = work_dir / f'output-{duration:.0f}-{execution}.nut'
+                if output_path.exists():
+                    output_path.unlink()
+                t1 = time.time()
+                convert(str(input_path), str(output_path), probe,
+                        execution=execution,
+                        max_workers=args.max_workers,
+                        segment_seconds=args.segment_seconds)
+                t2 = time.time()
+                outputs[execution] = output_path
+
+                print(f"{duration:>6.0f} s {execution:>8}: wall {t2 - t1:7.1f} s"
+                      f"  size {output_path.stat().st_size / 1e6:7.1f} MB"
+                      f"  frames {count_frames(output_path)}"
+                      f"  samples {count_samples(output_path)}")
+
+            print(f"{duration:>6.0f} s parallel PSNR against serial: "
+                  f"{calc_psnr(outputs['serial'], outputs['parallel'])} dB")
+
+
+if __name__ == '__main__':
+
+    main()
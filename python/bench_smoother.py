@@ -0,0 +1,83 @@
+import argparse
+import time
+
+import numpy as np
+
+import calculate_alignment
+from calculate_alignment import calc_offset, smooth_curves, PARAMS
+
+# Shapes of the stacked error curves fuse_errors smooths: one curve per hop
+# length over the exhaustive search, and over a coarse to fine band
+SHAPES = [(4, 70), (3, 13), (1, 70)]
+
+
+def ukf_smooth_curves(curves):
+    # What fuse_errors used to do
+    from pykalman import UnscentedKalmanFilter as KalmanFilter
+    kf = KalmanFilter(initial_state_mean=0, n_dim_obs=curves.shape[0])
+    return kf.smooth(curves.transpose())[0].flatten()
+
+
+def time_per_call(f, curves, repeats):
+    t1 = time.time()
+    for _ in range(repeats):
+        f(curves)
+    t2 = time.time()
+    return (t2 - t1) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the error curve smoother against pykalman")
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--cache-dir', help="directory of converted .nut files, to compare offsets on tune_data")
+    parser.add_argument('--tune-data', default='tune_data')
+    parser.add_argument('--duration', type=float, default=180)
+    args = parser.parse_args()
+
+    t1 = time.time()
+    import pykalman
+    t2 = time.time()
+    print(f"import pykalman: {(t2 - t1) * 1000:.1f} ms")
+
+    rng = np.random.default_rng(0)
+    for shape in SHAPES:
+        curves = rng.normal(size=shape).cumsum(axis=1)
+
+        diff = np.abs(ukf_smooth_curves(curves) - smooth_curves(curves)).max()
+        ukf_time = time_per_call(ukf_smooth_curves, curves, args.repeats)
+        rts_time = time_per_call(smooth_curves, curves, args.repeats)
+
+        print(f"{str(shape):>10}: ukf {ukf_time * 1000:.3f} ms"
+              f"  rts {rts_time * 1000:.3f} ms"
+              f"  speedup {ukf_time / rts_time:.0f}x"
+              f"  max diff {diff:.2e}")
+
+    if not args.cache_dir:
+        return
+
+    from bench_alignment import load_pairs
+
+    pairs = load_pairs(args.cache_dir, args.tune_data, args.duration)
+    print("Number of pairs:", len(pairs))
+
+    weights = {k: v for k, v in PARAMS.items() if k.endswith('_weight')}
+
+    matches = []
+    for a, b, actual_offset in pairs:
+        offset = calc_offset(a['s'], a['sr'], b['s'], b['sr'], **weights)
+
+        calculate_alignment.smooth_curves = ukf_smooth_curves
+        try:
+            ukf_offset = calc_offset(a['s'], a['sr'], b['s'], b['sr'], **weights)
+        finally:
+            calculate_alignment.smooth_curves = smooth_curves
+
+        matches.append(offset == ukf_offset)
+        print(b['filename'], int(actual_offset), offset, ukf_offset)
+
+    print(f"offsets matching pykalman: {np.mean(matches):.0%}")
+
+
+if __name__ == '__main__':
+
+    main()
@@ -1,31 +1,125 @@
 import io
 import json
-import os
+import math
 import librosa
 import numpy as np
 import re
+import scipy.ndimage
 import tempfile
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial, reduce
+from multiprocessing import shared_memory
 from pathlib import Path
-from urllib.parse import urljoin
-from scipy.signal import find_peaks
-from surfboard.sound import Waveform
+from scipy.linalg import solve_banded
+from scipy.signal import find_peaks, peak_prominences
 
-from pykalman import UnscentedKalmanFilter as KalmanFilter
-
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-
-
-import requests
-
-from choirless_lib import create_cos_client, mqtt_status
+from choirless_lib import create_cos_client, create_signed_url, mqtt_status
+from choirless_lib import load_audio, audio_blocks
+from choirless_lib import FeatureStore, ResultStore, LocalBlobStore, COSBlobStore
+from choirless_lib import ArrayLRUCache, fingerprint
+from choirless_lib import available_cpus
+from choirless_lib import create_api_client, create_part_metadata
 
 SAMPLE_RATE = 44100
 HOP_LENGTH_SECONDS = 0.01
-
-PARAMS = {'cf_weight': 0.5, 'chroma_weight': 0.8, 'sf_weight': 0.6}
+HOP_LENGTHS = [256, 512, 1024, 2048]
+MAX_DURATION = 180
+
+# Bump this whenever gen_multi_hop_features changes its output, so stored
+# features are recalculated
+FEATURES_VERSION = 2
+
+# Features and peak maps kept in memory between calls in a warm container
+FEATURE_CACHE_BYTES = 64 * 1024 * 1024
+feature_cache = ArrayLRUCache(FEATURE_CACHE_BYTES)
+
+# Error curves are calculated for these features, in this order
+FEATURE_NAMES = ['chroma', 'sf', 'cf']
+
+# Order of the features in the per hop length tuples of
+# gen_multi_hop_features
+FEATURE_TUPLE_NAMES = ['sf', 'cf', 'chroma']
+
+# Offsets either side of each coarse candidate re-evaluated at finer hop
+# lengths when searching coarse to fine. The coarsest hop is ~46 ms.
+COARSE_TO_FINE_BAND_MS = 60
+
+# With an adaptive window, alignment starts from the most informative
+# WINDOW_SECONDS of the part, doubling the window while the chosen offset's
+# peak is less prominent than WINDOW_MIN_PROMINENCE
+WINDOW_SECONDS = 20
+WINDOW_MIN_PROMINENCE = 2.0
+
+# Streaming feature extraction decodes and analyses this many seconds of
+# audio at a time, and calculates the CQT chroma of each block over this
+# much more audio either side. The margin covers the longest CQT filter
+# and the resampling in librosa's lower octaves, so the chroma is the same
+# as over the whole signal
+STREAM_BLOCK_SECONDS = 30
+CQT_MARGIN_SECONDS = 2.0
+
+# The CQT tuning is estimated from this many seconds at the start of the
+# signal, so streamed and whole signal features agree
+TUNING_SECONDS = 30
+
+# Resolution of the energy envelope used to pick the window
+ENVELOPE_SECONDS = 0.05
+
+# Landmark fingerprinting: spectrogram peaks that are the maximum of their
+# LANDMARK_PEAK_SIZE neighbourhood (bins, frames) are paired into hashes
+LANDMARK_N_FFT_SECONDS = 0.04
+LANDMARK_HOP_LENGTH = 256
+LANDMARK_MAX_BIN = 1023
+LANDMARK_PEAK_SIZE = (15, 15)
+LANDMARK_PEAKS_PER_SECOND = 30
+LANDMARK_FAN_OUT = 5
+LANDMARK_MAX_DT = 63
+LANDMARK_MAX_DF = 127
+
+# Bump this whenever build_landmark_index changes its output
+LANDMARKS_VERSION = 1
+
+# Bump this whenever calc_alignment would give a different result for the
+# same audio and PARAMS, so stored results are recalculated
+ALGORITHM_VERSION = 2
+
+# With early exit, the offset is taken from the EARLY_EXIT_HOPS coarsest hop
+# lengths alone when each of them picks an offset within
+# EARLY_EXIT_AGREE_MS of the others, and their fused error curve's peak is
+# at least EARLY_EXIT_PROMINENCE prominent
+EARLY_EXIT_HOPS = 2
+EARLY_EXIT_AGREE_MS = 30
+EARLY_EXIT_PROMINENCE = 4.0
+
+# Confidence goes from 0 to 1 as the smaller of the chosen offset's
+# prominence and its margin over the next candidate goes from
+# CONFIDENCE_LOW to CONFIDENCE_HIGH. Parts below REVIEW_CONFIDENCE, or
+# whose offset had to be clamped, are flagged for review.
+#
+# Calibrated with PARAMS on 180 s of bench_alignment's 16 synthetic pairs,
+# the same references against unrelated synthetic parts, and the tune_data
+# pair we have media for. Unrelated pairs scored at most 3.32, so LOW is
+# just above them. 14 of the matched pairs scored 4.62-7.32 and the real
+# pair 4.61, so HIGH is just below them. The other two matched pairs were
+# right but scored 1.98 and 2.90, so are reviewed needlessly, which costs
+# less than passing a part out of sync.
+CONFIDENCE_LOW = 3.5
+CONFIDENCE_HIGH = 4.5
+REVIEW_CONFIDENCE = 0.5
+
+# The same for the landmark engine, in votes the winning offset has over
+# the next best
+LANDMARK_CONFIDENCE_LOW = 5
+LANDMARK_CONFIDENCE_HIGH = 50
+
+# engine is 'features' (the weighted multi-feature error curves) or
+# 'landmarks', search is 'exhaustive' or 'coarse_to_fine', and window is
+# 'full' or 'adaptive'. search, window and early_exit only apply to
+# 'features'.
+PARAMS = {'cf_weight': 0.5, 'chroma_weight': 0.8, 'sf_weight': 0.6,
+          'search': 'exhaustive', 'window': 'full', 'engine': 'features',
+          'early_exit': False}
 
 @mqtt_status()
 def main(args):
@@ -36,6 +130,8 @@ def main(args):
     if not cos:
         raise ValueError("could not create COS instance")
 
+    feature_cache.resize(int(args.get('feature_cache_bytes', FEATURE_CACHE_BYTES)))
+
     notification = args.get('notification', {})
     rendition_key = args.get('key', notification.get('object_name', ''))
 
@@ -45,33 +141,14 @@ def main(args):
 
     choir_id, song_id, part_id, ext = mo.groups()
 
-    # Try and detemine the reference key, first by looking in the bucket
-    # for a specially named partid, or then via the Choirless API
-    reference_key = f"{choir_id}+{song_id}+reference.{ext}"
-
-    # Ask the API if we have parts for this Song
-    try:
-        api_url = args['CHOIRLESS_API_URL']
-        api_key = args['CHOIRLESS_API_KEY']
-
-        params = {'apikey': api_key,
-                  'choirId': choir_id,
-                  'songId': song_id,}
-        req = requests.get(urljoin(api_url, 'choir/songparts'),
-                           params=params)
-        parts = req.json()['parts']
-
-        # Check each part and look for the reference one
-        for part in parts:
-            if part['partType'] == 'backing':
-                reference_key = f"{part['choirId']}+{part['songId']}+{part['partId']}.nut"
-    except:
-        print(f"Could not look up part in API: choidId {choir_id} songId {song_id}")
+    reference_key = lookup_reference_key(args, choir_id, song_id, ext)
 
     # Abort if we are the reference part
     if rendition_key == reference_key:
         ret = {"offset":  0,
                "err": 0,
+               "confidence": 1.0,
+               "needs_review": False,
                "key": rendition_key,
                "rendition_key": rendition_key,
                "reference_key": reference_key,
@@ -82,90 +159,683 @@ def main(args):
     args['rendition_key'] = rendition_key
     args['reference_key'] = reference_key
 
+    sample_rate = int(args.get('analysis_sample_rate', SAMPLE_RATE))
+    params = dict(PARAMS, engine=args.get('alignment_engine', PARAMS['engine']))
+    streaming = use_streaming(args, params)
+    max_duration = parse_max_duration(args, streaming)
+
+    # Re-uploads of the same bytes and re-runs get the offset we already
+    # calculated, without decoding anything
+    result_store = create_result_store(args, cos, bucket)
+    part_metadata = create_part_metadata(args, bucket)
+    if result_store:
+        reference_etag = cos.head_object(Bucket=bucket, Key=reference_key)['ETag']
+        part_etag = cos.head_object(Bucket=bucket, Key=rendition_key)['ETag']
+        stored_params = result_params(params, sample_rate, max_duration, streaming)
+        result = result_store.load(reference_etag, rendition_key, part_etag,
+                                   stored_params)
+        if result is not None:
+            offset_ms = result['offset']
+            print(f"Loaded offset from store: {rendition_key} offset {offset_ms}")
+
+            post_offset(args, choir_id, song_id, part_id, offset_ms)
+            save_offset(part_metadata, rendition_key, offset_ms)
+
+            ret = {"offset":  offset_ms,
+                   "confidence": result['confidence'],
+                   "needs_review": result['needs_review'],
+                   "key": rendition_key,
+                   "rendition_key": rendition_key,
+                   "reference_key": reference_key,
+                   "cached": True,
+            }
+
+            return ret
+
     def load_from_cos(key):
-        # Create a temp dir for our files to use
-        with tempfile.TemporaryDirectory() as tmpdir:
-            file_path = Path(tmpdir, key)
-            cos.download_file(bucket, key, str(file_path))
+        return audio_source(args, bucket, key, sample_rate, max_duration)()
+
+    def stream_from_cos(key, names):
+        return feature_source(args, bucket, key, sample_rate, max_duration, names)()
+
+    feature_store = create_feature_store(args, cos, bucket)
 
-            # load the audio from out temp file
-            return librosa.load(file_path,
-                                sr=SAMPLE_RATE,
-                                mono=True,
-                                offset=0,
-                                duration=180)
+    # With parallel execution the part is loaded, and features are
+    # calculated, in worker processes rather than all on one core
+    pool = get_feature_pool() if args.get('execution', 'serial') == 'parallel' else None
 
-    # load in the leader
-    s0, sr0 = load_from_cos(reference_key)
-    print("Loaded from COS: ", reference_key)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # load in sarah, while we deal with the reference
+        print("Loading from COS: ", rendition_key)
+        part_future = (pool or executor).submit(part_source(args, bucket, rendition_key,
+                                                            sample_rate, max_duration,
+                                                            params, streaming))
 
-    # load in sarah
-    print("Loading from COS: ", rendition_key)
-    s1, sr1 = load_from_cos(rendition_key)
-    print("Loaded from COS: ", rendition_key)
+        reference = load_reference(cos, bucket, feature_store,
+                                   reference_key, load_from_cos,
+                                   sample_rate, params, max_duration,
+                                   stream_from_cos if streaming else None)
 
-    min_len = min(len(s0), len(s1))
+        part = part_future.result()
+        print("Loaded from COS: ", rendition_key)
 
-    s0 = s0[:min_len]
-    s1 = s1[:min_len]
 
+    alignment = calc_alignment(None, sample_rate,
+                               executor=pool,
+                               **part,
+                               **reference,
+                               **params)
 
-    # Set up a chart to plot sync process
-    fig = plt.figure(figsize=(20, 6))
-    ax = fig.add_subplot(1, 1, 1)
+    # The error curves are saved for render_alignment_debug to plot later
+    if parse_flag(args, 'debug_artifacts'):
+        save_debug_artifact(cos, debug_bucket,
+                            rendition_key, reference_key, alignment, params)
 
-    offset_ms = calc_offset(s0, sr0, s1, sr1,
-                            ax=ax,
-                            **PARAMS)
+    offset_ms, needs_review = review_alignment(alignment)
 
-    # Plot the output
-    plt.title(f'Alignment: {rendition_key}')
-    plt.ylabel('difference')
-    plt.xlabel(f'milliseconds behind: {reference_key}')
+    if result_store:
+        result_store.save(reference_etag, rendition_key, part_etag,
+                          stored_params, {'offset': offset_ms,
+                                          'confidence': alignment['confidence'],
+                                          'needs_review': needs_review})
 
-    x_bounds = plt.xlim()
-    plt.annotate(text=f'{offset_ms:.0f} ms',
-                 xy =(((offset_ms-x_bounds[0])/(x_bounds[1]-x_bounds[0])),0.99),
-                 xycoords='axes fraction', verticalalignment='top',
-                 horizontalalignment='left' , rotation = 270)
+    post_offset(args, choir_id, song_id, part_id, offset_ms)
+    save_offset(part_metadata, rendition_key, offset_ms)
+
+    print("Feature cache:", feature_cache.stats())
+
+    ret = {"offset":  offset_ms,
+           "confidence": alignment['confidence'],
+           "needs_review": needs_review,
+           "key": rendition_key,
+           "rendition_key": rendition_key,
+           "reference_key": reference_key,
+           "cached": False,
+    }
+
+    return ret
+
+
+# Align every part of a song against the reference in one invocation,
+# e.g. when a whole choir is uploaded or reprocessed. The song is taken
+# from the args, or else from the key, and align_song() does the rest
+def main_batch(args):
+    notification = args.get('notification', {})
+    key = args.get('key', notification.get('object_name', ''))
+
+    choir_id = args.get('choir_id')
+    song_id = args.get('song_id')
+    if not (choir_id and song_id):
+        key_parts = Path(key).stem.split('+')
+        if len(key_parts) < 2:
+            raise ValueError(f"Need choir_id and song_id, or a key: {key}")
+        choir_id, song_id = key_parts[:2]
+
+    args['choir_id'] = choir_id
+    args['song_id'] = song_id
+    args['key'] = f'{choir_id}+{song_id}'
+
+    return align_song(args)
+
+
+@mqtt_status()
+def align_song(args):
+    cos = create_cos_client(args)
+    bucket = args.get('bucket')
+
+    if not cos:
+        raise ValueError("could not create COS instance")
+
+    feature_cache.resize(int(args.get('feature_cache_bytes', FEATURE_CACHE_BYTES)))
+
+    choir_id = args['choir_id']
+    song_id = args['song_id']
+    ext = args.get('ext', 'nut')
+
+    reference_key = lookup_reference_key(args, choir_id, song_id, ext)
+
+    # Every converted part of this song, apart from the reference. The
+    # features, alignment results and metadata kept next to each part mean
+    # a song can run to more than one page of keys
+    key_prefix = f'{choir_id}+{song_id}+'
+    paginator = cos.get_paginator('list_objects_v2')
+    part_keys = sorted(x['Key']
+                       for page in paginator.paginate(Bucket=bucket, Prefix=key_prefix)
+                       for x in page.get('Contents', [])
+                       if x['Key'].endswith(f'.{ext}') and x['Size'] > 0
+                       and x['Key'] != reference_key)
+    print(f"Aligning {len(part_keys)} parts against: {reference_key}")
+
+    sample_rate = int(args.get('analysis_sample_rate', SAMPLE_RATE))
+    params = dict(PARAMS, engine=args.get('alignment_engine', PARAMS['engine']))
+    streaming = use_streaming(args, params)
+    max_duration = parse_max_duration(args, streaming)
+
+    offsets = {}
+    confidences = {}
+    needs_review = []
+    errors = {}
+
+    # Parts already aligned against this reference are not decoded again
+    result_store = create_result_store(args, cos, bucket)
+    part_metadata = create_part_metadata(args, bucket)
+    part_etags = {}
+    if result_store:
+        reference_etag = cos.head_object(Bucket=bucket, Key=reference_key)['ETag']
+        stored_params = result_params(params, sample_rate, max_duration, streaming)
+        for part_key in list(part_keys):
+            part_etags[part_key] = cos.head_object(Bucket=bucket, Key=part_key)['ETag']
+            result = result_store.load(reference_etag, part_key,
+                                       part_etags[part_key], stored_params)
+            if result is not None:
+                part_id = parse_part_id(part_key)
+                offsets[part_id] = result['offset']
+                confidences[part_id] = result['confidence']
+                if result['needs_review']:
+                    needs_review.append(part_id)
+                print(f"Loaded offset from store: {part_key} offset {result['offset']}")
+                post_offset(args, choir_id, song_id, part_id, result['offset'])
+                save_offset(part_metadata, part_key, result['offset'])
+                part_keys.remove(part_key)
+
+    if not part_keys:
+        ret = {"choir_id": choir_id,
+               "song_id": song_id,
+               "reference_key": reference_key,
+               "offsets": offsets,
+               "confidences": confidences,
+               "needs_review": needs_review,
+               "errors": errors,
+        }
+
+        return ret
+
+    def load_from_cos(key):
+        return audio_source(args, bucket, key, sample_rate, max_duration)()
+
+    def stream_from_cos(key, names):
+        return feature_source(args, bucket, key, sample_rate, max_duration, names)()
+
+    feature_store = create_feature_store(args, cos, bucket)
+
+    # The reference is decoded once at most, for all the parts
+    reference = load_reference(cos, bucket, feature_store,
+                               reference_key, load_from_cos,
+                               sample_rate, params, max_duration,
+                               stream_from_cos if streaming else None)
+
+    max_workers = int(args.get('max_workers', available_cpus()))
+    max_workers = max(1, min(max_workers, len(part_keys)))
+
+    debug_bucket = args.get('debug_bucket')
+    save_debug = parse_flag(args, 'debug_artifacts')
+
+    with ProcessPoolExecutor(max_workers=max_workers,
+                             initializer=init_align_worker,
+                             initargs=(reference,)) as executor:
+        futures = {}
+        for part_key in part_keys:
+            source = part_source(args, bucket, part_key, sample_rate,
+                                 max_duration, params, streaming)
+            futures[part_key] = executor.submit(align_part, source, sample_rate,
+                                                params)
+
+        for part_key, future in futures.items():
+            part_id = parse_part_id(part_key)
+            try:
+                alignment = future.result()
+            except Exception as e:
+                print(f"Could not align part: {part_key}", e)
+                errors[part_id] = str(e)
+                continue
+
+            if save_debug:
+                save_debug_artifact(cos, debug_bucket,
+                                    part_key, reference_key, alignment, params)
+
+            offset_ms, review = review_alignment(alignment)
+
+            if result_store:
+                result_store.save(reference_etag, part_key, part_etags[part_key],
+                                  stored_params, {'offset': offset_ms,
+                                                  'confidence': alignment['confidence'],
+                                                  'needs_review': review})
+
+            print(f"Aligned: {part_key} offset {offset_ms} confidence {alignment['confidence']:.2f}")
+            post_offset(args, choir_id, song_id, part_id, offset_ms)
+            save_offset(part_metadata, part_key, offset_ms)
+            offsets[part_id] = offset_ms
+            confidences[part_id] = alignment['confidence']
+            if review:
+                needs_review.append(part_id)
+
+    print("Feature cache:", feature_cache.stats())
+
+    ret = {"choir_id": choir_id,
+           "song_id": song_id,
+           "reference_key": reference_key,
+           "offsets": offsets,
+           "confidences": confidences,
+           "needs_review": needs_review,
+           "errors": errors,
+    }
+
+    return ret
+
+
+# Reference features or landmarks for the worker processes of
+# align_song, set once per worker rather than sent with every part
+_reference = None
+
+# Worker processes for main with parallel execution, one per CPU of the
+# container's quota, kept while the container is warm
+_feature_pool = None
+
+
+def get_feature_pool():
+    global _feature_pool
+    if _feature_pool is None:
+        _feature_pool = ProcessPoolExecutor(max_workers=available_cpus())
+    return _feature_pool
+
+
+def init_align_worker(reference):
+    global _reference
+    _reference = reference
+
+
+def align_part(source, sample_rate, params):
+    part = source()
+    return calc_alignment(None, sample_rate,
+                          **part,
+                          **_reference,
+                          **params)
+
+
+def parse_part_id(key):
+    return Path(key).stem.split('+')[2]
+
+
+def lookup_reference_key(args, choir_id, song_id, ext='nut'):
+    """
+    Determine the key of the reference part for a song, first by looking
+    for a specially named partid, or then via the Choirless API
+
+    :param args: action parameters
+    :type args: dict
+    :param choir_id: choir id
+    :type choir_id: str
+    :param song_id: song id
+    :type song_id: str
+    :param ext: extension of the converted parts
+    :type ext: str
+    :return: the reference key
+    :rtype: str
+    """
+    reference_key = f"{choir_id}+{song_id}+reference.{ext}"
 
-    # Upload the plot
+    # Ask the API if we have parts for this Song
+    try:
+        api = create_api_client(args)
+        parts = api.get_songparts(choir_id, song_id)
+
+        # Check each part and look for the reference one
+        for part in parts:
+            if part['partType'] == 'backing':
+                reference_key = f"{part['choirId']}+{part['songId']}+{part['partId']}.nut"
+    except Exception as e:
+        print(f"Could not look up part in API: choidId {choir_id} songId {song_id}", e)
+
+    return reference_key
+
+
+def download_audio(args, bucket, key, sample_rate, max_duration):
+    cos = create_cos_client(args)
+
+    # Create a temp dir for our files to use
     with tempfile.TemporaryDirectory() as tmpdir:
-        key = f'{choir_id}+{song_id}+{part_id}-alignment.png'
-        file_path = str(Path(tmpdir, key))
-        plt.savefig(file_path)
-        cos.upload_file(file_path, debug_bucket, key)
+        file_path = Path(tmpdir, key)
+        cos.download_file(bucket, key, str(file_path))
+
+        # load the audio from out temp file
+        return librosa.load(file_path,
+                            sr=sample_rate,
+                            mono=True,
+                            offset=0,
+                            duration=max_duration)
+
+
+def audio_source(args, bucket, key, sample_rate, max_duration):
+    """
+    Return a callable that decodes an object to (samples, sample rate).
+    It can be pickled, so it can also be sent to a worker process.
+
+    :param args: action parameters
+    :type args: dict
+    :param bucket: bucket the object is in
+    :type bucket: str
+    :param key: key of the object
+    :type key: str
+    :param sample_rate: sample rate to decode to
+    :type sample_rate: int
+    :param max_duration: number of seconds to decode at most
+    :type max_duration: float
+    :return: a callable taking no arguments
+    :rtype: functools.partial
+    """
+    if args.get('decode', 'stream') == 'download':
+        return partial(download_audio, args, bucket, key, sample_rate, max_duration)
+
+    # Decode straight from a signed URL into memory
+    url = signed_url(args, bucket, key)
+    return partial(load_audio, url, sample_rate=sample_rate, duration=max_duration)
+
+
+def feature_source(args, bucket, key, sample_rate, max_duration, names=FEATURE_NAMES):
+    """
+    Return a callable that calculates the features of an object, decoding
+    and analysing it a block at a time. Like audio_source, it can be
+    pickled.
+
+    :param args: action parameters
+    :type args: dict
+    :param bucket: bucket the object is in
+    :type bucket: str
+    :param key: key of the object
+    :type key: str
+    :param sample_rate: sample rate to decode to
+    :type sample_rate: int
+    :param max_duration: number of seconds to decode at most, or None for all
+    :type max_duration: float
+    :param names: features to calculate, from FEATURE_NAMES
+    :type names: list
+    :return: a callable taking no arguments, returning features as from
+             gen_multi_hop_features
+    :rtype: functools.partial
+    """
+    hop_lengths = hop_lengths_for(sample_rate)
+
+    if args.get('decode', 'stream') == 'download':
+        # Already all in memory, so nothing to gain from streaming
+        return partial(download_features, args, bucket, key, sample_rate,
+                       max_duration, hop_lengths, names)
+
+    url = signed_url(args, bucket, key)
+    return partial(stream_features, url, sample_rate, hop_lengths,
+                   names=names, duration=max_duration)
+
+
+def download_features(args, bucket, key, sample_rate, max_duration, hop_lengths, names):
+    s, sr = download_audio(args, bucket, key, sample_rate, max_duration)
+    return gen_multi_hop_features(s, sr, hop_lengths, names=names)
+
+
+def part_source(args, bucket, key, sample_rate, max_duration, params, streaming):
+    # What calc_alignment needs from a part: its features when they can be
+    # streamed, otherwise its audio
+    if streaming:
+        return partial(load_part_features,
+                       feature_source(args, bucket, key, sample_rate,
+                                      max_duration, active_features(params)),
+                       sample_rate)
+    return partial(load_part_audio,
+                   audio_source(args, bucket, key, sample_rate, max_duration))
+
+
+def load_part_audio(source):
+    s1, sr1 = source()
+    return {'s1': s1, 'sr1': sr1}
+
+
+def load_part_features(source, sample_rate):
+    return {'s1': None, 'sr1': sample_rate, 'features1': source()}
+
+
+def use_streaming(args, params):
+    # Only the feature engine over the whole part works from features alone,
+    # the adaptive window and landmarks need the audio
+    return (args.get('extraction', 'stream') == 'stream'
+            and params['engine'] == 'features'
+            and params['window'] == 'full')
+
+
+def parse_flag(args, name, default=True):
+    # Action params can arrive as strings, e.g. "false" or "0" from the CLI
+    value = args.get(name, default)
+    return str(value).lower() not in ('0', 'false', 'no', 'off', '')
+
+
+def parse_max_duration(args, streaming):
+    # Streamed features take the same memory however long the part is, so
+    # are not capped unless asked. 0 means no cap either way.
+    max_duration = args.get('max_duration', None if streaming else MAX_DURATION)
+    return float(max_duration) if max_duration else None
+
+
+def signed_url(args, bucket, key):
+    geo = args['geo']
+    host = args.get('endpoint', args.get('ENDPOINT'))
+    cos_hmac_keys = args['__bx_creds']['cloud-object-storage']['cos_hmac_keys']
+    url = create_signed_url(host,
+                            'GET',
+                            cos_hmac_keys['access_key_id'],
+                            cos_hmac_keys['secret_access_key'],
+                            geo,
+                            bucket,
+                            key)
+
+    return url
+
+
+def create_feature_store(args, cos, bucket):
+    if args.get('feature_store_dir'):
+        return FeatureStore(LocalBlobStore(args['feature_store_dir']))
+    else:
+        return FeatureStore(COSBlobStore(cos, bucket))
+
+
+def create_result_store(args, cos, bucket):
+    # Results can be turned off, e.g. to force parts to be aligned again
+    if not parse_flag(args, 'result_store'):
+        return None
+    if args.get('result_store_dir'):
+        return ResultStore(LocalBlobStore(args['result_store_dir']))
+    else:
+        return ResultStore(COSBlobStore(cos, bucket))
+
+
+def result_params(params, sample_rate, max_duration, streaming):
+    """
+    Everything besides the audio itself that an alignment result depends on
+
+    :param params: calc_alignment parameters, as PARAMS
+    :type params: dict
+    :param sample_rate: sample rate the audio is analysed at
+    :type sample_rate: int
+    :param max_duration: number of seconds of audio analysed at most
+    :type max_duration: float
+    :param streaming: whether features are streamed
+    :type streaming: bool
+    :return: parameters to key results on
+    :rtype: dict
+    """
+    return dict(params,
+                sample_rate=sample_rate,
+                max_duration=max_duration,
+                streaming=streaming,
+                algorithm_version=ALGORITHM_VERSION,
+                features_version=FEATURES_VERSION,
+                landmarks_version=LANDMARKS_VERSION)
+
+
+def load_reference(cos, bucket, feature_store, reference_key,
+                   load_from_cos, sample_rate, params, max_duration,
+                   stream_from_cos=None):
+    """
+    Load or calculate what the alignment engine in params needs from the
+    reference part
+
+    :param stream_from_cos: callable taking a key and feature names that
+                            streams the features of an object, to use
+                            instead of decoding the reference in full
+    :return: keyword arguments for calc_alignment, either features0 or
+             landmarks0
+    :rtype: dict
+    """
+    if params['engine'] == 'landmarks':
+        return {'landmarks0': load_reference_landmarks(cos, bucket, feature_store,
+                                                       reference_key, load_from_cos,
+                                                       sample_rate, max_duration)}
+
+    return {'features0': load_reference_features(cos, bucket, feature_store,
+                                                 reference_key, load_from_cos,
+                                                 sample_rate,
+                                                 hop_lengths_for(sample_rate),
+                                                 active_features(params),
+                                                 max_duration,
+                                                 stream_from_cos)}
+
+
+def load_reference_landmarks(cos, bucket, feature_store, reference_key,
+                             load_from_cos, sample_rate, max_duration):
+    """
+    Load the landmark index of the reference part from the feature store,
+    or decode the reference and build it if no other part has yet
+
+    :return: index as from build_landmark_index
+    :rtype: dict
+    """
+    reference_etag = cos.head_object(Bucket=bucket, Key=reference_key)['ETag']
+    params = dict(landmark_params(sample_rate), duration=max_duration)
+    landmarks0 = feature_store.load_arrays(reference_key, reference_etag, params)
+    if landmarks0 is None:
+        s0, sr0 = load_from_cos(reference_key)
+        print("Loaded from COS: ", reference_key)
+        landmarks0 = build_landmark_index(s0, sr0)
+        feature_store.save_arrays(reference_key, reference_etag, params, landmarks0)
+    else:
+        print("Loaded landmarks from store: ", reference_key)
+
+    return landmarks0
+
+
+def load_reference_features(cos, bucket, feature_store, reference_key,
+                            load_from_cos, sample_rate, hop_lengths,
+                            names=FEATURE_NAMES, max_duration=MAX_DURATION,
+                            stream_from_cos=None):
+    """
+    Load the features of the reference part from the feature store, or
+    decode the reference and calculate them if no other part has yet
+
+    :return: features for each hop length, as from gen_multi_hop_features
+    :rtype: dict
+    """
+    reference_etag = cos.head_object(Bucket=bucket, Key=reference_key)['ETag']
+    params = dict(feature_params(sample_rate, hop_lengths, names=names),
+                  duration=max_duration,
+                  streamed=stream_from_cos is not None)
+    features0 = feature_store.load(reference_key, reference_etag, params)
+    if features0 is None:
+        if stream_from_cos is not None:
+            features0 = stream_from_cos(reference_key, names)
+            print("Streamed features from COS: ", reference_key)
+        else:
+            # load in the leader
+            s0, sr0 = load_from_cos(reference_key)
+            print("Loaded from COS: ", reference_key)
+            features0 = gen_multi_hop_features(s0, sr0, hop_lengths, names=names)
+        feature_store.save(reference_key, reference_etag, params, features0)
+    else:
+        print("Loaded features from store: ", reference_key)
+
+    return features0
+
+
+def active_features(params):
+    # Only the features with a non-zero weight are ever calculated
+    return [name for name in FEATURE_NAMES
+            if params.get(f'{name}_weight', 1.0) != 0]
+
+
+def save_debug_artifact(cos, debug_bucket, rendition_key, reference_key, debug,
+                        params):
+    """
+    Save the error curves, candidate offsets, chosen offset and confidence
+    from calc_alignment as a JSON artifact in the debug bucket, for
+    render_alignment_debug to turn into a plot. Failures are logged but
+    not raised as the artifact is only for debugging.
+
+    :param cos: an ibm_boto3.client
+    :param debug_bucket: bucket to save the artifact in
+    :type debug_bucket: str
+    :param rendition_key: key of the part that was aligned
+    :type rendition_key: str
+    :param reference_key: key of the reference it was aligned against
+    :type reference_key: str
+    :param debug: result from calc_alignment
+    :type debug: dict
+    :param params: the params calc_alignment was called with
+    :type params: dict
+    """
+    key = f'{Path(rendition_key).stem}-alignment.json'
+    artifact = dict(debug,
+                    rendition_key=rendition_key,
+                    reference_key=reference_key,
+                    params=params)
+    try:
+        cos.put_object(Bucket=debug_bucket,
+                       Key=key,
+                       Body=json.dumps(artifact).encode('utf-8'))
+    except Exception as e:
+        print(f"Could not save debug artifact: {key}", e)
+
 
+def clamp_offset(offset_ms):
     # If the offset is too great, assume we failed and fallback to zero
     if offset_ms > 700 or offset_ms < -700:
-        print(f"Offset was too great ({offset}) so falling back to zero")
+        print(f"Offset was too great ({offset_ms}) so falling back to zero")
         offset_ms = 0
-
+    return offset_ms
+
+
+def review_alignment(alignment):
+    """
+    The offset to use from a calc_alignment result, and whether the part
+    should be reviewed by hand: when the offset was clamped, or it was
+    found with less than REVIEW_CONFIDENCE confidence
+
+    :param alignment: result from calc_alignment
+    :type alignment: dict
+    :return: (offset in ms, needs review)
+    :rtype: (int, bool)
+    """
+    offset_ms = clamp_offset(alignment['offset'])
+    needs_review = offset_ms != alignment['offset'] or \
+        alignment['confidence'] < REVIEW_CONFIDENCE
+    if needs_review:
+        print(f"Alignment needs review: offset {alignment['offset']} "
+              f"confidence {alignment['confidence']:.2f}")
+    return offset_ms, needs_review
+
+
+def post_offset(args, choir_id, song_id, part_id, offset_ms):
     # Save the offest to the API so we can trim on it later
     try:
-        api_url = args['CHOIRLESS_API_URL']
-        api_key = args['CHOIRLESS_API_KEY']
-
-        params = {'apikey': api_key}
-        payload = {'choirId': choir_id,
-                   'songId': song_id,
-                   'partId': part_id,
-                   'offset': offset_ms}
-        resp = requests.post(urljoin(api_url, 'choir/songpart'),
-                             params=params,
-                             json=payload)
-        resp.raise_for_status()
+        api = create_api_client(args)
+        api.post_songpart(choir_id, song_id, part_id, offset=offset_ms)
 
     except Exception as e:
         print(f"Could not store offset in API: choidId {choir_id} songId {song_id} partId {part_id} offset {offset_ms}", e)
 
-    ret = {"offset":  offset_ms,
-           "key": rendition_key,
-           "rendition_key": rendition_key,
-           "reference_key": reference_key,
-    }
 
-    return ret
+def save_offset(part_metadata, key, offset_ms):
+    # Keep the offset with the part too, so stages can seek to it rather
+    # than a trimmed copy of the part having to be made
+    try:
+        part_metadata.save(key, 'calculate_alignment', {'offset_ms': offset_ms})
+
+    except Exception as e:
+        print(f"Could not store offset in part metadata: key {key} offset {offset_ms}", e)
 
 
 def ms_to_frames(ms, sr, hop_length):
@@ -189,238 +859,1201 @@ def calc_prominence_threshold(signal, q=0.9):
     return prominence
 
 
+def calc_peak_prominence(signal, index):
+    # Prominence of the peak at signal[index], or 0 if it is not a peak.
+    # Curves from coarse hop lengths are stepped, so the peak may be flat.
+    peaks, properties = find_peaks(signal, plateau_size=1)
+    on_peak = (properties['left_edges'] <= index) & (index <= properties['right_edges'])
+    if on_peak.any():
+        return float(peak_prominences(signal, peaks[on_peak][:1])[0][0])
+    return 0.0
+
+
 def calc_peaks(signal, prominence=0, height=0):
     peaks, properties = find_peaks(signal, prominence=prominence, height=height)
     return peaks, properties.get('peak_heights', np.array([]))
 
 
-def map_peaks(peaks, length, decay=0.8):
-    data = np.zeros(length, dtype=np.float32)
-    np.put(data, peaks.astype(np.int), 1.0)
-
-    for i in range(1, len(data)):
-        data[i] = max(data[i], data[i-1] * decay)
-
-    for i in range(len(data) - 2, 0, -1):
-        data[i] = max(data[i], data[i+1] * decay)
-
-    return data
-
 def calc_errors(x0, x1, times, hop_length, exact=False):
+    shifts = calc_shifts(times, hop_length)
     if exact:
-        errors = np.array([measure_error_chroma(x0, x1, -int(ms_to_frames(t, SAMPLE_RATE, hop_length))) for t in times])
+        errors = calc_chroma_error_curve(x0, x1, shifts)
     else:
-        errors = np.array([measure_error(x0, x1, -int(ms_to_frames(t, SAMPLE_RATE, hop_length))) for t in times])
+        errors = calc_error_curve(x0, x1, shifts)
     return errors
 
 
-# function to measure two waveforms with one offset by a certian amount
-def measure_error(x0, x1, offset):
-    max_len = min(len(x0), len(x1))
+def calc_shifts(times, hop_length):
+    # The frame shift for each candidate offset, x1 being rolled by it
+    frames = ms_to_frames(np.asarray(times), SAMPLE_RATE, hop_length)
+    return -np.trunc(frames).astype(int)
 
-    # calculate the mean squared error of the two signals
-    diff = x0[:max_len] - np.roll(x1[:max_len], offset)
-    if len(diff) > 0:
-        return np.sum(diff**2) / len(diff)
-    return 0
 
-# function to measure two waveforms with one offset by a certian amount
-def measure_error_chroma(x0, x1, offset):
-    x0t = x0.transpose()
-    x1t = x1.transpose()
-    max_len = min(len(x0t), len(x1t))
+def circular_xcorr(a, b):
+    """
+    Circular cross-correlation of a and b along the last axis, such that
+    result[..., k] == np.sum(a * np.roll(b, k, axis=-1), axis=-1)
+    """
+    n = a.shape[-1]
+    fa = np.fft.rfft(a, n=n)
+    fb = np.fft.rfft(b, n=n)
+    return np.fft.irfft(fa * np.conj(fb), n=n)
 
-    x0a = np.argmax(x0t, axis=1) / 12
-    x1a = np.argmax(x1t, axis=1) / 12
 
-    # calculate the mean squared error of the two signals
-    diff = np.where(x0a[:max_len] == np.roll(x1a[:max_len], offset, 0), 0, 1)
-    if len(diff) > 0:
-        return np.nanmean(diff)
-    return 0
+def use_fft(n_shifts, n):
+    # A direct evaluation costs O(n) per shift, the FFT O(n log n) in total
+    return n_shifts > 2 * np.log2(max(n, 2))
 
 
-def gen_features(s, sr, n_fft_seconds=0.04, hop_length_seconds=0.01):
-    if not hasattr(gen_features, '__cache'):
-        gen_features.__cache = {}
-    cache = gen_features.__cache
+def calc_error_curve(x0, x1, shifts):
+    """
+    Mean squared error between x0 and x1 rolled by each of shifts, over
+    their common length.
 
-    key = (hash(s.tobytes()), n_fft_seconds, hop_length_seconds)
-    if key in cache:
-        return cache[key]
+    As np.roll is circular the energy of the rolled signal does not depend on
+    the shift, so the mean squared error for every shift falls out of a single
+    FFT cross-correlation: sum((a - roll(b, k))**2) = |a|^2 + |b|^2 - 2 xcorr[k]
 
-    sound = Waveform(signal=s, sample_rate=sr)
-    sf = sound.spectral_flux(n_fft_seconds, hop_length_seconds)[0]
-    cf = sound.crest_factor(n_fft_seconds, hop_length_seconds)[0]
-    #chroma = np.argmax(sound.chroma_cqt(hop_length_seconds), axis=0) / 12
-    chroma = sound.chroma_cens(hop_length_seconds)
-
-    cache[key] = (sf, cf, chroma)
+    When only a few distinct shifts are wanted (coarse hop lengths, or a
+    narrow band of offsets) they are evaluated directly instead.
+    """
+    max_len = min(len(x0), len(x1))
+    if max_len == 0:
+        return np.zeros(len(shifts))
 
-    return sf, cf, chroma
+    a = np.asarray(x0[:max_len], dtype=np.float64)
+    b = np.asarray(x1[:max_len], dtype=np.float64)
 
-def gen_peak_map(signal):
-    if not hasattr(gen_peak_map, '__cache'):
-        gen_peak_map.__cache = {}
-    cache = gen_peak_map.__cache
+    unique_shifts, inverse = np.unique(np.mod(shifts, max_len), return_inverse=True)
+    if use_fft(len(unique_shifts), max_len):
+        xcorr = circular_xcorr(a, b)[unique_shifts]
+    else:
+        xcorr = np.array([np.dot(a[k:], b[:max_len - k]) + np.dot(a[:k], b[max_len - k:])
+                          for k in unique_shifts])
+
+    energy = np.dot(a, a) + np.dot(b, b)
+    errors = energy - 2 * xcorr[inverse]
+
+    # Guard against tiny negative values from floating point error
+    return np.maximum(errors, 0) / max_len
+
+
+def calc_chroma_error_curve(x0, x1, shifts, n_chroma=12):
+    """
+    Fraction of frames whose dominant pitch class differs between x0 and
+    x1 rolled by each of shifts, over their common length.
+
+    The dominant pitch class of each frame is computed once, and the number of
+    matching frames for every shift is counted with one cross-correlation of
+    the one-hot encoded pitch classes.
+    """
+    max_len = min(x0.shape[1], x1.shape[1])
+    if max_len == 0:
+        return np.zeros(len(shifts))
+
+    a0 = np.argmax(x0[:, :max_len], axis=0)
+    a1 = np.argmax(x1[:, :max_len], axis=0)
+
+    unique_shifts, inverse = np.unique(np.mod(shifts, max_len), return_inverse=True)
+    if use_fft(n_chroma * len(unique_shifts), max_len):
+        classes = np.arange(n_chroma)[:, np.newaxis]
+        onehot0 = (a0 == classes).astype(np.float64)
+        onehot1 = (a1 == classes).astype(np.float64)
+        matches = np.rint(circular_xcorr(onehot0, onehot1).sum(axis=0))[unique_shifts]
+    else:
+        matches = np.array([np.count_nonzero(a0[k:] == a1[:max_len - k]) +
+                            np.count_nonzero(a0[:k] == a1[max_len - k:])
+                            for k in unique_shifts])
 
-    key = hash(signal.tobytes())
-    if key in cache:
-        return cache[key]
+    return (max_len - matches[inverse]) / max_len
 
-    peaks, peak_heights = calc_peaks(signal)
-    std = np.std(peak_heights)
-    peaks = peaks[peak_heights > std]
-    peak_map = map_peaks(peaks, len(signal))
 
-    cache[key] = peak_map
+def numseconds_to_numsamples(numseconds, sample_rate):
+    # Closest power of two, as surfboard rounds its frame and hop lengths
+    return int(2 ** np.round(np.log2(int(numseconds * sample_rate))))
 
-    return peak_map
 
+def hop_lengths_for(sr):
+    # HOP_LENGTHS are in samples at SAMPLE_RATE, keep the same hops in seconds
+    return [numseconds_to_numsamples(h / SAMPLE_RATE, sr) for h in HOP_LENGTHS]
 
-def calc_offset(s0, sr0, s1, sr1,
-                ax=None,
-                start_seconds=None,
-                length_seconds=None,
-                chroma_weight=1.0, sf_weight=1.0, cf_weight=1.0):
 
+def gen_features(s, sr, n_fft_seconds=0.04, hop_length_seconds=0.01):
+    hop_length = numseconds_to_numsamples(hop_length_seconds, sr)
+    features = gen_multi_hop_features(s, sr, [hop_length],
+                                      n_fft_seconds=n_fft_seconds)
+    return features[hop_length]
+
+
+def feature_params(sr, hop_lengths, n_fft_seconds=0.04, names=FEATURE_NAMES):
+    # Everything that affects the output of gen_multi_hop_features
+    return {'sr': sr,
+            'hop_lengths': list(hop_lengths),
+            'n_fft_seconds': n_fft_seconds,
+            'features': sorted(names),
+            'version': FEATURES_VERSION}
+
+
+def landmark_params(sr):
+    # Everything that affects the output of build_landmark_index
+    return {'engine': 'landmarks',
+            'sr': sr,
+            'n_fft_seconds': LANDMARK_N_FFT_SECONDS,
+            'hop_length': LANDMARK_HOP_LENGTH,
+            'max_bin': LANDMARK_MAX_BIN,
+            'peak_size': list(LANDMARK_PEAK_SIZE),
+            'peaks_per_second': LANDMARK_PEAKS_PER_SECOND,
+            'fan_out': LANDMARK_FAN_OUT,
+            'max_dt': LANDMARK_MAX_DT,
+            'max_df': LANDMARK_MAX_DF,
+            'version': LANDMARKS_VERSION}
+
+
+class LazyGraph:
+    """
+    Named values, each calculated from the values it depends on the first
+    time it is asked for, so only what is needed is ever calculated.
+    """
+
+    def __init__(self):
+        self.nodes = {}
+        self.values = {}
+
+    def add(self, name, f, *depends_on):
+        self.nodes[name] = (f, depends_on)
+
+    def __getitem__(self, name):
+        if name not in self.values:
+            f, depends_on = self.nodes[name]
+            self.values[name] = f(*[self[d] for d in depends_on])
+        return self.values[name]
+
+
+def gen_multi_hop_features(s, sr, hop_lengths, n_fft_seconds=0.04,
+                           store=None, store_key=None, names=FEATURE_NAMES,
+                           cache=True):
+    """
+    Calculate the spectral flux, crest factor and CENS chroma of a signal
+    for several hop lengths at once.
+
+    A single STFT, RMS and CQT chroma pass is made at the finest hop length
+    (the gcd of hop_lengths). As frames are centred, frame i at a hop length
+    of k * base_hop is frame k * i at base_hop, so coarser hop lengths are
+    derived by decimation rather than by re-analysing the signal.
+
+    Only the features in names, and the passes they need, are calculated.
+
+    :param s: mono signal
+    :param sr: sample rate of the signal
+    :param hop_lengths: hop lengths in samples
+    :param n_fft_seconds: length of the analysis window in seconds
+    :param store: optional FeatureStore to load from and save to
+    :param store_key: (object_key, etag) of the object s was loaded from
+    :param names: features to calculate, from FEATURE_NAMES
+    :param cache: look the features up in, and add them to, feature_cache.
+                  Off in worker processes, whose caches nothing reads
+    :return: dict of hop_length -> (sf, cf, chroma), with None for any
+             feature not in names
+    """
+    if store is not None:
+        params = feature_params(sr, hop_lengths, n_fft_seconds, names)
+        features = store.load(*store_key, params)
+        if features is not None:
+            return features
+
+    base_hop = reduce(math.gcd, hop_lengths)
+    n_fft = numseconds_to_numsamples(n_fft_seconds, sr)
+
+    def decimate(f):
+        return lambda x, *rest: {h: f(x[..., ::h // base_hop],
+                                      *[r[..., ::h // base_hop] for r in rest])
+                                 for h in hop_lengths}
+
+    graph = LazyGraph()
+    graph.add('magnitude',
+              lambda: np.abs(librosa.stft(s, n_fft=n_fft, hop_length=base_hop)))
+    graph.add('rms',
+              lambda: librosa.feature.rms(y=s, frame_length=n_fft, hop_length=base_hop)[0])
+    graph.add('peak',
+              lambda rms: frame_max(s, n_fft, base_hop, len(rms)),
+              'rms')
+    graph.add('chroma_cqt',
+              lambda: librosa.feature.chroma_cqt(y=s, sr=sr, hop_length=base_hop, norm=None,
+                                                 tuning=estimate_tuning(s, sr)))
+    graph.add('sf', decimate(calc_spectral_flux), 'magnitude')
+    graph.add('cf', decimate(lambda peak, rms: np.abs(peak) / rms), 'peak', 'rms')
+    graph.add('chroma', decimate(calc_chroma_cens), 'chroma_cqt')
+
+    # Each feature is cached on its own, so asking for more features later
+    # only calculates the ones that are new
+    fp = fingerprint(s) if cache else None
+    by_name = {}
+    for name in names:
+        key = ('features', name, fp, sr, tuple(hop_lengths), n_fft_seconds)
+        by_name[name] = feature_cache.get(key) if cache else None
+        if by_name[name] is None:
+            by_name[name] = graph[name]
+            if cache:
+                feature_cache.put(key, by_name[name])
+
+    features = {h: tuple(by_name[name][h] if name in by_name else None
+                         for name in FEATURE_TUPLE_NAMES)
+                for h in hop_lengths}
+
+    if store is not None:
+        store.save(*store_key, params, features)
+
+    return features
+
+
+def gen_multi_hop_features_parallel(executor, signals, names=FEATURE_NAMES,
+                                    n_fft_seconds=0.04):
+    """
+    Calculate the features of several signals at once, as a task in
+    executor for each signal and feature. Signals are passed to the tasks
+    through shared memory rather than pickled.
+
+    Features already in the feature cache are not calculated again, and
+    those calculated are added to it, as with gen_multi_hop_features.
+
+    :param executor: a ProcessPoolExecutor
+    :param signals: list of (s, sr, hop_lengths)
+    :param names: features to calculate, from FEATURE_NAMES
+    :param n_fft_seconds: length of the analysis window in seconds
+    :return: list of dicts of hop_length -> (sf, cf, chroma), as from
+             gen_multi_hop_features, in the order of signals
+    """
+    by_name = [{} for _ in signals]
+    futures = {}
+    shms = []
     try:
+        for i, (s, sr, hop_lengths) in enumerate(signals):
+            fp = fingerprint(s)
+            shm = None
+            for name in names:
+                key = ('features', name, fp, sr, tuple(hop_lengths), n_fft_seconds)
+                by_name[i][name] = feature_cache.get(key)
+                if by_name[i][name] is not None:
+                    continue
+
+                if shm is None:
+                    shm = shared_memory.SharedMemory(create=True, size=max(1, s.nbytes))
+                    shms.append(shm)
+                    np.ndarray(s.shape, dtype=s.dtype, buffer=shm.buf)[:] = s
+
+                futures[(i, name)] = (key, executor.submit(gen_shared_feature,
+                                                           shm.name, s.shape, s.dtype.str,
+                                                           sr, hop_lengths, name,
+                                                           n_fft_seconds))
+
+        for (i, name), (key, future) in futures.items():
+            by_name[i][name] = future.result()
+            feature_cache.put(key, by_name[i][name])
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+    return [{h: tuple(features[name][h] if name in features else None
+                      for name in FEATURE_TUPLE_NAMES)
+             for h in hop_lengths}
+            for features, (s, sr, hop_lengths) in zip(by_name, signals)]
+
+
+def gen_shared_feature(shm_name, shape, dtype, sr, hop_lengths, name, n_fft_seconds):
+    # One feature of a signal in shared memory, for
+    # gen_multi_hop_features_parallel. The parent caches what it gets back
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        s = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        features = gen_multi_hop_features(s, sr, hop_lengths, n_fft_seconds,
+                                          names=[name], cache=False)
+        index = FEATURE_TUPLE_NAMES.index(name)
+        feature = {h: values[index] for h, values in features.items()}
+        del s, features
+    finally:
+        shm.close()
+    return feature
+
+
+def frame_max(s, frame_length, hop_length, n_frames):
+    # Max of s over the (uncentred) windows surfboard uses for crest factor
+    padded_len = (n_frames - 1) * hop_length + frame_length
+    padded = np.full(padded_len, -np.inf, dtype=s.dtype)
+    padded[:len(s)] = s[:padded_len]
+    frames = librosa.util.frame(padded,
+                                frame_length=frame_length,
+                                hop_length=hop_length)
+    peak = frames.max(axis=0)
+    peak[~np.isfinite(peak)] = 0
+    return peak
+
+
+def calc_spectral_flux(magnitude):
+    # As surfboard: the first frame is repeated so the first delta is 0
+    delta = np.diff(magnitude, axis=1, prepend=magnitude[:, :1])
+    return np.sqrt((delta ** 2).sum(axis=0)) / magnitude.shape[0]
+
+
+def estimate_tuning(s, sr):
+    # chroma_cqt's own estimate, but from the start of the signal only
+    return librosa.estimate_tuning(y=s[:int(TUNING_SECONDS * sr)], sr=sr,
+                                   bins_per_octave=36)
+
+
+def calc_chroma_cens(chroma, win_len_smooth=41):
+    # CENS post-processing from librosa.feature.chroma_cens, applied to an
+    # unnormalised CQT chromagram
+    chroma = librosa.util.normalize(chroma, norm=1, axis=0)
+
+    chroma_quant = np.zeros_like(chroma)
+    for step in [0.4, 0.2, 0.1, 0.05]:
+        chroma_quant += (chroma > step) * 0.25
+
+    win = librosa.filters.get_window('hann', win_len_smooth + 2, fftbins=False)
+    win /= np.sum(win)
+    cens = scipy.ndimage.convolve(chroma_quant, win[np.newaxis, :], mode='constant')
+
+    return librosa.util.normalize(cens, norm=2, axis=0)
+
+
+class StreamingFeatures:
+    """
+    The same features as gen_multi_hop_features, calculated block by block
+    as the audio is decoded, so only a block of audio and its spectrogram
+    are ever held in memory however long the recording is.
+
+    The STFT and RMS frames of the whole signal are windows of the signal
+    with n_fft // 2 zeros either side, so they are calculated uncentred over
+    a buffer that keeps the samples the next frame starts from. The CQT
+    chroma is calculated over each block with a margin either side, and
+    only the frames at least a margin from the ends of that are kept. The
+    tuning is estimated from the first TUNING_SECONDS, as it is for the
+    whole signal, and then kept fixed.
+    """
+
+    def __init__(self, sr, hop_lengths, n_fft_seconds=0.04,
+                 names=FEATURE_NAMES, tuning=None):
+        """
+        :param sr: sample rate of the signal
+        :param hop_lengths: hop lengths in samples
+        :param n_fft_seconds: length of the analysis window in seconds
+        :param names: features to calculate, from FEATURE_NAMES
+        :param tuning: CQT tuning, estimated from the start of the signal if None
+        """
+        self.sr = sr
+        self.hop_lengths = list(hop_lengths)
+        self.names = names
+        self.tuning = tuning
+
+        self.base_hop = reduce(math.gcd, self.hop_lengths)
+        self.n_fft = numseconds_to_numsamples(n_fft_seconds, sr)
+        self.margin = int(math.ceil(CQT_MARGIN_SECONDS * sr / self.base_hop)) * self.base_hop
+
+        self.n_samples = 0
+
+        # Zero padded signal from the start of the next STFT frame
+        self.buf = np.zeros(self.n_fft // 2, dtype=np.float32)
+        self.n_frames = 0
+
+        # Signal from cqt_start, and the next chroma frame
+        self.cqt_buf = np.zeros(0, dtype=np.float32)
+        self.cqt_start = 0
+        self.cqt_frames = 0
+
+        # Feature values so far, and the last magnitude column of each hop
+        # length for the spectral flux of the next block
+        self.parts = defaultdict(list)
+        self.last_magnitude = {}
+
+    def add(self, block):
+        """
+        Calculate the features of every frame the block completes
+
+        :param block: next samples of the mono signal
+        """
+        self.n_samples += len(block)
+
+        if 'sf' in self.names or 'cf' in self.names:
+            self.buf = np.concatenate([self.buf, block])
+            self.add_frames(final=False)
+
+        if 'chroma' in self.names:
+            self.cqt_buf = np.concatenate([self.cqt_buf, block])
+            self.add_chroma(final=False)
+
+    def finish(self):
+        """
+        Calculate the features of the remaining frames, once the whole signal
+        has been added
+
+        :return: dict of hop_length -> (sf, cf, chroma), as from
+                 gen_multi_hop_features
+        """
+        if 'sf' in self.names or 'cf' in self.names:
+            self.add_frames(final=True)
+        if 'chroma' in self.names:
+            self.add_chroma(final=True)
+
+        by_name = {}
+        if 'sf' in self.names:
+            by_name['sf'] = {h: np.concatenate(self.parts[('sf', h)])
+                             for h in self.hop_lengths}
+        if 'cf' in self.names:
+            rms = np.concatenate(self.parts['rms'])
+            peak = np.concatenate(self.parts['peak'])
+            by_name['cf'] = {h: np.abs(peak[::h // self.base_hop]) / rms[::h // self.base_hop]
+                             for h in self.hop_lengths}
+        if 'chroma' in self.names:
+            chroma = np.concatenate(self.parts['chroma_cqt'], axis=1)
+            by_name['chroma'] = {h: calc_chroma_cens(chroma[:, ::h // self.base_hop])
+                                 for h in self.hop_lengths}
+
+        return {h: tuple(by_name[name][h] if name in by_name else None
+                         for name in FEATURE_TUPLE_NAMES)
+                for h in self.hop_lengths}
+
+    def add_frames(self, final):
+        hop = self.base_hop
+        n_fft = self.n_fft
+        half = n_fft // 2
+        buf = self.buf
+
+        if final:
+            # Zeros after the end, as for the last centred frames
+            signal_end = len(buf)
+            buf = np.concatenate([buf, np.zeros(half, dtype=buf.dtype)])
+            n = (len(buf) - n_fft) // hop + 1
+        else:
+            # The peak's windows are not centred, so start half a window
+            # later than the STFT frame and need that much more signal
+            signal_end = len(buf)
+            n = (len(buf) - n_fft - half) // hop + 1
+        if n <= 0:
+            return
+
+        frames_end = (n - 1) * hop + n_fft
+
+        if 'sf' in self.names:
+            magnitude = np.abs(librosa.stft(buf[:frames_end], n_fft=n_fft,
+                                            hop_length=hop, center=False))
+            for h in self.hop_lengths:
+                # Columns that fall on this hop length's frames
+                k = h // hop
+                columns = magnitude[:, (-self.n_frames) % k::k]
+                if columns.shape[1] == 0:
+                    continue
+                previous = self.last_magnitude.get(h, columns[:, :1])
+                delta = np.diff(columns, axis=1, prepend=previous)
+                self.parts[('sf', h)].append(np.sqrt((delta ** 2).sum(axis=0)) / magnitude.shape[0])
+                self.last_magnitude[h] = columns[:, -1:]
+
+        if 'cf' in self.names:
+            rms = librosa.feature.rms(y=buf[:frames_end], frame_length=n_fft,
+                                      hop_length=hop, center=False)[0]
+            self.parts['rms'].append(rms)
+            self.parts['peak'].append(frame_max(buf[half:min(half + frames_end, signal_end)],
+                                                n_fft, hop, n))
+
+        self.n_frames += n
+        self.buf = buf[n * hop:]
+
+    def add_chroma(self, final):
+        hop = self.base_hop
+        cqt_end = self.cqt_start + len(self.cqt_buf)
+
+        if final:
+            end = self.n_samples // hop + 1
+        else:
+            # Frames at least a margin from the end of the signal so far
+            end = (cqt_end - self.margin) // hop + 1
+        if end <= self.cqt_frames:
+            return
+
+        if self.tuning is None:
+            # Wait for as much of the signal as the whole signal estimate
+            # uses. Nothing has been dropped from cqt_buf yet
+            if not final and self.n_samples < TUNING_SECONDS * self.sr:
+                return
+            self.tuning = estimate_tuning(self.cqt_buf, self.sr)
+
+        chroma = librosa.feature.chroma_cqt(y=self.cqt_buf, sr=self.sr,
+                                            hop_length=hop, norm=None,
+                                            tuning=self.tuning)
+        first = self.cqt_start // hop
+        self.parts['chroma_cqt'].append(chroma[:, self.cqt_frames - first:end - first])
+        self.cqt_frames = end
+
+        # Keep a margin before the next frame
+        cqt_start = max(0, end * hop - self.margin)
+        self.cqt_buf = self.cqt_buf[cqt_start - self.cqt_start:]
+        self.cqt_start = cqt_start
+
+
+def stream_features(url, sr, hop_lengths, names=FEATURE_NAMES, duration=None,
+                    block_seconds=STREAM_BLOCK_SECONDS):
+    """
+    Decode the audio at url and calculate its features block by block with
+    StreamingFeatures, so memory does not grow with the recording
+
+    :param url: URL (e.g. a signed COS GET URL) or path of the media
+    :param sr: sample rate to decode and analyse at
+    :param hop_lengths: hop lengths in samples
+    :param names: features to calculate, from FEATURE_NAMES
+    :param duration: maximum number of seconds to decode, or None for all
+    :param block_seconds: seconds of audio decoded at a time
+    :return: dict of hop_length -> (sf, cf, chroma), as from
+             gen_multi_hop_features
+    """
+    extractor = StreamingFeatures(sr, hop_lengths, names=names)
+    for block in audio_blocks(url, sr, duration=duration,
+                              block_seconds=block_seconds):
+        extractor.add(block)
+    return extractor.finish()
+
+
+def calc_hop_errors(features, times, hop_length, weights):
+    """
+    Normalised, weighted error curves for one hop length.
+
+    :param features: dict of feature name -> (x0, x1)
+    :param times: candidate offsets in ms
+    :param hop_length: hop length in samples at SAMPLE_RATE
+    :param weights: dict of feature name -> weight
+    :return: dict of feature name -> error curve
+    """
+    errors = {}
+    for name, (x0, x1) in features.items():
+        e = calc_errors(x0, x1, times, hop_length, exact=(name == 'chroma'))
+        std = np.std(e)
+        std = 1 if std == 0 else std
+        e = (e - np.mean(e)) / std
+        e *= weights[name]
+        errors[name] = e
+    return errors
 
-        # Acutally calc the offset
-        lookahead_ms = 100
-        lookbehind_ms = 600
-
-        hop_lengths = [256, 512, 1024, 2048]
-
-        times = np.arange(-lookahead_ms, lookbehind_ms, 10)
-
-        all_chroma_errors = []
-        all_sf_errors = []
-        all_cf_errors = []
-
-        for hop_length in hop_lengths:
-
-            hop_length_seconds = hop_length / SAMPLE_RATE 
-
-            sf0, cf0, chroma_s0 = gen_features(s0, sr0, hop_length_seconds=hop_length_seconds)
-            sf1, cf1, chroma_s1 = gen_features(s1, sr1, hop_length_seconds=hop_length_seconds)
 
+def smooth_curves(curves, transition_variance=1.0, observation_variance=1.0,
+                  initial_variance=1.0):
+    """
+    Smoothed estimate of the single curve that the rows of curves are noisy
+    observations of, modelled as a random walk starting from zero.
+
+    This is what a Kalman filter plus Rauch-Tung-Striebel smoother gives for
+    that model, but as the model is linear and Gaussian the smoothed curve
+    is just the solution of a tridiagonal system, so it is solved directly.
+
+    :param curves: array of shape (number of curves, number of points)
+    :param transition_variance: variance of each step of the random walk
+    :param observation_variance: variance of the noise on each curve
+    :param initial_variance: variance of the first point about zero
+    :return: the smoothed curve
+    """
+    k, n = curves.shape
+
+    # Precision of the posterior: the walk couples each point to its
+    # neighbours, and each point is observed k times
+    diagonal = np.full(n, k / observation_variance)
+    diagonal[0] += 1 / initial_variance
+    diagonal[:-1] += 1 / transition_variance
+    diagonal[1:] += 1 / transition_variance
+    off_diagonal = np.full(n, -1 / transition_variance)
+
+    banded = np.stack([off_diagonal, diagonal, off_diagonal])
+    observed = np.sum(curves, axis=0) / observation_variance
+
+    return solve_banded((1, 1), banded, observed)
+
+
+def contiguous_runs(times):
+    """
+    Split candidate offsets into the runs with no gap in them, e.g. the
+    separate bands around each coarse candidate
+
+    :param times: candidate offsets in ms, ascending
+    :return: list of slices of times
+    """
+    if len(times) < 2:
+        return [slice(0, len(times))]
+    steps = np.diff(times)
+    breaks = np.flatnonzero(steps > steps.min()) + 1
+    bounds = [0, *breaks, len(times)]
+    return [slice(start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def fuse_errors(hop_errors, times):
+    """
+    Smooth each feature's per hop length error curves into one curve, and
+    sum those into an overall curve. Each contiguous run of times is
+    smoothed on its own, so bands around separate candidates don't bleed
+    into each other across the gaps between them.
+
+    :param hop_errors: list of dicts from calc_hop_errors
+    :param times: candidate offsets in ms the curves are over
+    :return: dict of feature name -> curves used, dict of feature name ->
+             smoothed curve, and the overall curve
+    """
+    runs = contiguous_runs(times)
+    all_errors = {}
+    fused = {}
+    for name in FEATURE_NAMES:
+        curves = [e[name] for e in hop_errors
+                  if name in e and np.isfinite(e[name]).all()]
+        if len(curves):
+            curves = np.stack(curves)
+            all_errors[name] = curves
+            fused[name] = np.concatenate([smooth_curves(curves[:, run])
+                                          for run in runs])
+
+    total = np.sum(np.stack(list(fused.values())), axis=0)
+    return all_errors, fused, total
+
+
+def pick_offsets(times, total):
+    # Candidate offsets are the clear minima of the overall error
+    peaks, _ = calc_peaks(-total, height=1.0, prominence=1.0)
+    return times[peaks]
+
+
+def calc_offset(s0, sr0, s1, sr1, debug=None, **kwargs):
+    """
+    Offset of s1 behind s0, as calc_alignment finds it
+
+    :param debug: optional dict to fill in with the rest of calc_alignment's
+                  result, e.g. for render_alignment_debug
+    :param kwargs: as for calc_alignment
+    :return: offset in ms
+    """
+    result = calc_alignment(s0, sr0, s1, sr1, **kwargs)
+    if debug is not None:
+        debug.update(result)
+    return result['offset']
+
+
+def calc_alignment(s0, sr0, s1, sr1,
+                   start_seconds=None,
+                   length_seconds=None,
+                   chroma_weight=1.0, sf_weight=1.0, cf_weight=1.0,
+                   search='exhaustive',
+                   window='full',
+                   engine='features',
+                   early_exit=False,
+                   features0=None, features1=None, landmarks0=None,
+                   executor=None):
+    """
+    Find the offset of s1 behind s0, and how confident we are of it.
+
+    With early_exit, the EARLY_EXIT_HOPS coarsest hop lengths are evaluated
+    first, and if they agree on the offset with a prominent enough peak the
+    finer hop lengths are skipped, along with calculating their features.
+
+    :param s0: reference signal, or None if features0 or landmarks0 is given
+    :param s1: part signal, or None if features1 is given
+    :param features0: reference features from gen_multi_hop_features
+    :param features1: part features from gen_multi_hop_features
+    :param landmarks0: reference index from build_landmark_index
+    :param executor: optional ProcessPoolExecutor to calculate features in
+    :return: dict with the 'offset' in ms, its 'confidence' from 0 to 1, the
+             'prominence' of its peak, the 'margin' it beats the next
+             candidate by and the candidate 'offsets', plus the curves it was
+             chosen from: 'times', 'curves', 'fused' and 'total' from the
+             feature engine, or 'vote_times' and 'votes' from the landmark
+             engine
+    :rtype: dict
+    """
+    if engine == 'landmarks':
+        return calc_alignment_landmarks(s0, sr0, s1, sr1,
+                                        landmarks0=landmarks0)
+
+    if window == 'adaptive' and s1 is not None:
+        return calc_alignment_windowed(s0, sr0, s1, sr1,
+                                       chroma_weight=chroma_weight,
+                                       sf_weight=sf_weight,
+                                       cf_weight=cf_weight,
+                                       search=search,
+                                       early_exit=early_exit,
+                                       features0=features0,
+                                       executor=executor)
+
+    # Acutally calc the offset
+    lookahead_ms = 100
+    lookbehind_ms = 600
+
+    hop_lengths = HOP_LENGTHS
+
+    times = np.arange(-lookahead_ms, lookbehind_ms, 10)
+
+    weights = {'chroma': chroma_weight, 'sf': sf_weight, 'cf': cf_weight}
+
+    names = [name for name in FEATURE_NAMES if weights[name] != 0]
+    if not names:
+        print("All feature weights are zero, so cannot sync audio")
+        return {'offset': 0, 'confidence': 0.0, 'prominence': 0.0,
+                'margin': 0.0, 'offsets': []}
+
+    hops0 = [numseconds_to_numsamples(h / SAMPLE_RATE, sr0) for h in hop_lengths]
+    hops1 = [numseconds_to_numsamples(h / SAMPLE_RATE, sr1) for h in hop_lengths]
+
+    def ensure_features(indices):
+        # Features for every hop length come from one analysis per signal,
+        # unless they have been passed in already calculated
+        nonlocal features0, features1
+        features0, features1 = gen_missing_features(
+            [(features0, s0, sr0, [hops0[i] for i in indices]),
+             (features1, s1, sr1, [hops1[i] for i in indices])],
+            names, executor)
+
+    def hop_features(i):
+        hop_length_seconds = hop_lengths[i] / SAMPLE_RATE
+
+        pairs = dict(zip(FEATURE_TUPLE_NAMES,
+                         zip(features0[hops0[i]], features1[hops1[i]])))
+
+        features = {}
+        for name in names:
+            x0, x1 = pairs[name]
+
+            # Frames are the last axis of every feature
             if start_seconds is not None:
                 start_frames = int(start_seconds // hop_length_seconds)
-                sf0 = sf0.copy()[start_frames:]
-                sf1 = sf1.copy()[start_frames:]
-                cf0 = cf0.copy()[start_frames:]
-                cf1 = cf1.copy()[start_frames:]
-                chroma_s0 = chroma_s0.copy()[start_frames:]
-                chroma_s1 = chroma_s1.copy()[start_frames:]
+                x0 = x0[..., start_frames:]
+                x1 = x1[..., start_frames:]
 
             if length_seconds is not None:
                 length_frames = int(length_seconds // hop_length_seconds)
-                sf0 = sf0.copy()[:length_frames]
-                sf1 = sf1.copy()[:length_frames]
-                cf0 = cf0.copy()[:length_frames]
-                cf1 = cf1.copy()[:length_frames]
-                chroma_s0 = chroma_s0.copy()[:length_frames]
-                chroma_s1 = chroma_s1.copy()[:length_frames]
-
-            map_sf0 = gen_peak_map(sf0)
-            map_sf1 = gen_peak_map(sf1)
-            map_cf0 = gen_peak_map(cf0)
-            map_cf1 = gen_peak_map(cf1)
-
-            chroma_errors = calc_errors(chroma_s0,
-                                        chroma_s1,
-                                        times,
-                                        hop_length,
-                                        exact=True)
-            std = np.std(chroma_errors)
-            std = 1 if std == 0 else std
-            chroma_errors = (chroma_errors - np.mean(chroma_errors)) / std
-            chroma_errors *= chroma_weight
-            if np.isfinite(chroma_errors).all():
-                all_chroma_errors.append(chroma_errors)
-
-            sf_errors = calc_errors(sf0,
-                                    sf1,
-                                    times,
-                                    hop_length)
-            std = np.std(sf_errors)
-            std = 1 if std == 0 else std
-            sf_errors = (sf_errors - np.mean(sf_errors)) / std
-            sf_errors *= sf_weight
-            if np.isfinite(sf_errors).all():
-                all_sf_errors.append(sf_errors)
-
-            cf_errors = calc_errors(cf0,
-                                    cf1,
-                                    times,
-                                    hop_length)
-            std = np.std(cf_errors)
-            std = 1 if std == 0 else std
-            cf_errors = (cf_errors - np.mean(cf_errors)) / std
-            cf_errors *= cf_weight
-            if np.isfinite(cf_errors).all():
-                all_cf_errors.append(cf_errors)
-
-        # Normalise
-        to_stack = []
-        if len(all_chroma_errors):
-            all_chroma_errors = np.stack(all_chroma_errors)
-            kf = KalmanFilter(initial_state_mean=0, n_dim_obs=all_chroma_errors.shape[0])
-            median_chroma_errors = kf.smooth(all_chroma_errors.transpose())[0].flatten()
-            to_stack.append(median_chroma_errors)
-
-        if len(all_sf_errors):
-            all_sf_errors = np.stack(all_sf_errors)
-            kf = KalmanFilter(initial_state_mean=0, n_dim_obs=all_sf_errors.shape[0])
-            median_sf_errors = kf.smooth(all_sf_errors.transpose())[0].flatten()
-            to_stack.append(median_sf_errors)
-
-        if len(all_cf_errors):
-            all_cf_errors = np.stack(all_cf_errors)
-            kf = KalmanFilter(initial_state_mean=0, n_dim_obs=all_cf_errors.shape[0])
-            median_cf_errors = kf.smooth(all_cf_errors.transpose())[0].flatten()
-            to_stack.append(median_cf_errors)
-        
-        total = np.sum(np.stack(to_stack), axis=0)
+                x0 = x0[..., :length_frames]
+                x1 = x1[..., :length_frames]
 
-        peaks, _ = calc_peaks(-total, height=1.0, prominence=1.0)
+            features[name] = (x0, x1)
 
-        if len(peaks) > 0:
-            offsets = times[peaks]
-            offset_ms = offsets[0]
-        else:
-            offsets = []
-            offset_ms = 0
-            
-        if ax:
-            if len(all_chroma_errors):
-                for chroma_errors in all_chroma_errors:
-                    ax.plot(times, chroma_errors, color='r', alpha=0.3)
-                ax.plot(times, median_chroma_errors, label='Chroma', color='r')
-
-            if len(all_sf_errors):
-                for sf_errors in all_sf_errors:
-                    ax.plot(times, sf_errors, color='g', alpha=0.3)
-                ax.plot(times, median_sf_errors, label='Spectral Flux', color='g')
-
-            if len(all_cf_errors):
-                for cf_errors in all_cf_errors:
-                    ax.plot(times, cf_errors, color='b', alpha=0.3)
-                ax.plot(times, median_cf_errors, label='Crest Factor', color='b')
-
-            plt.plot(times, total, label='Overall', color='k', linewidth=5)
-
-            for offset in offsets:
-                alpha = 1 if offset == offset_ms else 0.2
-                ax.axvline(x=offset, color='r', alpha=alpha, linestyle='--')
-            ax.legend()
-                
-    except Exception as e:
-        raise
-        print("Could not sync audio", e)
-        offset_ms = 0
+        return features
 
-    return int(offset_ms)
+    # Coarsest hop lengths first
+    order = sorted(range(len(hop_lengths)), key=lambda i: -hop_lengths[i])
+    if early_exit:
+        groups = [order[:EARLY_EXIT_HOPS], order[EARLY_EXIT_HOPS:]]
+    else:
+        groups = [order]
+
+    coarse_offsets = []
+    if search == 'coarse_to_fine':
+        # Scan the whole window at the coarsest hop length only, then
+        # narrow the window down to bands around the candidates it finds
+        coarsest = order[0]
+        ensure_features([coarsest])
+        coarse_errors = calc_hop_errors(hop_features(coarsest),
+                                        times,
+                                        hop_lengths[coarsest],
+                                        weights)
+        # With a single hop length there is nothing to fuse, so skip the
+        # smoothing and just sum the features
+        coarse_total = sum_errors(coarse_errors)
+        coarse_times = times
+        coarse_offsets = pick_offsets(times, coarse_total)
+
+        if len(coarse_offsets):
+            band = np.zeros(len(times), dtype=bool)
+            for offset in coarse_offsets:
+                band |= np.abs(times - offset) <= COARSE_TO_FINE_BAND_MS
+            times = times[band]
+        else:
+            print("No coarse candidates, falling back to exhaustive search")
+
+    hop_errors = {}
+    exited_early = False
+    for group in groups:
+        ensure_features(group)
+        for i in group:
+            hop_errors[i] = calc_hop_errors(hop_features(i), times,
+                                            hop_lengths[i], weights)
+
+        if group is not groups[-1] and coarse_hops_agree(times, [hop_errors[i] for i in group]):
+            exited_early = True
+            break
+
+    used = sorted(hop_errors)
+    all_errors, fused, total = fuse_errors([hop_errors[i] for i in used], times)
+
+    if len(coarse_offsets):
+        # Refine each coarse candidate to the lowest overall error
+        # within its band, keeping the order the coarse scan found them
+        offsets = []
+        for offset in coarse_offsets:
+            in_band = np.flatnonzero(np.abs(times - offset) <= COARSE_TO_FINE_BAND_MS)
+            offsets.append(times[in_band[np.argmin(total[in_band])]])
+        offsets = np.array(offsets)
+    else:
+        offsets = pick_offsets(times, total)
 
+    if len(offsets) > 0:
+        offset_ms = offsets[0]
+    else:
+        offset_ms = 0
 
+    if len(coarse_offsets):
+        # The fine curves only cover the bands, so judge the offset by the
+        # coarse candidate it was refined from over the whole window
+        prominence, margin, confidence = calc_confidence(coarse_times, coarse_total,
+                                                         coarse_offsets, coarse_offsets[0])
+    else:
+        prominence, margin, confidence = calc_confidence(times, total, offsets, offset_ms)
+
+    # Everything needed to plot how the offset was chosen
+    return {'offset': int(offset_ms),
+            'confidence': confidence,
+            'prominence': prominence,
+            'margin': margin,
+            'offsets': [int(offset) for offset in offsets],
+            'hop_lengths': [hop_lengths[i] for i in used],
+            'early_exit': exited_early,
+            'times': times.tolist(),
+            'curves': {name: curves.tolist()
+                       for name, curves in all_errors.items()},
+            'fused': {name: curve.tolist()
+                      for name, curve in fused.items()},
+            'total': total.tolist()}
+
+
+def gen_missing_features(signals, names, executor=None):
+    """
+    Add the features for any of the hop lengths that are missing, for each
+    of the signals
+
+    :param signals: list of (features or None, s, sr, hop_lengths)
+    :param names: features to calculate, from FEATURE_NAMES
+    :param executor: optional ProcessPoolExecutor to calculate them in
+    :return: list of features, as from gen_multi_hop_features
+    """
+    missing = {}
+    for i, (features, s, sr, hop_lengths) in enumerate(signals):
+        hops = sorted(h for h in hop_lengths if features is None or h not in features)
+        if hops:
+            missing[i] = (s, sr, hops)
+
+    if executor is not None:
+        # Every signal, and each feature of them, at the same time
+        computed = gen_multi_hop_features_parallel(executor, list(missing.values()),
+                                                   names=names)
+    else:
+        computed = [gen_multi_hop_features(s, sr, hops, names=names)
+                    for s, sr, hops in missing.values()]
+    computed = dict(zip(missing, computed))
+
+    results = []
+    for i, (features, s, sr, hop_lengths) in enumerate(signals):
+        features = dict(features or {})
+        features.update(computed.get(i, {}))
+        results.append(features)
+    return results
+
+
+def sum_errors(errors):
+    # Sum a hop length's feature error curves, leaving out any that failed
+    return np.sum(np.stack([e for e in errors.values() if np.isfinite(e).all()]), axis=0)
+
+
+def coarse_hops_agree(times, hop_errors):
+    """
+    Whether the coarse hop lengths are enough on their own: each picks an
+    offset within EARLY_EXIT_AGREE_MS of the others, and their fused error
+    has a peak at least EARLY_EXIT_PROMINENCE prominent.
+
+    :param times: candidate offsets in ms
+    :param hop_errors: list of dicts from calc_hop_errors
+    :rtype: bool
+    """
+    picked = [times[np.argmin(sum_errors(errors))] for errors in hop_errors]
+    if max(picked) - min(picked) > EARLY_EXIT_AGREE_MS:
+        return False
+
+    _, _, total = fuse_errors(hop_errors, times)
+    best = int(np.argmin(total))
+    return calc_peak_prominence(-total, best) >= EARLY_EXIT_PROMINENCE
+
+
+def calc_confidence(times, total, offsets, offset_ms):
+    """
+    How far the chosen offset stands out in the overall error curve
+
+    :param times: candidate offsets in ms
+    :param total: overall error for each of times
+    :param offsets: candidate offsets, best first
+    :param offset_ms: the chosen offset
+    :return: the prominence of the chosen offset's peak, the margin its error
+             beats the next candidate's by (the prominence if there is no
+             other), and a confidence from 0 to 1 scaling the smaller of
+             them between CONFIDENCE_LOW and CONFIDENCE_HIGH
+    :rtype: (float, float, float)
+    """
+    if not len(offsets):
+        return 0.0, 0.0, 0.0
+
+    best = int(np.argmin(np.abs(times - offset_ms)))
+    prominence = calc_peak_prominence(-total, best)
+
+    others = [int(np.argmin(np.abs(times - offset))) for offset in offsets[1:]]
+    if others:
+        margin = float(min(total[i] for i in others) - total[best])
+    else:
+        margin = prominence
+
+    confidence = (min(prominence, margin) - CONFIDENCE_LOW) / (CONFIDENCE_HIGH - CONFIDENCE_LOW)
+    return prominence, margin, float(np.clip(confidence, 0, 1))
+
+
+def calc_envelope(s, sr, frame_seconds=ENVELOPE_SECONDS):
+    # Energy of non-overlapping frames, in dB relative to the loudest
+    frame_length = max(1, int(frame_seconds * sr))
+    n_frames = len(s) // frame_length
+    frames = np.asarray(s[:n_frames * frame_length]).reshape(n_frames, frame_length)
+    energy = np.mean(np.square(frames, dtype=np.float32), axis=1)
+    return 10 * np.log10(np.maximum(energy, 1e-10) / max(energy.max(initial=0), 1e-10))
+
+
+def select_window(s, sr, length_seconds, silence_db=-40, onset_db=3):
+    """
+    Pick the most informative window of a signal from its energy envelope,
+    the one with the most onsets that is least silent.
+
+    :param s: mono signal
+    :param sr: sample rate of the signal
+    :param length_seconds: length of the window in seconds
+    :param silence_db: envelope frames quieter than this, relative to the
+                       loudest, count as silent
+    :param onset_db: a rise of more than this from one envelope frame to
+                     the next counts as an onset
+    :return: start of the window in seconds
+    """
+    envelope = calc_envelope(s, sr)
+    n = int(round(length_seconds / ENVELOPE_SECONDS))
+    if len(envelope) <= n:
+        return 0.0
+
+    silent = envelope < silence_db
+    onsets = np.diff(envelope, prepend=envelope[0]) > onset_db
+
+    def window_sums(x):
+        c = np.concatenate([[0], np.cumsum(x)])
+        return c[n:] - c[:-n]
+
+    score = window_sums(onsets) * (1 - window_sums(silent) / n)
+    return float(np.argmax(score) * ENVELOPE_SECONDS)
+
+
+def calc_alignment_windowed(s0, sr0, s1, sr1,
+                            window_seconds=WINDOW_SECONDS,
+                            min_prominence=WINDOW_MIN_PROMINENCE,
+                            features0=None,
+                            executor=None,
+                            **kwargs):
+    """
+    calc_alignment over the most informative window of the part, rather
+    than all of it. The window doubles in length, until it covers the whole
+    part, while the chosen offset is less prominent than min_prominence.
+
+    :param s0: reference signal, or None if features0 is given
+    :param s1: part signal
+    :param window_seconds: length of the first window tried
+    :param min_prominence: prominence of the chosen offset in the overall
+                           error curve that is accepted
+    :param features0: reference features from gen_multi_hop_features
+    :param executor: optional ProcessPoolExecutor to calculate features in
+    :param kwargs: weights, search and early_exit for calc_alignment
+    :return: result as from calc_alignment, plus the 'window' used as
+             [start, length] in seconds
+    :rtype: dict
+    """
+    names = active_features(kwargs)
+    if not names:
+        return calc_alignment(None, sr0, None, sr1, **kwargs)
+
+    hops0 = [numseconds_to_numsamples(h / SAMPLE_RATE, sr0) for h in HOP_LENGTHS]
+    hops1 = [numseconds_to_numsamples(h / SAMPLE_RATE, sr1) for h in HOP_LENGTHS]
+
+    def window_features(s, sr, hop_lengths):
+        if executor is not None:
+            return gen_multi_hop_features_parallel(executor, [(s, sr, hop_lengths)],
+                                                   names=names)[0]
+        return gen_multi_hop_features(s, sr, hop_lengths, names=names)
+
+    if features0 is None:
+        features0 = window_features(s0, sr0, hops0)
+
+    # Windows start on a multiple of the coarsest hop, so the part's frames
+    # line up with the reference's frames at every hop length
+    align = max(hops1)
+
+    length_seconds = window_seconds
+    while True:
+        start_seconds = select_window(s1, sr1, length_seconds)
+        start = int(start_seconds * sr1) // align * align
+        end = start + int(length_seconds * sr1)
+
+        window1 = window_features(s1[start:end], sr1, hops1)
+        window0 = {}
+        for h0, h1 in zip(hops0, hops1):
+            first = int(round(start / sr1 * sr0 / h0))
+            n_frames = next(x.shape[-1] for x in window1[h1] if x is not None)
+            window0[h0] = tuple(None if x is None else x[..., first:first + n_frames]
+                                for x in features0[h0])
+
+        result = calc_alignment(None, sr0, None, sr1,
+                                features0=window0,
+                                features1=window1,
+                                **kwargs)
+
+        print(f"Window {start / sr1:.1f}s +{length_seconds}s: "
+              f"offset {result['offset']} prominence {result['prominence']:.2f}")
+
+        if result['prominence'] >= min_prominence or end >= len(s1):
+            break
+        length_seconds *= 2
+
+    result['window'] = [start / sr1, (min(end, len(s1)) - start) / sr1]
+
+    return result
+
+
+def find_landmark_peaks(s, sr):
+    """
+    Find the strongest local maxima of the log magnitude spectrogram, at
+    most LANDMARK_PEAKS_PER_SECOND in each second.
+
+    :return: frequency bins and frames of the peaks, sorted by frame, and
+             the hop length in samples
+    """
+    n_fft = numseconds_to_numsamples(LANDMARK_N_FFT_SECONDS, sr)
+    hop_length = numseconds_to_numsamples(LANDMARK_HOP_LENGTH / SAMPLE_RATE, sr)
+
+    spec = np.log1p(np.abs(librosa.stft(np.asarray(s), n_fft=n_fft, hop_length=hop_length)))
+    spec = spec[:LANDMARK_MAX_BIN + 1]
+
+    is_peak = scipy.ndimage.maximum_filter(spec, size=LANDMARK_PEAK_SIZE) == spec
+    is_peak &= spec > spec.mean()
+    bins, frames = np.nonzero(is_peak)
+    strength = spec[bins, frames]
+
+    # Rank the peaks within each second by strength, and keep the strongest
+    frames_per_second = max(1, int(round(sr / hop_length)))
+    second = frames // frames_per_second
+    order = np.lexsort((-strength, second))
+    second = second[order]
+    starts = np.flatnonzero(np.diff(second, prepend=-1))
+    rank = np.arange(len(order)) - np.repeat(starts, np.diff(np.append(starts, len(order))))
+    keep = order[rank < LANDMARK_PEAKS_PER_SECOND]
+
+    keep = keep[np.lexsort((bins[keep], frames[keep]))]
+    return bins[keep], frames[keep], hop_length
+
+
+def build_landmark_index(s, sr):
+    """
+    Build a landmark fingerprint index of a signal. Each peak is paired with
+    up to LANDMARK_FAN_OUT later peaks near it, and each pair hashed from
+    the first peak's frequency, the difference in frequency and the
+    difference in time, which do not change when the signal is shifted.
+
+    :param s: mono signal
+    :param sr: sample rate of the signal
+    :return: dict with the sorted 'hashes', the frame of the first peak of
+             each as 'frames', and the 'hop_length' and 'sr'
+    """
+    key = ('landmarks', fingerprint(s), sr)
+    index = feature_cache.get(key)
+    if index is not None:
+        return index
+
+    bins, frames, hop_length = find_landmark_peaks(s, sr)
+
+    hashes = []
+    anchor_frames = []
+    paired = np.zeros(len(frames), dtype=int)
+    # Peaks are sorted by frame, so the targets of a peak are among the
+    # next few peaks. Take the first LANDMARK_FAN_OUT that are close enough.
+    for k in range(1, 3 * LANDMARK_FAN_OUT + 1):
+        f1, t1 = bins[:-k], frames[:-k]
+        f2, t2 = bins[k:], frames[k:]
+        dt = t2 - t1
+        df = f2 - f1
+        ok = (dt > 0) & (dt <= LANDMARK_MAX_DT) & (np.abs(df) <= LANDMARK_MAX_DF)
+        ok &= paired[:-k] < LANDMARK_FAN_OUT
+        paired[:-k] += ok
+
+        hashes.append((f1[ok] << 14) | ((df[ok] + 128) << 6) | dt[ok])
+        anchor_frames.append(t1[ok])
+
+    hashes = np.concatenate(hashes).astype(np.uint32)
+    anchor_frames = np.concatenate(anchor_frames).astype(np.int32)
+    order = np.argsort(hashes, kind='stable')
+
+    index = {'hashes': hashes[order],
+             'frames': anchor_frames[order],
+             'hop_length': np.int64(hop_length),
+             'sr': np.int64(sr)}
+
+    feature_cache.put(key, index)
+
+    return index
+
+
+def calc_alignment_landmarks(s0, sr0, s1, sr1, landmarks0=None):
+    """
+    Find the offset of s1 behind s0 by landmark fingerprinting. Every
+    landmark of s1 is looked up in the index of s0, and each match votes for
+    the offset between them. The offset with most votes wins.
+
+    The margin is the number of votes the winning offset has over the next
+    best offset more than a frame away, and the confidence scales it
+    between LANDMARK_CONFIDENCE_LOW and LANDMARK_CONFIDENCE_HIGH.
+
+    :param s0: reference signal, or None if landmarks0 is given
+    :param s1: part signal
+    :param landmarks0: index of the reference from build_landmark_index
+    :return: result as from calc_alignment, with the votes for each offset
+    :rtype: dict
+    """
+    if landmarks0 is None:
+        landmarks0 = build_landmark_index(s0, sr0)
+    landmarks1 = build_landmark_index(s1, sr1)
+
+    hashes0 = landmarks0['hashes']
+    hashes1 = landmarks1['hashes']
+    first = np.searchsorted(hashes0, hashes1, side='left')
+    counts = np.searchsorted(hashes0, hashes1, side='right') - first
+
+    # Expand to every (part landmark, reference landmark) match
+    part_index = np.repeat(np.arange(len(hashes1)), counts)
+    match_starts = np.repeat(first - (np.cumsum(counts) - counts), counts)
+    reference_index = np.arange(counts.sum()) + match_starts
+    deltas = landmarks1['frames'][part_index] - landmarks0['frames'][reference_index]
+
+    # Only offsets in the same window as calc_alignment searches get a vote
+    frame_ms = 1000 * int(landmarks1['hop_length']) / int(landmarks1['sr'])
+    lowest = int(np.floor(-100 / frame_ms))
+    highest = int(np.ceil(600 / frame_ms))
+    deltas = deltas[(deltas >= lowest) & (deltas < highest)]
+    votes = np.bincount(deltas - lowest, minlength=highest - lowest)
+
+    if votes.sum() == 0:
+        print("No landmarks matched, so cannot sync audio")
+        offset_ms = 0
+        margin = 0
+        confidence = 0.0
+    else:
+        best = int(np.argmax(votes))
+        offset_ms = (best + lowest) * frame_ms
+        others = votes.copy()
+        others[max(0, best - 1):best + 2] = 0
+        margin = int(votes[best] - others.max())
+        confidence = np.clip((margin - LANDMARK_CONFIDENCE_LOW) /
+                             (LANDMARK_CONFIDENCE_HIGH - LANDMARK_CONFIDENCE_LOW), 0, 1)
+
+    return {'offset': int(offset_ms),
+            'confidence': float(confidence),
+            'prominence': float(margin),
+            'margin': float(margin),
+            'offsets': [int(offset_ms)] if votes.sum() else [],
+            'engine': 'landmarks',
+            'vote_times': ((np.arange(len(votes)) + lowest) * frame_ms).tolist(),
+            'votes': votes.tolist(),
+            'matches': int(counts.sum())}
@@ -1,3 +1,15 @@
 from .signed_urls import create_signed_url
 from .mqtt_status import mqtt_status
 from .cos_client import create_cos_client
+from .blob_store import LocalBlobStore, COSBlobStore
+from .feature_store import FeatureStore
+from .result_store import ResultStore
+from .array_cache import ArrayLRUCache, fingerprint
+from .audio_stream import load_audio, stream_audio, audio_blocks
+from .cpu_quota import available_cpus
+from .api_client import APIClient, create_api_client
+from .audio_analysis import VolumeDetector, LoudnessMeter, AudioAnalyser, pcm_blocks
+from .audio_analysis import analyse_pcm, analyse_audio, audio_format, calc_volume_gain
+from .part_metadata import PartMetadata, create_part_metadata, part_volume
+from .codec_profiles import CodecProfile, CODEC_PROFILES
+from .codec_profiles import register_codec_profile, get_codec_profile
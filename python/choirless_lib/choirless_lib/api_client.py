@@ -0,0 +1,204 @@
+import threading
+import time
+from urllib.parse import urljoin
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# (connect, read) timeouts in seconds, so a slow API can never stall an action
+API_TIMEOUT = (3.05, 10)
+API_RETRIES = 3
+API_BACKOFF_FACTOR = 0.5
+API_POOL_SIZE = 8
+
+# How long the parts of a song are cached for in a warm container
+SONGPARTS_TTL = 60
+
+# Clients kept for the life of a warm container, by (api_url, api_key)
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class APIClient:
+    """
+    Client for the Choirless API.
+
+    Requests share one pooled session, so warm containers reuse their
+    connections, and have strict timeouts. Failed connections, and 429 and
+    5xx responses, are retried with exponential backoff, but only for
+    requests that are safe to repeat. Updating a song part sets its fields,
+    so is retried, while posting a render status creates a render record
+    each time, so is made once.
+    """
+
+    def __init__(self, api_url, api_key, timeout=API_TIMEOUT,
+                 retries=API_RETRIES, backoff_factor=API_BACKOFF_FACTOR,
+                 pool_size=API_POOL_SIZE, songparts_ttl=SONGPARTS_TTL):
+        """
+        :param api_url: base URL of the API
+        :type api_url: str
+        :param api_key: API key
+        :type api_key: str
+        :param timeout: (connect, read) timeouts in seconds
+        :type timeout: tuple
+        :param retries: number of times to retry a failed request
+        :type retries: int
+        :param backoff_factor: backoff between retries, doubling each time
+        :type backoff_factor: float
+        :param pool_size: connections to keep open
+        :type pool_size: int
+        :param songparts_ttl: seconds to cache the parts of a song for
+        :type songparts_ttl: float
+        """
+        self.api_url = api_url
+        self.api_key = api_key
+        self.timeout = timeout
+        self.songparts_ttl = songparts_ttl
+
+        retry = Retry(total=retries,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset(['GET', 'POST']),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # For requests that mustn't be repeated
+        once_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                                   max_retries=0)
+        self.once_session = requests.Session()
+        self.once_session.mount('http://', once_adapter)
+        self.once_session.mount('https://', once_adapter)
+
+        self._songparts = {}
+        self._lock = threading.Lock()
+
+    def request(self, method, path, retry=True, **kwargs):
+        """
+        Make a request to the API, raising for any error response
+
+        :param method: HTTP method
+        :type method: str
+        :param path: path relative to the API URL, e.g. 'choir/songparts'
+        :type path: str
+        :param retry: whether the request is safe to retry
+        :type retry: bool
+        :return: the response
+        :rtype: requests.Response
+        """
+        session = self.session if retry else self.once_session
+        params = dict(kwargs.pop('params', {}), apikey=self.api_key)
+        resp = session.request(method, urljoin(self.api_url, path),
+                               params=params, timeout=self.timeout,
+                               **kwargs)
+        resp.raise_for_status()
+        return resp
+
+    def get_songparts(self, choir_id, song_id):
+        """
+        Get the parts of a song, from the cache if fetched in the last
+        songparts_ttl seconds
+
+        :param choir_id: choir id
+        :type choir_id: str
+        :param song_id: song id
+        :type song_id: str
+        :return: the parts
+        :rtype: list
+        """
+        key = (choir_id, song_id)
+        now = time.monotonic()
+
+        with self._lock:
+            cached = self._songparts.get(key)
+        if cached and cached[0] > now:
+            return cached[1]
+
+        resp = self.request('GET', 'choir/songparts',
+                            params={'choirId': choir_id, 'songId': song_id})
+        parts = resp.json()['parts']
+
+        with self._lock:
+            self._songparts[key] = (now + self.songparts_ttl, parts)
+            # Drop anything expired so a long lived container doesn't grow
+            for k in [k for k, v in self._songparts.items() if v[0] <= now]:
+                del self._songparts[k]
+
+        return parts
+
+    def post_songpart(self, choir_id, song_id, part_id, **fields):
+        """
+        Update fields of a song part, e.g. its offset
+
+        :param choir_id: choir id
+        :type choir_id: str
+        :param song_id: song id
+        :type song_id: str
+        :param part_id: part id
+        :type part_id: str
+        :return: the response
+        :rtype: requests.Response
+        """
+        payload = dict(fields, choirId=choir_id, songId=song_id, partId=part_id)
+        resp = self.request('POST', 'choir/songpart', json=payload)
+
+        # The cached parts of this song are now out of date
+        with self._lock:
+            self._songparts.pop((choir_id, song_id), None)
+
+        return resp
+
+    def post_render(self, choir_id, song_id, part_id, status):
+        """
+        Set the render status of a song. Each call creates a render record,
+        so it is not retried
+
+        :param choir_id: choir id
+        :type choir_id: str
+        :param song_id: song id
+        :type song_id: str
+        :param part_id: part id
+        :type part_id: str
+        :param status: render status, e.g. 'new'
+        :type status: str
+        :return: the response
+        :rtype: requests.Response
+        """
+        payload = {'choirId': choir_id,
+                   'songId': song_id,
+                   'partId': part_id,
+                   'status': status}
+        return self.request('POST', 'render', json=payload, retry=False)
+
+
+def create_api_client(args):
+    """
+    Get an APIClient using the connectivity information contained in
+    args. The same client is returned for the same API URL and key for
+    the life of the container, so its connections and cache survive
+    between warm invocations.
+
+    :param args: action parameters
+    :type args: dict
+    :return: An APIClient
+    :rtype: APIClient
+    :raises ValueError: if the API is not configured
+    """
+    api_url = args.get('CHOIRLESS_API_URL')
+    api_key = args.get('CHOIRLESS_API_KEY')
+
+    if not api_url:
+        raise ValueError("could not create API client")
+
+    with _clients_lock:
+        client = _clients.get((api_url, api_key))
+        if client is None:
+            client = APIClient(api_url, api_key)
+            _clients[(api_url, api_key)] = client
+
+    return client
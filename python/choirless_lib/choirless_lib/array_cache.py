@@ -0,0 +1,127 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def fingerprint(a):
+    """
+    A key for a NumPy array, made from its shape, dtype and a digest of all
+    of its contents, so arrays differing anywhere get different keys. The
+    array is hashed in place if it is contiguous, so is not copied.
+
+    :param a: the array
+    :type a: np.ndarray
+    :return: hex digest
+    :rtype: str
+    """
+    a = np.ascontiguousarray(a)
+
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f'{a.shape}{a.dtype.str}'.encode('utf-8'))
+    h.update(memoryview(a).cast('B'))
+    return h.hexdigest()
+
+
+def nbytes(value):
+    # Size of all the arrays held in a (possibly nested) value
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(nbytes(v) for v in value)
+    return 0
+
+
+class ArrayLRUCache:
+    """
+    Least recently used cache of NumPy arrays (or tuples, lists and dicts of
+    them), bounded by the total number of bytes held rather than the number
+    of entries.
+    """
+
+    def __init__(self, max_bytes):
+        """
+        :param max_bytes: byte budget, least recently used entries are
+                          evicted to stay within it
+        :type max_bytes: int
+        """
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Get a value from the cache.
+
+        :param key: the key
+        :return: the cached value, or None if not present
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value):
+        """
+        Put a value into the cache. Values larger than the whole budget
+        are not cached.
+
+        :param key: the key
+        :param value: the value
+        """
+        size = nbytes(value)
+        with self._lock:
+            if key in self._entries:
+                self.bytes -= self._entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self.bytes += size
+            self._evict()
+
+    def resize(self, max_bytes):
+        """
+        Change the byte budget, evicting entries if needed.
+
+        :param max_bytes: the new byte budget
+        :type max_bytes: int
+        """
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """
+        Counters for logging.
+
+        :return: hits, misses, evictions, entries, bytes and max_bytes
+        :rtype: dict
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._entries),
+                    'bytes': self.bytes,
+                    'max_bytes': self.max_bytes}
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and self._entries:
+            _, (_, size) = self._entries.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
@@ -0,0 +1,371 @@
+import math
+
+import ffmpeg
+import numpy as np
+from scipy.signal import sosfilt
+
+from .audio_stream import read_into
+
+# Quietest level volumedetect reports, a 16 bit sample of 0
+MAX_DB = 91
+
+# EBU R128 gating, in LUFS and LU
+ABSOLUTE_GATE = -70
+RELATIVE_GATE = -10
+# Resolution and top of the histogram the gating blocks are kept in
+LOUDNESS_BIN_WIDTH = 0.01
+MAX_LOUDNESS = 5
+
+
+class VolumeDetector:
+    """
+    In-process equivalent of ffmpeg's volumedetect filter.
+
+    Samples are added a block at a time, so it can sit on the end of an
+    ffmpeg pipe and memory stays flat however long the audio is. As with
+    volumedetect, samples are measured as 16 bit PCM and every channel
+    counts.
+    """
+
+    def __init__(self):
+        self.counts = np.zeros(0x10000, dtype=np.int64)
+
+    def add(self, samples):
+        """
+        Add a block of samples.
+
+        :param samples: float samples in [-1, 1], of any shape
+        :type samples: np.ndarray
+        """
+        pcm = np.clip(np.rint(np.ravel(samples) * 0x8000), -0x8000, 0x7FFF)
+        self.counts += np.bincount(pcm.astype(np.int64) + 0x8000,
+                                   minlength=0x10000)
+
+    def stats(self):
+        """
+        The statistics volumedetect would log.
+
+        :return: dict of n_samples, mean_volume and max_volume in dB, and
+                 histogram of the number of samples at each dB below full
+                 scale, for the loudest levels making up at least 0.1% of
+                 the samples
+        :rtype: dict
+        """
+        n_samples = int(self.counts.sum())
+        if n_samples == 0:
+            return {'n_samples': 0, 'mean_volume': None, 'max_volume': None,
+                    'histogram': {}}
+
+        values = np.arange(-0x8000, 0x8000, dtype=np.float64)
+        power = values ** 2
+        present = self.counts > 0
+
+        # dB below full scale of each sample value, truncated as ffmpeg does
+        with np.errstate(divide='ignore'):
+            levels = -10 * np.log10(power / 0x40000000)
+        levels = np.where(power > 0, np.minimum(levels, MAX_DB), MAX_DB).astype(int)
+        levels_db = np.bincount(levels[present], weights=self.counts[present],
+                                minlength=MAX_DB + 1).astype(np.int64)
+
+        mean_power = (power * self.counts).sum() / n_samples
+        max_power = power[present].max()
+
+        histogram = {}
+        total = 0
+        for level in np.flatnonzero(levels_db):
+            if total >= n_samples // 1000:
+                break
+            histogram[int(level)] = int(levels_db[level])
+            total += int(levels_db[level])
+
+        return {'n_samples': n_samples,
+                'mean_volume': to_db(mean_power),
+                'max_volume': to_db(max_power),
+                'histogram': histogram}
+
+
+class LoudnessMeter:
+    """
+    EBU R128 integrated loudness, as ITU-R BS.1770 defines it.
+
+    Samples are K-weighted a block at a time, carrying the filter state
+    between blocks. The mean square of each 100 ms segment is kept just
+    long enough to make the overlapping 400 ms gating blocks, and the
+    blocks are counted into a fine histogram of loudness instead of being
+    kept, so memory stays flat however long the audio is.
+    """
+
+    def __init__(self, sample_rate, channels):
+        """
+        :param sample_rate: sample rate of the audio
+        :type sample_rate: int
+        :param channels: number of channels, in the usual order for 5.1
+        :type channels: int
+        """
+        self.sos = k_weighting(sample_rate)
+        self.zi = np.zeros((self.sos.shape[0], 2, channels))
+        self.weights = channel_weights(channels)
+
+        self.segment_length = int(round(sample_rate * 0.1))
+        self.partial = np.empty(0)
+        self.segments = []
+
+        n_bins = int(round((MAX_LOUDNESS - ABSOLUTE_GATE) / LOUDNESS_BIN_WIDTH)) + 1
+        self.block_counts = np.zeros(n_bins, dtype=np.int64)
+        self.block_powers = np.zeros(n_bins)
+
+    def add(self, samples):
+        """
+        Add a block of samples.
+
+        :param samples: float samples of shape (frames, channels)
+        :type samples: np.ndarray
+        """
+        filtered, self.zi = sosfilt(self.sos, samples, axis=0, zi=self.zi)
+        power = np.concatenate([self.partial, (filtered ** 2) @ self.weights])
+
+        n_segments = len(power) // self.segment_length
+        segments = power[:n_segments * self.segment_length]
+        self.partial = power[n_segments * self.segment_length:]
+
+        # Every 100 ms ends a 400 ms block, overlapping the last by 75%
+        segments = np.concatenate([self.segments, segments.reshape(n_segments, self.segment_length)
+                                   .mean(axis=1)])
+        if len(segments) >= 4:
+            blocks = np.convolve(segments, np.ones(4) / 4, mode='valid')
+            self.add_blocks(blocks)
+        self.segments = segments[-3:]
+
+    def add_blocks(self, powers):
+        with np.errstate(divide='ignore'):
+            loudness = -0.691 + 10 * np.log10(powers)
+        gated = loudness >= ABSOLUTE_GATE
+        bins = np.minimum(((loudness[gated] - ABSOLUTE_GATE) / LOUDNESS_BIN_WIDTH).astype(int),
+                          len(self.block_counts) - 1)
+        np.add.at(self.block_counts, bins, 1)
+        np.add.at(self.block_powers, bins, powers[gated])
+
+    def integrated_loudness(self):
+        """
+        The integrated loudness of the audio so far.
+
+        :return: loudness in LUFS, or None if the audio is all below the
+                 absolute gate, e.g. silence
+        :rtype: float
+        """
+        n_blocks = self.block_counts.sum()
+        if n_blocks == 0:
+            return None
+
+        relative_gate = to_lufs(self.block_powers.sum() / n_blocks) + RELATIVE_GATE
+        first_bin = max(0, int((relative_gate - ABSOLUTE_GATE) / LOUDNESS_BIN_WIDTH))
+        n_blocks = self.block_counts[first_bin:].sum()
+        return round(to_lufs(self.block_powers[first_bin:].sum() / n_blocks), 1)
+
+
+class AudioAnalyser:
+    """
+    Volume statistics, as VolumeDetector gives them, and the EBU R128
+    integrated loudness of audio, added a block at a time.
+    """
+
+    def __init__(self, sample_rate, channels):
+        """
+        :param sample_rate: sample rate of the audio
+        :type sample_rate: int
+        :param channels: number of channels
+        :type channels: int
+        """
+        self.volume = VolumeDetector()
+        self.loudness = LoudnessMeter(sample_rate, channels)
+
+    def add(self, samples):
+        """
+        Add a block of samples.
+
+        :param samples: float samples of shape (frames, channels)
+        :type samples: np.ndarray
+        """
+        self.volume.add(samples)
+        self.loudness.add(samples)
+
+    def results(self):
+        """
+        :return: dict of n_samples, mean_volume and max_volume in dB,
+                 histogram as VolumeDetector gives it, and
+                 integrated_loudness in LUFS
+        :rtype: dict
+        """
+        return dict(self.volume.stats(),
+                    integrated_loudness=self.loudness.integrated_loudness())
+
+
+def k_weighting(sample_rate):
+    # The BS.1770 pre-filter and RLB high-pass as second order sections,
+    # designed for any sample rate as libebur128 does
+    f0 = 1681.974450955533
+    G = 3.999843853973347
+    Q = 0.7071752369554196
+    K = math.tan(math.pi * f0 / sample_rate)
+    Vh = 10 ** (G / 20)
+    Vb = Vh ** 0.4996667741545416
+    a0 = 1 + K / Q + K * K
+    shelf = [(Vh + Vb * K / Q + K * K) / a0,
+             2 * (K * K - Vh) / a0,
+             (Vh - Vb * K / Q + K * K) / a0,
+             1,
+             2 * (K * K - 1) / a0,
+             (1 - K / Q + K * K) / a0]
+
+    f0 = 38.13547087602444
+    Q = 0.5003270373238773
+    K = math.tan(math.pi * f0 / sample_rate)
+    a0 = 1 + K / Q + K * K
+    highpass = [1, -2, 1,
+                1,
+                2 * (K * K - 1) / a0,
+                (1 - K / Q + K * K) / a0]
+
+    return np.array([shelf, highpass])
+
+
+def channel_weights(channels):
+    # Surround channels count for more, and LFE not at all
+    if channels == 6:
+        return np.array([1, 1, 1, 0, 1.41, 1.41])
+    return np.ones(channels)
+
+
+def to_lufs(power):
+    return -0.691 + 10 * math.log10(power)
+
+
+def to_db(power):
+    if power <= 0:
+        return -float(MAX_DB)
+    return round(float(10 * np.log10(power / 0x40000000)), 1)
+
+
+def pcm_blocks(pipe, channels=1, block_frames=65536):
+    """
+    Read interleaved float32 PCM from a pipe, such as the stdout of an
+    ffmpeg process writing f32le, in fixed size blocks.
+
+    :param pipe: file object to read from
+    :param channels: number of interleaved channels
+    :type channels: int
+    :param block_frames: frames per block
+    :type block_frames: int
+    :return: generator of (frames, channels) float32 blocks
+    :rtype: generator
+    """
+    while True:
+        block = np.empty(block_frames * channels, dtype=np.float32)
+        n = read_into(pipe, block) // channels * channels
+        if n:
+            yield block[:n].reshape(-1, channels)
+        if n < len(block):
+            break
+
+
+def analyse_pcm(pipe, sample_rate, channels):
+    """
+    Analyse interleaved float32 PCM read from a pipe until it ends
+
+    :param pipe: file object to read from
+    :param sample_rate: sample rate of the PCM
+    :type sample_rate: int
+    :param channels: number of interleaved channels
+    :type channels: int
+    :return: results as AudioAnalyser gives them
+    :rtype: dict
+    """
+    analyser = AudioAnalyser(sample_rate, channels)
+    for block in pcm_blocks(pipe, channels):
+        analyser.add(block)
+    return analyser.results()
+
+
+def audio_format(probe):
+    """
+    Sample rate and channels of the first audio stream of media, which is
+    the one ffmpeg picks. Analysing the audio as it is, rather than
+    resampled or remixed, measures the samples volumedetect would.
+
+    :param probe: output of ffmpeg.probe for the media
+    :type probe: dict
+    :return: sample rate and channels, or None if there is no audio
+    :rtype: (int, int)
+    """
+    for stream in probe['streams']:
+        if stream['codec_type'] == 'audio':
+            return int(stream['sample_rate']), int(stream.get('channels', 1))
+    return None
+
+
+def analyse_audio(url, sample_rate=44100, channels=2):
+    """
+    Decode the audio at url and analyse it, without holding more than a
+    block of it in memory.
+
+    :param url: URL (e.g. a signed COS GET URL) or path of the media
+    :type url: str
+    :param sample_rate: sample rate to decode at
+    :type sample_rate: int
+    :param channels: number of channels to decode
+    :type channels: int
+    :return: results as AudioAnalyser gives them
+    :rtype: dict
+    """
+    stream = ffmpeg.input(url, seekable=0)
+    pipeline = ffmpeg.output(stream.audio,
+                             'pipe:',
+                             format='f32le',
+                             acodec='pcm_f32le',
+                             ac=channels,
+                             ar=sample_rate)
+    pipeline = pipeline.global_args('-nostdin', '-loglevel', 'error')
+
+    process = pipeline.run_async(pipe_stdout=True)
+    try:
+        results = analyse_pcm(process.stdout, sample_rate, channels)
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            process.terminate()
+        returncode = process.wait()
+
+    if results['n_samples'] == 0 or returncode != 0:
+        raise RuntimeError(f"ffmpeg could not decode audio, exit code {returncode}")
+
+    return results
+
+
+def calc_volume_gain(results, vol_threshold, vol_pct, target_peak):
+    """
+    Calculate the gain to normalise the peak volume to target_peak, and
+    whether the audio is so quiet it should be muted instead
+
+    :param results: results from analysing the audio
+    :type results: dict
+    :param vol_threshold: dB below full scale a sample counts as sound at
+    :type vol_threshold: int
+    :param vol_pct: fraction of the loudest samples that must be sound
+    :type vol_pct: float
+    :param target_peak: peak volume to normalise to in dB
+    :type target_peak: float
+    :return: the gain in dB and whether to mute
+    :rtype: (float, bool)
+    """
+    total_samples = sum(results['histogram'].values())
+    high_samples = sum(samples for level, samples in results['histogram'].items()
+                       if level < vol_threshold)
+
+    mute = False
+    if high_samples/total_samples < vol_pct:
+        print(f"Input volume is so low, we are muting it {high_samples/total_samples:.2f} above {vol_threshold}")
+        mute = True
+
+    volume_gain = target_peak - results['max_volume']
+
+    return volume_gain, mute
@@ -0,0 +1,137 @@
+import numpy as np
+
+import ffmpeg
+
+BYTES_PER_SAMPLE = 4
+
+
+def stream_audio(url, sample_rate=44100, offset=0, duration=None):
+    """
+    Start an ffmpeg process decoding the audio at url to mono float32 PCM
+    on its stdout.
+
+    :param url: URL (e.g. a signed COS GET URL) or path of the media
+    :type url: str
+    :param sample_rate: sample rate to decode at
+    :type sample_rate: int
+    :param offset: seconds into the media to start at
+    :type offset: float
+    :param duration: maximum number of seconds to decode
+    :type duration: float
+    :return: the running ffmpeg process
+    :rtype: subprocess.Popen
+    """
+    input_kwargs = {'seekable': 0}
+    if offset:
+        input_kwargs['ss'] = offset
+    if duration is not None:
+        input_kwargs['t'] = duration
+
+    stream = ffmpeg.input(url, **input_kwargs)
+    pipeline = ffmpeg.output(stream.audio,
+                             'pipe:',
+                             format='f32le',
+                             acodec='pcm_f32le',
+                             ac=1,
+                             ar=sample_rate)
+    pipeline = pipeline.global_args('-nostdin', '-loglevel', 'error')
+
+    return pipeline.run_async(pipe_stdout=True)
+
+
+def read_into(pipe, buf):
+    # Fill buf from pipe, returning the number of whole samples read
+    view = memoryview(buf).cast('B')
+    total = 0
+    while total < len(view):
+        n = pipe.readinto(view[total:])
+        if not n:
+            break
+        total += n
+    return total // BYTES_PER_SAMPLE
+
+
+def audio_blocks(url, sample_rate=44100, offset=0, duration=None,
+                 block_seconds=10):
+    """
+    Decode the audio at url in fixed size blocks, so only one block is ever
+    held in memory however long the media is.
+
+    :param url: URL (e.g. a signed COS GET URL) or path of the media
+    :type url: str
+    :param sample_rate: sample rate to decode at
+    :type sample_rate: int
+    :param offset: seconds into the media to start at
+    :type offset: float
+    :param duration: maximum number of seconds to decode
+    :type duration: float
+    :param block_seconds: size of the blocks
+    :type block_seconds: float
+    :return: generator of mono float32 blocks, all block_seconds long
+             apart from the last
+    :rtype: generator
+    """
+    process = stream_audio(url, sample_rate, offset=offset, duration=duration)
+
+    n_samples = 0
+    try:
+        while True:
+            block = np.empty(int(block_seconds * sample_rate), dtype=np.float32)
+            n = read_into(process.stdout, block)
+            n_samples += n
+            if n:
+                yield block[:n]
+            if n < len(block):
+                break
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            process.terminate()
+        returncode = process.wait()
+
+    if n_samples == 0 and returncode != 0:
+        raise RuntimeError(f"ffmpeg could not decode audio, exit code {returncode}")
+
+
+def load_audio(url, sample_rate=44100, offset=0, duration=None,
+               block_seconds=10):
+    """
+    Decode the audio at url straight into a NumPy array, without writing
+    the media to disk first.
+
+    When duration is given the samples are read into a single preallocated
+    buffer and ffmpeg is stopped as soon as it is full.
+
+    :param url: URL (e.g. a signed COS GET URL) or path of the media
+    :type url: str
+    :param sample_rate: sample rate to decode at
+    :type sample_rate: int
+    :param offset: seconds into the media to start at
+    :type offset: float
+    :param duration: maximum number of seconds to decode
+    :type duration: float
+    :param block_seconds: size of the blocks read when duration is not known
+    :type block_seconds: float
+    :return: the mono float32 signal and its sample rate
+    :rtype: (np.ndarray, int)
+    """
+    if duration is None:
+        blocks = list(audio_blocks(url, sample_rate, offset=offset,
+                                   block_seconds=block_seconds))
+        return np.concatenate(blocks or [np.empty(0, dtype=np.float32)]), sample_rate
+
+    process = stream_audio(url, sample_rate, offset=offset, duration=duration)
+
+    try:
+        signal = np.empty(int(duration * sample_rate), dtype=np.float32)
+        signal = signal[:read_into(process.stdout, signal)]
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            process.terminate()
+        returncode = process.wait()
+
+    if len(signal) == 0 and returncode != 0:
+        raise RuntimeError(f"ffmpeg could not decode audio, exit code {returncode}")
+
+    return signal, sample_rate
@@ -0,0 +1,85 @@
+from pathlib import Path
+
+from ibm_botocore.exceptions import ClientError
+
+
+class LocalBlobStore:
+    """
+    Store blobs as files in a local directory. Useful for testing
+    offline and for scripts such as tune_alignment.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def get(self, key):
+        """
+        Get a blob from the store.
+
+        :param key: the blob key
+        :type key: str
+        :return: the blob contents, or None if not present
+        :rtype: bytes
+        """
+        path = Path(self.path, key)
+        if not path.exists():
+            return None
+        return path.read_bytes()
+
+    def put(self, key, data):
+        """
+        Put a blob into the store, replacing any existing one.
+
+        :param key: the blob key
+        :type key: str
+        :param data: the blob contents
+        :type data: bytes
+        """
+        path = Path(self.path, key)
+        # Write to a temporary name first so readers never see a partial blob
+        tmp_path = path.with_name(f'{path.name}.tmp')
+        tmp_path.write_bytes(data)
+        tmp_path.replace(path)
+
+
+class COSBlobStore:
+    """
+    Store blobs as objects in a Cloud Object Storage bucket.
+    """
+
+    def __init__(self, cos, bucket, prefix=''):
+        self.cos = cos
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def get(self, key):
+        """
+        Get a blob from the store.
+
+        :param key: the blob key
+        :type key: str
+        :return: the blob contents, or None if not present
+        :rtype: bytes
+        """
+        try:
+            obj = self.cos.get_object(Bucket=self.bucket,
+                                      Key=f'{self.prefix}{key}')
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                return None
+            raise
+        return obj['Body'].read()
+
+    def put(self, key, data):
+        """
+        Put a blob into the store, replacing any existing one.
+
+        :param key: the blob key
+        :type key: str
+        :param data: the blob contents
+        :type data: bytes
+        """
+        self.cos.put_object(Bucket=self.bucket,
+                            Key=f'{self.prefix}{key}',
+                            Body=data)
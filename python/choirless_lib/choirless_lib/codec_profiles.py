@@ -0,0 +1,103 @@
+class CodecProfile:
+    """
+    Named output settings for the intermediate files passed between
+    stages. Which one a stage uses trades the bytes moved through COS
+    against the CPU spent encoding and decoding them, see
+    bench_codec_profiles.py.
+    """
+
+    def __init__(self, name, video, audio, format='nut', description=''):
+        """
+        :param name: name of the profile
+        :type name: str
+        :param video: ffmpeg output arguments for the video
+        :type video: dict
+        :param audio: ffmpeg output arguments for the audio
+        :type audio: dict
+        :param format: container format
+        :type format: str
+        :param description: what the profile is for
+        :type description: str
+        """
+        self.name = name
+        self.video = video
+        self.audio = audio
+        self.format = format
+        self.description = description
+
+    def output_args(self, video=True, audio=True):
+        """
+        The ffmpeg output arguments of the profile
+
+        :param video: include the arguments for the video
+        :type video: bool
+        :param audio: include the arguments for the audio
+        :type audio: bool
+        :return: arguments for ffmpeg.output
+        :rtype: dict
+        """
+        args = {'format': self.format}
+        if video:
+            args.update(self.video)
+        if audio:
+            args.update(self.audio)
+        return args
+
+    def __repr__(self):
+        return f'CodecProfile({self.name!r})'
+
+
+CODEC_PROFILES = {}
+
+
+def register_codec_profile(profile):
+    """
+    Add a profile to the registry, replacing any with the same name
+
+    :param profile: the profile
+    :type profile: CodecProfile
+    """
+    CODEC_PROFILES[profile.name] = profile
+
+
+def get_codec_profile(name):
+    """
+    Look up a profile in the registry
+
+    :param name: name of the profile
+    :type name: str
+    :return: the profile
+    :rtype: CodecProfile
+    """
+    try:
+        return CODEC_PROFILES[name]
+    except KeyError:
+        raise ValueError(f"Unknown codec profile: {name}, "
+                         f"expected one of {', '.join(sorted(CODEC_PROFILES))}")
+
+
+PCM_F32 = {'acodec': 'pcm_f32le'}
+PCM_S16 = {'acodec': 'pcm_s16le'}
+
+for profile in [
+        CodecProfile('h264_slow', {'vcodec': 'libx264', 'preset': 'slow'}, PCM_F32,
+                     description="small, slow to encode; converted parts"),
+        CodecProfile('h264', {'vcodec': 'libx264'}, PCM_F32,
+                     description="x264 defaults"),
+        CodecProfile('h264_veryfast', {'vcodec': 'libx264', 'preset': 'veryfast'}, PCM_F32,
+                     description="cheap to encode"),
+        CodecProfile('mpeg2_q1', {'vcodec': 'mpeg2video', 'pix_fmt': 'yuv420p',
+                                  'qscale': 1, 'qmin': 1}, PCM_S16,
+                     description="near lossless, fast, huge; composited rows and mixes"),
+        CodecProfile('mpeg2_q4', {'vcodec': 'mpeg2video', 'pix_fmt': 'yuv420p',
+                                  'qscale': 4}, PCM_S16,
+                     description="fast, a fraction of the size of mpeg2_q1"),
+        CodecProfile('mjpeg_q3', {'vcodec': 'mjpeg', 'pix_fmt': 'yuvj420p',
+                                  'qscale': 3}, PCM_S16,
+                     description="intra only, fast to encode and decode"),
+        CodecProfile('huffyuv', {'vcodec': 'huffyuv'}, PCM_S16,
+                     description="lossless, fastest, largest; scaled videos"),
+        CodecProfile('ffv1', {'vcodec': 'ffv1'}, PCM_S16,
+                     description="lossless, smaller and slower than huffyuv"),
+        ]:
+    register_codec_profile(profile)
@@ -0,0 +1,48 @@
+import math
+import os
+from pathlib import Path
+
+
+def read_cgroup_quota(cgroup_root='/sys/fs/cgroup'):
+    # cgroup v2 has "<quota> <period>" in cpu.max, with a quota of "max" if
+    # unlimited. cgroup v1 has the two in separate files, with a quota of -1.
+    try:
+        quota, period = Path(cgroup_root, 'cpu.max').read_text().split()[:2]
+        if quota == 'max':
+            return None
+        return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+
+    try:
+        quota = int(Path(cgroup_root, 'cpu', 'cpu.cfs_quota_us').read_text())
+        period = int(Path(cgroup_root, 'cpu', 'cpu.cfs_period_us').read_text())
+        if quota <= 0 or period <= 0:
+            return None
+        return quota / period
+    except (OSError, ValueError):
+        return None
+
+
+def available_cpus(cgroup_root='/sys/fs/cgroup'):
+    """
+    The number of CPUs this process can actually use. Containers, such as
+    actions, usually see every CPU of the host in os.cpu_count() but are
+    limited to a share of them by their cgroup CPU quota.
+
+    :param cgroup_root: where the cgroup filesystem is mounted
+    :type cgroup_root: str
+    :return: the number of CPUs, at least 1
+    :rtype: int
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+
+    quota = read_cgroup_quota(cgroup_root)
+    if quota is not None:
+        # A fractional quota still gets part of another CPU
+        cpus = min(cpus, math.ceil(quota))
+
+    return max(1, cpus)
@@ -0,0 +1,132 @@
+import hashlib
+import io
+import json
+from pathlib import Path
+
+import numpy as np
+
+
+class FeatureStore:
+    """
+    Content addressed store of per-track alignment features.
+
+    Features are kept as a compressed .npz blob next to the object they
+    were calculated from, keyed by the object's ETag and a digest of the
+    parameters used to calculate them, so a changed object or changed
+    parameters never pick up stale features.
+    """
+
+    def __init__(self, backend):
+        """
+        :param backend: a LocalBlobStore or COSBlobStore
+        """
+        self.backend = backend
+
+    def blob_key(self, object_key, etag, params):
+        etag = etag.strip('"')
+        digest = hashlib.sha1(json.dumps(params, sort_keys=True)
+                              .encode('utf-8')).hexdigest()[:12]
+        return f'{Path(object_key).stem}.features-{etag}-{digest}.npz'
+
+    def load(self, object_key, etag, params):
+        """
+        Load the features for an object.
+
+        :param object_key: key of the object the features were calculated from
+        :type object_key: str
+        :param etag: ETag of the object
+        :type etag: str
+        :param params: parameters the features were calculated with
+        :type params: dict
+        :return: dict of hop_length -> (sf, cf, chroma), with None for any
+                 feature that was not saved, or None if not stored
+        :rtype: dict
+        """
+        arrays = self.load_arrays(object_key, etag, params)
+        if arrays is None:
+            return None
+
+        features = {}
+        for hop_length in arrays['hop_lengths']:
+            features[int(hop_length)] = tuple(arrays[f'{name}_{hop_length}']
+                                              if f'{name}_{hop_length}' in arrays
+                                              else None
+                                              for name in ('sf', 'cf', 'chroma'))
+        return features
+
+    def save(self, object_key, etag, params, features):
+        """
+        Save the features for an object. Failures are logged but not raised
+        as the store is only an optimisation.
+
+        :param object_key: key of the object the features were calculated from
+        :type object_key: str
+        :param etag: ETag of the object
+        :type etag: str
+        :param params: parameters the features were calculated with
+        :type params: dict
+        :param features: dict of hop_length -> (sf, cf, chroma), with None
+                         for any feature not calculated
+        :type features: dict
+        """
+        arrays = {'hop_lengths': np.array(sorted(features))}
+        for hop_length, values in features.items():
+            for name, value in zip(('sf', 'cf', 'chroma'), values):
+                if value is not None:
+                    arrays[f'{name}_{hop_length}'] = value
+
+        self.save_arrays(object_key, etag, params, arrays)
+
+    def load_arrays(self, object_key, etag, params):
+        """
+        Load arrays saved by save_arrays for an object.
+
+        :param object_key: key of the object the arrays were calculated from
+        :type object_key: str
+        :param etag: ETag of the object
+        :type etag: str
+        :param params: parameters the arrays were calculated with
+        :type params: dict
+        :return: dict of name -> numpy.ndarray, or None if not stored
+        :rtype: dict
+        """
+        try:
+            data = self.backend.get(self.blob_key(object_key, etag, params))
+        except Exception as e:
+            print("Could not load features from store:", e)
+            return None
+
+        if data is None:
+            return None
+
+        # A truncated or corrupt blob is treated as missing, so the
+        # features are calculated again and the blob replaced
+        try:
+            with np.load(io.BytesIO(data)) as arrays:
+                return dict(arrays)
+        except Exception as e:
+            print("Could not read features from store:", e)
+            return None
+
+    def save_arrays(self, object_key, etag, params, arrays):
+        """
+        Save any named arrays calculated from an object, such as a
+        fingerprint index. Failures are logged but not raised.
+
+        :param object_key: key of the object the arrays were calculated from
+        :type object_key: str
+        :param etag: ETag of the object
+        :type etag: str
+        :param params: parameters the arrays were calculated with
+        :type params: dict
+        :param arrays: dict of name -> numpy.ndarray
+        :type arrays: dict
+        """
+        buf = io.BytesIO()
+        np.savez_compressed(buf, **arrays)
+
+        try:
+            self.backend.put(self.blob_key(object_key, etag, params),
+                             buf.getvalue())
+        except Exception as e:
+            print("Could not save features to store:", e)
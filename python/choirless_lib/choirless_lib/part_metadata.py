@@ -0,0 +1,102 @@
+import json
+from pathlib import Path
+
+from .blob_store import LocalBlobStore, COSBlobStore
+from .cos_client import create_cos_client
+
+
+# The stages that write metadata. Each writes only its own sidecar, so
+# stages finishing at the same time can't overwrite each other's fields
+OWNERS = ('convert_format', 'calculate_alignment')
+
+
+class PartMetadata:
+    """
+    Small JSON sidecars kept next to a converted part, holding adjustments
+    later stages should apply to it rather than each stage re-encoding the
+    part, e.g. the loudness gain convert_format measured.
+    """
+
+    def __init__(self, backend):
+        """
+        :param backend: a LocalBlobStore or COSBlobStore
+        """
+        self.backend = backend
+
+    def blob_key(self, part_key, owner=None):
+        # Without an owner, the single sidecar parts used to have
+        if owner is None:
+            return f'{Path(part_key).stem}.meta.json'
+        return f'{Path(part_key).stem}.meta-{owner}.json'
+
+    def load(self, part_key):
+        """
+        Load the metadata for a part, merged from every owner's sidecar.
+
+        :param part_key: key of the part
+        :type part_key: str
+        :return: the metadata, empty if there is none
+        :rtype: dict
+        """
+        metadata = {}
+        for owner in (None, *OWNERS):
+            data = self.backend.get(self.blob_key(part_key, owner))
+            if data is not None:
+                metadata.update(json.loads(data))
+        return metadata
+
+    def save(self, part_key, owner, metadata):
+        """
+        Save one owner's metadata for a part, replacing whatever that owner
+        saved before. Fields other owners saved are left alone.
+
+        :param part_key: key of the part
+        :type part_key: str
+        :param owner: the stage saving it, from OWNERS
+        :type owner: str
+        :param metadata: JSON serialisable metadata
+        :type metadata: dict
+        """
+        if owner not in OWNERS:
+            raise ValueError(f"Unknown part metadata owner: {owner}, "
+                             f"expected one of {', '.join(OWNERS)}")
+        self.backend.put(self.blob_key(part_key, owner),
+                         json.dumps(metadata).encode('utf-8'))
+
+
+def create_part_metadata(args, bucket):
+    """
+    Create a PartMetadata for the parts in bucket, or in a local directory
+    if args has a part_metadata_dir, e.g. for testing offline.
+
+    :param args: action parameters
+    :type args: dict
+    :param bucket: bucket of the parts
+    :type bucket: str
+    :return: A PartMetadata
+    :rtype: PartMetadata
+    """
+    if args.get('part_metadata_dir'):
+        return PartMetadata(LocalBlobStore(args['part_metadata_dir']))
+
+    cos = create_cos_client(args)
+    if not cos:
+        raise ValueError("could not create COS instance")
+    return PartMetadata(COSBlobStore(cos, bucket))
+
+
+def part_volume(metadata):
+    """
+    The argument for ffmpeg's volume filter that applies the gain stored in
+    a part's metadata, or None if there is nothing to apply.
+
+    :param metadata: metadata of the part
+    :type metadata: dict
+    :return: e.g. '-3.20dB', or 0 to mute
+    """
+    if metadata.get('mute'):
+        return 0
+    gain = metadata.get('volume_gain_db', 0)
+    if not gain:
+        return None
+    return f'{gain:.2f}dB'
@@ -0,0 +1,77 @@
+import hashlib
+import json
+from pathlib import Path
+
+
+class ResultStore:
+    """
+    Content addressed store of alignment results.
+
+    A result is keyed by the ETags of the reference and the part it was
+    calculated from, and a digest of the parameters used, so re-uploading
+    identical bytes or re-running an alignment finds the stored result,
+    while a changed object or changed parameters never do.
+    """
+
+    def __init__(self, backend):
+        """
+        :param backend: a LocalBlobStore or COSBlobStore
+        """
+        self.backend = backend
+
+    def blob_key(self, reference_etag, part_key, part_etag, params):
+        digest = hashlib.sha1(json.dumps([reference_etag.strip('"'),
+                                          part_etag.strip('"'),
+                                          params], sort_keys=True)
+                              .encode('utf-8')).hexdigest()
+        return f'{Path(part_key).stem}.alignment-{digest}.json'
+
+    def load(self, reference_etag, part_key, part_etag, params):
+        """
+        Load the result of aligning a part against a reference.
+
+        :param reference_etag: ETag of the reference
+        :type reference_etag: str
+        :param part_key: key of the part
+        :type part_key: str
+        :param part_etag: ETag of the part
+        :type part_etag: str
+        :param params: parameters the result was calculated with
+        :type params: dict
+        :return: the stored result, or None if not stored
+        :rtype: dict
+        """
+        try:
+            data = self.backend.get(self.blob_key(reference_etag, part_key,
+                                                  part_etag, params))
+        except Exception as e:
+            print("Could not load result from store:", e)
+            return None
+
+        if data is None:
+            return None
+
+        return json.loads(data)
+
+    def save(self, reference_etag, part_key, part_etag, params, result):
+        """
+        Save the result of aligning a part against a reference. Failures
+        are logged but not raised as the store is only an optimisation.
+
+        :param reference_etag: ETag of the reference
+        :type reference_etag: str
+        :param part_key: key of the part
+        :type part_key: str
+        :param part_etag: ETag of the part
+        :type part_etag: str
+        :param params: parameters the result was calculated with
+        :type params: dict
+        :param result: JSON serialisable result, e.g. {'offset': 120}
+        :type result: dict
+        """
+        try:
+            self.backend.put(self.blob_key(reference_etag, part_key,
+                                           part_etag, params),
+                             json.dumps(result).encode('utf-8'))
+        except Exception as e:
+            print("Could not save result to store:", e)
@@ -10,7 +10,7 @@ config = {
     'download_url': 'https://github.com/choirless/renderer',
     'author_email': 'mh@quernus.co.uk',
     'version': '0.1',
-    'install_requires': ['requests', 'paho-mqtt', 'ibm_cos_sdk'],
+    'install_requires': ['requests', 'paho-mqtt', 'ibm_cos_sdk', 'numpy', 'scipy', 'ffmpeg-python'],
     'packages': ['choirless_lib'],
     'scripts': [],
     'name': 'choirless_lib'
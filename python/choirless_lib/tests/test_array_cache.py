@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from choirless_lib import ArrayLRUCache, fingerprint
+
+
+def array(kb):
+    return np.zeros(kb * 1024 // 8)
+
+
+def test_evicts_least_recently_used():
+    cache = ArrayLRUCache(3 * 1024)
+    for key in 'abc':
+        cache.put(key, array(1))
+    cache.get('a')
+    cache.put('d', array(1))
+
+    # b was the least recently used once a was looked up
+    assert cache.get('b') is None
+    assert [cache.get(key) is not None for key in 'acd'] == [True, True, True]
+    assert cache.stats()['evictions'] == 1
+
+
+def test_stays_within_byte_budget():
+    cache = ArrayLRUCache(3 * 1024)
+    cache.put('a', array(1))
+    cache.put('b', (array(1), {'c': array(1)}))
+    assert cache.stats()['bytes'] == 3 * 1024
+
+    # Replacing an entry counts only its new size
+    cache.put('a', array(2))
+    assert cache.get('b') is None
+    assert cache.stats()['bytes'] == 2 * 1024
+
+    # Too big for the whole budget, so not cached and nothing evicted
+    cache.put('big', array(4))
+    assert cache.get('big') is None
+    assert cache.get('a') is not None
+
+    cache.resize(1024)
+    assert cache.get('a') is None
+    assert cache.stats()['bytes'] == 0
+
+
+def test_fingerprint_covers_every_element():
+    a = np.random.default_rng(0).standard_normal(100000).astype(np.float32)
+    b = a.copy()
+    b[12345] += 1
+    assert fingerprint(a) == fingerprint(a.copy())
+    assert fingerprint(a) != fingerprint(b)
+
+
+@pytest.mark.parametrize('other', [
+    lambda a: a[:-1],
+    lambda a: a.astype(np.float64),
+    lambda a: a.reshape(2, -1),
+])
+def test_fingerprint_covers_length_dtype_and_shape(other):
+    a = np.zeros(1000, dtype=np.float32)
+    assert fingerprint(a) != fingerprint(other(a))
+
+
+def test_fingerprint_of_a_view():
+    a = np.arange(24.0).reshape(4, 6)
+    assert fingerprint(a[:, ::2]) == fingerprint(a[:, ::2].copy())
+    assert fingerprint(a.T) != fingerprint(a)
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+from scipy.signal import sosfilt
+
+from choirless_lib import AudioAnalyser
+from choirless_lib.audio_analysis import k_weighting, channel_weights
+
+SAMPLE_RATE = 44100
+
+
+def bs1770_loudness(samples, sample_rate):
+    # Integrated loudness of the whole signal at once, straight from the
+    # recommendation: 400 ms blocks every 100 ms, absolute then relative gate
+    filtered = sosfilt(k_weighting(sample_rate), samples, axis=0)
+    power = (filtered ** 2) @ channel_weights(samples.shape[1])
+    block, step = int(0.4 * sample_rate), int(0.1 * sample_rate)
+    powers = np.array([power[i:i + block].mean()
+                       for i in range(0, len(power) - block + 1, step)])
+    loudness = -0.691 + 10 * np.log10(powers)
+    powers = powers[loudness >= -70]
+    relative_gate = -0.691 + 10 * np.log10(powers.mean()) - 10
+    powers = powers[-0.691 + 10 * np.log10(powers) >= relative_gate]
+    return -0.691 + 10 * np.log10(powers.mean())
+
+
+def test_k_weighting_matches_bs1770_at_48k():
+    # The coefficients the recommendation gives for 48 kHz
+    sos = k_weighting(48000)
+    np.testing.assert_allclose(sos[0], [1.53512485958697, -2.69169618940638, 1.19839281085285,
+                                        1, -1.69065929318241, 0.73248077421585], atol=1e-6)
+    np.testing.assert_allclose(sos[1], [1, -2, 1,
+                                        1, -1.99004745483398, 0.99007225036621], atol=1e-6)
+
+
+@pytest.mark.parametrize('channels', [1, 2, 6])
+@pytest.mark.parametrize('block_frames', [1000, 4410, 65536])
+def test_integrated_loudness_matches_bs1770(channels, block_frames):
+    rng = np.random.default_rng(channels)
+    duration = 12
+    t = np.arange(duration * SAMPLE_RATE) / SAMPLE_RATE
+    # Noise getting louder and quieter, with a quiet stretch for the
+    # relative gate to drop and a different level on each channel
+    envelope = 0.02 + 0.3 * np.abs(np.sin(2 * np.pi * t / 5))
+    envelope[3 * SAMPLE_RATE:4 * SAMPLE_RATE] = 0.001
+    levels = np.linspace(1, 0.4, channels)
+    samples = (rng.standard_normal((len(t), channels)) * 0.3
+               * envelope[:, None] * levels).astype(np.float32)
+
+    analyser = AudioAnalyser(SAMPLE_RATE, channels)
+    for i in range(0, len(samples), block_frames):
+        analyser.add(samples[i:i + block_frames])
+    results = analyser.results()
+
+    assert results['n_samples'] == samples.size
+    assert results['integrated_loudness'] == pytest.approx(
+        bs1770_loudness(samples.astype(np.float64), SAMPLE_RATE), abs=0.1)
+
+
+def test_silence_has_no_loudness():
+    analyser = AudioAnalyser(SAMPLE_RATE, 1)
+    analyser.add(np.zeros((SAMPLE_RATE, 1), dtype=np.float32))
+    assert analyser.results()['integrated_loudness'] is None
@@ -0,0 +1,60 @@
+import shutil
+
+import ffmpeg
+import pytest
+
+from choirless_lib import CodecProfile, CODEC_PROFILES, register_codec_profile, get_codec_profile
+
+
+@pytest.fixture
+def registry():
+    # Leave the built-in profiles as they were
+    saved = dict(CODEC_PROFILES)
+    yield CODEC_PROFILES
+    CODEC_PROFILES.clear()
+    CODEC_PROFILES.update(saved)
+
+
+def test_unknown_profile():
+    with pytest.raises(ValueError, match="Unknown codec profile: nope, expected one of .*h264_slow"):
+        get_codec_profile('nope')
+
+
+def test_register_replaces_same_name(registry):
+    register_codec_profile(CodecProfile('test', {'vcodec': 'mpeg2video'}, {'acodec': 'pcm_s16le'}))
+    profile = CodecProfile('test', {'vcodec': 'ffv1'}, {'acodec': 'pcm_s16le'})
+    register_codec_profile(profile)
+
+    assert get_codec_profile('test') is profile
+    assert list(registry).count('test') == 1
+
+
+def test_output_args():
+    profile = get_codec_profile('mpeg2_q1')
+    assert profile.output_args() == {'format': 'nut', 'vcodec': 'mpeg2video', 'pix_fmt': 'yuv420p',
+                                     'qscale': 1, 'qmin': 1, 'acodec': 'pcm_s16le'}
+    assert profile.output_args(video=False) == {'format': 'nut', 'acodec': 'pcm_s16le'}
+    assert profile.output_args(audio=False) == {'format': 'nut', 'vcodec': 'mpeg2video',
+                                                'pix_fmt': 'yuv420p', 'qscale': 1, 'qmin': 1}
+
+
+@pytest.mark.skipif(not shutil.which('ffmpeg'), reason="needs ffmpeg")
+@pytest.mark.parametrize('name', sorted(CODEC_PROFILES))
+def test_profile_encodes(tmp_path, name):
+    # Each built-in profile's arguments are ones ffmpeg accepts, and what
+    # it writes decodes again
+    profile = get_codec_profile(name)
+    path = str(tmp_path / f'{name}.{profile.format}')
+    video = ffmpeg.input('testsrc=size=64x48:rate=25:duration=0.4', format='lavfi')
+    audio = ffmpeg.input('sine=sample_rate=44100:duration=0.4', format='lavfi')
+    (ffmpeg.output(video, audio, path, **profile.output_args())
+     .global_args('-loglevel', 'error')
+     .run())
+
+    out, _ = (ffmpeg.input(path)
+              .output('pipe:', format='framecrc')
+              .global_args('-loglevel', 'error')
+              .run(capture_stdout=True))
+    streams = [l.split(',')[0] for l in out.decode().splitlines() if not l.startswith('#')]
+    assert streams.count('0') == 10
+    assert streams.count('1') > 0
@@ -0,0 +1,48 @@
+import os
+
+import pytest
+
+from choirless_lib.cpu_quota import read_cgroup_quota, available_cpus
+
+
+def write_v1(root, quota, period=100000):
+    (root / 'cpu').mkdir()
+    (root / 'cpu' / 'cpu.cfs_quota_us').write_text(f'{quota}\n')
+    (root / 'cpu' / 'cpu.cfs_period_us').write_text(f'{period}\n')
+
+
+@pytest.mark.parametrize('cpu_max, quota', [('max 100000', None),
+                                            ('150000 100000', 1.5),
+                                            ('200000 100000', 2.0)])
+def test_v2(tmp_path, cpu_max, quota):
+    (tmp_path / 'cpu.max').write_text(f'{cpu_max}\n')
+    assert read_cgroup_quota(tmp_path) == quota
+
+
+@pytest.mark.parametrize('cfs_quota, quota', [(-1, None), (50000, 0.5), (300000, 3.0)])
+def test_v1(tmp_path, cfs_quota, quota):
+    write_v1(tmp_path, cfs_quota)
+    assert read_cgroup_quota(tmp_path) == quota
+
+
+def test_unreadable_v2_falls_back_to_v1(tmp_path):
+    (tmp_path / 'cpu.max').write_text('garbage\n')
+    write_v1(tmp_path, 200000)
+    assert read_cgroup_quota(tmp_path) == 2.0
+
+
+def test_missing_directory(tmp_path):
+    assert read_cgroup_quota(tmp_path / 'missing') is None
+
+
+def test_available_cpus(tmp_path, monkeypatch):
+    monkeypatch.setattr(os, 'sched_getaffinity', lambda pid: set(range(8)), raising=False)
+    assert available_cpus(tmp_path / 'missing') == 8
+
+    # A fractional quota rounds up, and the quota only ever lowers the count
+    (tmp_path / 'cpu.max').write_text('150000 100000\n')
+    assert available_cpus(tmp_path) == 2
+    (tmp_path / 'cpu.max').write_text('1600000 100000\n')
+    assert available_cpus(tmp_path) == 8
+    (tmp_path / 'cpu.max').write_text('1000 100000\n')
+    assert available_cpus(tmp_path) == 1
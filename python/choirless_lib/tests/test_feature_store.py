@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from choirless_lib import FeatureStore, LocalBlobStore
+
+PARAMS = {'sr': 22050, 'hop_lengths': [256, 512], 'version': 1}
+
+
+@pytest.fixture
+def feature_store(tmp_path):
+    return FeatureStore(LocalBlobStore(tmp_path))
+
+
+@pytest.fixture
+def features():
+    rng = np.random.default_rng(0)
+    return {256: (rng.random(100), rng.random(100), rng.random((12, 100))),
+            512: (rng.random(50), None, rng.random((12, 50)))}
+
+
+def test_round_trip(feature_store, features):
+    feature_store.save('c+s+p.nut', '"etag1"', PARAMS, features)
+    # COS quotes ETags, which the key ignores
+    loaded = feature_store.load('c+s+p.nut', 'etag1', dict(PARAMS))
+
+    assert sorted(loaded) == [256, 512]
+    assert loaded[512][1] is None
+    for hop_length, values in features.items():
+        for value, stored in zip(values, loaded[hop_length]):
+            if value is not None:
+                np.testing.assert_array_equal(stored, value)
+
+
+@pytest.mark.parametrize('etag, params', [
+    ('etag2', PARAMS),
+    ('etag1', dict(PARAMS, hop_lengths=[256])),
+    ('etag1', dict(PARAMS, version=2)),
+])
+def test_changed_etag_or_params_miss(feature_store, features, etag, params):
+    feature_store.save('c+s+p.nut', 'etag1', PARAMS, features)
+    assert feature_store.load('c+s+p.nut', etag, params) is None
+
+
+def test_corrupt_blob_is_a_miss(feature_store, features, tmp_path):
+    feature_store.save('c+s+p.nut', 'etag1', PARAMS, features)
+    blob, = tmp_path.glob('c+s+p.features-*.npz')
+    blob.write_bytes(blob.read_bytes()[:100])
+
+    assert feature_store.load('c+s+p.nut', 'etag1', PARAMS) is None
@@ -0,0 +1,36 @@
+import json
+
+import pytest
+
+from choirless_lib import PartMetadata, LocalBlobStore, part_volume
+
+
+@pytest.fixture
+def part_metadata(tmp_path):
+    return PartMetadata(LocalBlobStore(tmp_path))
+
+
+def test_owners_keep_their_own_fields(part_metadata):
+    # calculate_alignment can finish before convert_format saves its fields
+    part_metadata.save('c+s+p.nut', 'calculate_alignment', {'offset_ms': 120})
+    part_metadata.save('c+s+p.nut', 'convert_format', {'volume_gain_db': -3.2, 'mute': False})
+    assert part_metadata.load('c+s+p.nut') == {'offset_ms': 120, 'volume_gain_db': -3.2,
+                                               'mute': False}
+
+    # Saving again replaces only that owner's fields
+    part_metadata.save('c+s+p.nut', 'convert_format', {'volume_gain_db': 0, 'mute': True})
+    assert part_metadata.load('c+s+p.nut') == {'offset_ms': 120, 'volume_gain_db': 0,
+                                               'mute': True}
+    assert part_volume(part_metadata.load('c+s+p.nut')) == 0
+
+
+def test_old_sidecar_is_read_under_the_owners(part_metadata, tmp_path):
+    (tmp_path / 'c+s+p.meta.json').write_text(json.dumps({'offset_ms': 50, 'volume_gain_db': 2}))
+    part_metadata.save('c+s+p.nut', 'calculate_alignment', {'offset_ms': 80})
+    assert part_metadata.load('c+s+p.nut') == {'offset_ms': 80, 'volume_gain_db': 2}
+
+
+def test_missing_and_unknown(part_metadata):
+    assert part_metadata.load('c+s+p.nut') == {}
+    with pytest.raises(ValueError):
+        part_metadata.save('c+s+p.nut', 'trim_clip', {})
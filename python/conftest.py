@@ -0,0 +1,6 @@
+import sys
+from pathlib import Path
+
+# The actions import choirless_lib as the image installs it, so use its
+# source here rather than the directory of the same name beside them
+sys.path.insert(0, str(Path(__file__).parent / 'choirless_lib'))
@@ -1,16 +1,31 @@
 import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from pathlib import Path
 import json
 import math
-import re
+import tempfile
 
 import ffmpeg
 
 from choirless_lib import mqtt_status, create_signed_url
+from choirless_lib import analyse_audio, analyse_pcm, audio_format, calc_volume_gain
+from choirless_lib import create_part_metadata, available_cpus
+from choirless_lib import get_codec_profile
 
 SAMPLE_RATE = 44100
 
+# Peak to normalise parts to in dB, leaving headroom for the mix
+TARGET_PEAK = -2
+
+# Length of the segments the video is encoded in with parallel execution
+SEGMENT_SECONDS = 20
+# Seconds decoded before each segment and thrown away
+SEGMENT_LEAD_IN = 1
+
+# Codec profile the converted parts are written with
+CODEC_PROFILE = 'h264_slow'
+
 
 @mqtt_status()
 def main(args):
@@ -51,12 +66,12 @@ def main(args):
     ## Probe pass
     # First probe the file to see if we have audio and/or video streams
     try:
-        output = ffmpeg.probe(get_input_url(key))
+        probe = ffmpeg.probe(get_input_url(key))
     except Exception as e:
         print("ffprobe error", e.stderr)
         return({'error': str(e)})
 
-    stream_types = set([ s['codec_type'] for s in output['streams'] ])
+    stream_types = set([ s['codec_type'] for s in probe['streams'] ])
     audio_present = 'audio' in stream_types
     video_present = 'video' in stream_types
 
@@ -66,80 +81,149 @@ def main(args):
     if not (audio_present or video_present):
         return {"error": "no streams!"}
 
+    # With a single pass the input is only decoded once. The loudness is
+    # measured as it is converted, and the gain left for later stages to
+    # apply from the part's metadata
+    passes = int(args.get('passes', 2))
+
+    # With parallel execution the video is encoded in segments at once
+    execution = args.get('execution', 'serial')
+    max_workers = int(args.get('max_workers', available_cpus()))
+    segment_seconds = float(args.get('segment_seconds', SEGMENT_SECONDS))
+    codec_profile = args.get('codec_profile', CODEC_PROFILE)
+
+    vol_threshold = int(args.get('vol_threshold', 30))
+    vol_pct = float(args.get('vol_pct', 0.05))
+
+    t1 = time.time()
+    results, metadata = convert(get_input_url(key),
+                                get_output_url(output_key),
+                                probe,
+                                passes=passes,
+                                execution=execution,
+                                vol_threshold=vol_threshold,
+                                vol_pct=vol_pct,
+                                max_workers=max_workers,
+                                segment_seconds=segment_seconds,
+                                codec_profile=codec_profile,
+                                **kwargs)
+    t2 = time.time()
+
+    # Every field we own is always saved, so metadata left from an earlier
+    # upload of the part is never applied to this one. The offset is in
+    # calculate_alignment's sidecar, which may get there first
+    part_metadata = create_part_metadata(args, dst_bucket)
+    part_metadata.save(output_key, 'convert_format', metadata)
+
+    ret = {'status': 'ok',
+           'render_time': int(t2-t1),
+           'src_key': key,
+           'dst_key': output_key,
+           'choir_id': choir_id,
+           'song_id': song_id,
+           'part_id': part_id,
+           'integrated_loudness': results.get('integrated_loudness'),
+           'status': 'converted'
+           }
+
+    return ret
+
+
+def convert(input_url, output_url, probe, passes=2, execution='serial',
+            vol_threshold=30, vol_pct=0.05, max_workers=1,
+            segment_seconds=SEGMENT_SECONDS, codec_profile=CODEC_PROFILE,
+            **kwargs):
+    """
+    Convert media to the format later stages work with, normalising the
+    loudness of its audio
+
+    :param input_url: URL (e.g. a signed COS GET URL) or path of the media
+    :type input_url: str
+    :param output_url: URL (e.g. a signed COS PUT URL) or path to write to
+    :type output_url: str
+    :param probe: output of ffmpeg.probe for the media
+    :type probe: dict
+    :param passes: 2 to normalise the audio as it is converted, or 1 to
+                   leave the gain for later stages to apply
+    :type passes: int
+    :param execution: 'parallel' to encode the video in segments at once
+    :type execution: str
+    :param vol_threshold: dB below full scale a sample counts as sound at
+    :type vol_threshold: int
+    :param vol_pct: fraction of the loudest samples that must be sound
+    :type vol_pct: float
+    :param max_workers: number of segments to encode at once
+    :type max_workers: int
+    :param segment_seconds: length of the segments
+    :type segment_seconds: float
+    :param codec_profile: name of the codec profile to write the output with
+    :type codec_profile: str
+    :return: the audio analysis results, and the metadata for the part:
+             the adjustments still to be made to the converted audio and
+             the codec profile it was written with
+    :rtype: (dict, dict)
+    """
+    stream_types = set([ s['codec_type'] for s in probe['streams'] ])
+    audio_present = 'audio' in stream_types
+    video_present = 'video' in stream_types
+    single_pass = passes == 1
+    profile = get_codec_profile(codec_profile)
+
+    # Segments need both streams and to know where the media ends
+    duration = float(probe.get('format', {}).get('duration', 0))
+    start_time = float(probe.get('format', {}).get('start_time', 0))
+    parallel = (execution == 'parallel' and audio_present and video_present
+                and duration > segment_seconds)
+
+    # Adjustments still to be made to the converted audio, and the profile
+    # for anything re-encoding part of it to match
+    metadata = {'volume_gain_db': 0,
+                'mute': False,
+                'codec_profile': codec_profile}
+    results = {}
+
     ## Two pass loudness normalisation
     # First pass, get details
-    if audio_present:
+    if audio_present and not single_pass:
         print("Doing first pass")
-        stream = ffmpeg.input(get_input_url(key),
-                              seekable=0)
-        audio = stream.audio
-        audio = audio.filter('volumedetect')
-        pipeline = ffmpeg.output(audio,
-                                 "-",
-                                 format='null')
+        results = analyse_audio(input_url, *audio_format(probe))
+        print("Audio analysis:", results)
 
-        cmd = pipeline.compile()
-        print("ffmpeg command to run: ", cmd)
+        volume_gain, mute = calc_volume_gain(results, vol_threshold, vol_pct,
+                                             target_peak=TARGET_PEAK)
 
-        stdout, stderr = pipeline.run(capture_stdout=True,
-                                      capture_stderr=True)
-        output = stdout + stderr
-        output_lines = [line.strip() for line in output.decode().split('\n')]
-
-        mute = False
-
-        # Volume detect
-        vol_threshold = int(args.get('vol_threshold', 30))
-        vol_pct = float(args.get('vol_pct', 0.05))
-
-        total_samples = 0
-        high_samples = 0
-        max_volume = 0
-        hist_re = re.compile(r'histogram_(\d+)db: (\d+)')
-        maxvol_re = re.compile(r'max_volume: (-?\d+\.?\d*) dB')
-        for line in output_lines:
-            # Search for histogram
-            mo = hist_re.search(line)
-            if mo:
-                level, samples = mo.groups()
-                total_samples += int(samples)
-                if int(level) < vol_threshold:
-                    high_samples += int(samples)
-
-            # Search for max volume
-            mo = maxvol_re.search(line)
-            if mo:
-                max_volume = float(mo.groups()[0])
-
-        if high_samples/total_samples < vol_pct:
-            print(f"Input volume is so low, we are muting it {high_samples/total_samples:.2f} above {vol_threshold}")
-            mute = True
-
-        target_peak = -2
-        volume_gain = target_peak - max_volume
-        volume_gain = f"{volume_gain:.2f} dB"
-            
     # Second pass, apply normalisation
-    print("Doing second pass")
-    stream = ffmpeg.input(get_input_url(key),
+    print("Doing single pass" if single_pass else "Doing second pass")
+    stream = ffmpeg.input(input_url,
                           seekable=0)
 
     if video_present:
-        video = stream.filter('fps', fps=25, round='up')
-        video = video.filter('scale', 640, 480,
-                             force_original_aspect_ratio='decrease',
-                             force_divisible_by=2)
+        video = scale_video(stream)
     else:
         video = ffmpeg.input('color=color=black:size=vga',
                              format='lavfi').video
 
-    if audio_present:
+    if audio_present and single_pass:
+        # Tee the audio to our stdout to measure it. Each branch has its
+        # own aresample so the output being mono and 44.1 kHz doesn't make
+        # the tee so too, as the analysis measures the audio as it is
+        sample_rate, channels = audio_format(probe)
+        split = stream.audio.asplit()
+        audio = split[0].filter('aresample', SAMPLE_RATE)
+        analysis = ffmpeg.output(split[1].filter('aresample', sample_rate),
+                                 'pipe:',
+                                 format='f32le',
+                                 acodec='pcm_f32le',
+                                 ac=channels)
+    elif audio_present:
         audio = stream.audio
 
         # If the normalisation appears to detect no sound then just mute audio
         if mute:
             volume_gain = 0
-            
+        else:
+            volume_gain = f"{volume_gain:.2f} dB"
+
         print("Volume gain to apply:", volume_gain)
         audio = audio.filter('volume',
                              volume_gain)
@@ -148,36 +232,259 @@ def main(args):
         audio = ffmpeg.input('anullsrc',
                              format='lavfi').audio
 
+    # The executor is left before the directory, so any segments still
+    # being encoded are finished with before it is removed
+    with tempfile.TemporaryDirectory() as tmpdir, \
+         ThreadPoolExecutor(max_workers=1) as executor:
+
+        if parallel:
+            # Only the audio is converted here, while the video segments
+            # are encoded alongside
+            segments = executor.submit(encode_segments, input_url, duration,
+                                       tmpdir, max_workers, segment_seconds,
+                                       start_time, profile)
+            audio_path = str(Path(tmpdir, 'audio.nut'))
+            pipeline = ffmpeg.output(audio,
+                                     audio_path,
+                                     ac=1,
+                                     **profile.output_args(video=False))
+        else:
+            pipeline = ffmpeg.output(audio,
+                                     video,
+                                     output_url,
+                                     method='PUT',
+                                     shortest=None,
+                                     seekable=0,
+                                     r=25,
+                                     ac=1,
+                                     **profile.output_args(),
+                                     **kwargs)
+
+        if audio_present and single_pass:
+            pipeline = ffmpeg.merge_outputs(pipeline, analysis)
+
+        cmd = pipeline.compile()
+        print("ffmpeg command to run: ", cmd)
+        if audio_present and single_pass:
+            results = analyse_pipeline(pipeline, sample_rate, channels)
+            print("Audio analysis:", results)
+            volume_gain, mute = calc_volume_gain(results, vol_threshold, vol_pct,
+                                                 target_peak=TARGET_PEAK)
+            print("Volume gain to apply later:", 0 if mute else f"{volume_gain:.2f} dB")
+            metadata.update(volume_gain_db=round(volume_gain, 2),
+                            mute=mute)
+        else:
+            pipeline.run()
+
+        if parallel:
+            pipeline = concat_segments(segments.result(), audio_path, output_url,
+                                       tmpdir, **kwargs)
+            cmd = pipeline.compile()
+            print("ffmpeg command to run: ", cmd)
+            pipeline.run()
+
+    return results, metadata
 
-    pipeline = ffmpeg.output(audio,
-                             video,
-                             get_output_url(output_key),
-                             format='nut',
-                             acodec='pcm_f32le',
-                             vcodec='libx264',
-                             method='PUT',
-                             preset='slow',
-                             shortest=None,
-                             seekable=0,
+
+def scale_video(stream):
+    # Every part has the same frame rate and fits in the same size
+    video = stream.filter('fps', fps=25, round='up')
+    video = video.filter('scale', 640, 480,
+                         force_original_aspect_ratio='decrease',
+                         force_divisible_by=2)
+    return video
+
+
+def plan_segments(duration, segment_seconds, fps=25):
+    """
+    Split media into segments that start on a frame of the output
+
+    :param duration: duration of the media in seconds
+    :type duration: float
+    :param segment_seconds: length of the segments
+    :type segment_seconds: float
+    :param fps: frame rate of the output
+    :type fps: int
+    :return: list of (start seconds, number of frames), with None for the
+             number of frames in the last segment so it runs to the end
+    :rtype: list
+    """
+    segment_frames = max(1, int(round(segment_seconds * fps)))
+    total_frames = int(math.ceil(duration * fps))
+    starts = list(range(0, total_frames, segment_frames))
+
+    # Don't leave a sliver of a segment on the end
+    if len(starts) > 1 and total_frames - starts[-1] < segment_frames / 2:
+        starts.pop()
+
+    segments = [(start / fps, segment_frames) for start in starts]
+    segments[-1] = (segments[-1][0], None)
+    return segments
+
+
+def encode_segment(input_url, start, frames, path, threads=0, start_time=0,
+                   profile=None):
+    """
+    Encode a segment of the video of media. The segment starts with a
+    keyframe, so segments can be joined without re-encoding.
+
+    :param input_url: URL or path of the media
+    :type input_url: str
+    :param start: seconds into the media to start at
+    :type start: float
+    :param frames: number of frames to encode, or None to run to the end
+    :type frames: int
+    :param path: path to write the segment to
+    :type path: str
+    :param threads: encoder threads, or 0 to let the encoder choose
+    :type threads: int
+    :param start_time: start time of the media, as ffmpeg.probe gives it
+    :type start_time: float
+    :param profile: codec profile to encode with, defaults to CODEC_PROFILE
+    :type profile: CodecProfile
+    """
+    profile = profile or get_codec_profile(CODEC_PROFILE)
+    input_kwargs = {}
+    output_kwargs = {}
+    global_args = ['-nostdin', '-loglevel', 'error']
+
+    # Start a little early, keeping the original timestamps, so the fps
+    # filter picks the same frames as it would converting the whole media
+    # in one go. The segment is then cut from its output on a frame of it
+    lead_in = min(start, SEGMENT_LEAD_IN)
+    if start > 0:
+        # Seeking needs range requests, so the input has to be seekable
+        input_kwargs['ss'] = start - lead_in
+        global_args.append('-copyts')
+    if frames is not None:
+        output_kwargs['frames:v'] = frames
+        # Stop reading shortly after the end of the segment
+        input_kwargs['t'] = lead_in + frames / 25 + 1
+
+    stream = ffmpeg.input(input_url, **input_kwargs)
+    video = scale_video(stream.video)
+    if start > 0:
+        video = video.trim(start=start_time + start)
+        video = video.setpts('PTS-STARTPTS')
+
+    pipeline = ffmpeg.output(video,
+                             path,
+                             threads=threads,
                              r=25,
-                             ac=1,
-                             **kwargs)
+                             **profile.output_args(audio=False),
+                             **output_kwargs)
+    pipeline = pipeline.global_args(*global_args)
+    pipeline.overwrite_output().run()
 
-    cmd = pipeline.compile()
-    print("ffmpeg command to run: ", cmd)
-    t1 = time.time()
-    pipeline.run()
-    t2 = time.time()
-    
-    ret = {'status': 'ok',
-           'render_time': int(t2-t1),
-           'src_key': key,
-           'dst_key': output_key,
-           'choir_id': choir_id,
-           'song_id': song_id,
-           'part_id': part_id,
-           'status': 'converted'
-           }
 
-    return ret
+def encode_segments(input_url, duration, tmpdir, max_workers, segment_seconds,
+                    start_time=0, profile=None):
+    """
+    Encode the video of media in segments, max_workers at a time
+
+    :param input_url: URL or path of the media
+    :type input_url: str
+    :param duration: duration of the media in seconds
+    :type duration: float
+    :param tmpdir: directory to write the segments to
+    :type tmpdir: str
+    :param max_workers: number of segments to encode at once
+    :type max_workers: int
+    :param segment_seconds: length of the segments
+    :type segment_seconds: float
+    :param start_time: start time of the media, as ffmpeg.probe gives it
+    :type start_time: float
+    :param profile: codec profile to encode with, defaults to CODEC_PROFILE
+    :type profile: CodecProfile
+    :return: (path, duration) of the segments in order, with None for the
+             duration of the last
+    :rtype: list
+    """
+    segments = plan_segments(duration, segment_seconds)
+    max_workers = max(1, min(max_workers, len(segments)))
+    # Share the CPUs between the encoders rather than each using them all
+    threads = max(1, available_cpus() // max_workers)
+    print(f"Encoding {len(segments)} segments, {max_workers} at a time")
+
+    paths = [str(Path(tmpdir, f'segment{i:04d}.nut'))
+             for i in range(len(segments))]
+
+    # Each encode is its own ffmpeg process, so threads are enough here
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(encode_segment, input_url, start, frames,
+                                   path, threads, start_time, profile)
+                   for (start, frames), path in zip(segments, paths)]
+        for future in futures:
+            future.result()
+
+    return [(path, frames / 25 if frames is not None else None)
+            for path, (_, frames) in zip(paths, segments)]
+
+
+def concat_segments(segments, audio_path, output_url, tmpdir, **kwargs):
+    """
+    Build the pipeline joining encoded video segments and the converted
+    audio into the output, without re-encoding either
+
+    :param segments: (path, duration) of the video segments, in order
+    :type segments: list
+    :param audio_path: path of the converted audio
+    :type audio_path: str
+    :param output_url: URL (e.g. a signed COS PUT URL) or path to write to
+    :type output_url: str
+    :param tmpdir: directory to write the list of segments to
+    :type tmpdir: str
+    :return: the ffmpeg pipeline
+    """
+    # Without the durations, each segment would be joined on to the last
+    # frame of the one before rather than the end of it
+    lines = []
+    for path, duration in segments:
+        lines.append(f"file '{path}'\n")
+        if duration is not None:
+            lines.append(f"duration {duration:.6f}\n")
+    list_path = Path(tmpdir, 'segments.txt')
+    list_path.write_text(''.join(lines))
+
+    video = ffmpeg.input(str(list_path), format='concat', safe=0)
+    audio = ffmpeg.input(audio_path)
+    # Both streams already end with the media, and -shortest would cut the
+    # copied video short of the audio's end by a few frames
+    return ffmpeg.output(audio.audio,
+                         video.video,
+                         output_url,
+                         format='nut',
+                         acodec='copy',
+                         vcodec='copy',
+                         method='PUT',
+                         seekable=0,
+                         **kwargs)
+
+
+def analyse_pipeline(pipeline, sample_rate, channels):
+    """
+    Run an ffmpeg pipeline that writes float32 PCM to its stdout alongside
+    its other outputs, and analyse the PCM as it runs
+
+    :param pipeline: ffmpeg pipeline
+    :param sample_rate: sample rate of the PCM
+    :type sample_rate: int
+    :param channels: number of channels in the PCM
+    :type channels: int
+    :return: results as choirless_lib.AudioAnalyser gives them
+    :rtype: dict
+    """
+    process = pipeline.run_async(pipe_stdout=True)
+    try:
+        results = analyse_pcm(process.stdout, sample_rate, channels)
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+
+    if returncode != 0:
+        raise ffmpeg.Error('ffmpeg', None, None)
+
+    if results['n_samples'] == 0:
+        raise RuntimeError("ffmpeg could not decode audio")
 
+    return results
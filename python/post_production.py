@@ -8,11 +8,14 @@ import tempfile
 from functools import partial
 import time
 import hashlib
-import re
 
 import ffmpeg
 
 from choirless_lib import mqtt_status, create_signed_url, create_cos_client
+from choirless_lib import analyse_audio, audio_format, calc_volume_gain
+
+# Peak to normalise the final mix to in dB
+TARGET_PEAK = 0
 
 @mqtt_status()
 def main(args):
@@ -70,54 +73,19 @@ def main(args):
     # Create a temp dir for our files to use
     with tempfile.TemporaryDirectory() as tmpdir:
 
+        # Analysed as it is, not resampled or remixed, so the gain and
+        # whether to mute are measured on the samples volumedetect used to
         print("Doing first pass")
-        stream = ffmpeg.input(get_input_url(key),
-                              seekable=0)
-        audio = stream.audio
-        audio = audio.filter('volumedetect')
-        pipeline = ffmpeg.output(audio,
-                                 "-",
-                                 format='null')
-
-        cmd = pipeline.compile()
-        print("ffmpeg command to run: ", cmd)
-
-        stdout, stderr = pipeline.run(capture_stdout=True,
-                                      capture_stderr=True)
-        output = stdout + stderr
-        output_lines = [line.strip() for line in output.decode().split('\n')]
-
-        mute = False
+        probe = ffmpeg.probe(get_input_url(key))
+        results = analyse_audio(get_input_url(key), *audio_format(probe))
+        print("Audio analysis:", results)
 
         # Volume detect
         vol_threshold = int(args.get('vol_threshold', 22))
         vol_pct = float(args.get('vol_pct', 0.05))
 
-        total_samples = 0
-        high_samples = 0
-        max_volume = 0
-        hist_re = re.compile(r'histogram_(\d+)db: (\d+)')
-        maxvol_re = re.compile(r'max_volume: (-?\d+\.?\d*) dB')
-        for line in output_lines:
-            # Search for histogram
-            mo = hist_re.search(line)
-            if mo:
-                level, samples = mo.groups()
-                total_samples += int(samples)
-                if int(level) < vol_threshold:
-                    high_samples += int(samples)
-
-            # Search for max volume
-            mo = maxvol_re.search(line)
-            if mo:
-                max_volume = float(mo.groups()[0])
-
-        if high_samples/total_samples < vol_pct:
-            print(f"Input volume is so low, we are muting it {high_samples/total_samples:.2f} above {vol_threshold}")
-            mute = True
-
-        target_peak = 0
-        volume_gain = target_peak - max_volume
+        volume_gain, mute = calc_volume_gain(results, vol_threshold, vol_pct,
+                                             target_peak=TARGET_PEAK)
         volume_gain = f"{volume_gain:.2f} dB"
 
         # Second pass, apply normalisation
@@ -206,6 +174,7 @@ def main(args):
                'status': 'ok',
                'choir_id': choir_id,
                'song_id': song_id,
+               'integrated_loudness': results['integrated_loudness'],
                'status': 'done'}
 
         return ret
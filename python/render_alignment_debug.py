@@ -0,0 +1,137 @@
+import argparse
+import json
+import tempfile
+from pathlib import Path
+
+from choirless_lib import create_cos_client
+
+# Plot colours for each feature, as calculate_alignment used to draw them
+FEATURE_STYLES = [('chroma', 'Chroma', 'r'),
+                  ('sf', 'Spectral Flux', 'g'),
+                  ('cf', 'Crest Factor', 'b')]
+
+
+# Render the debug artifact calculate_alignment saved for a part into a
+# plot of its error curves, on demand
+def main(args):
+    cos = create_cos_client(args)
+
+    if not cos:
+        raise ValueError("could not create COS instance")
+
+    notification = args.get('notification', {})
+    key = args.get('key', notification.get('object_name', ''))
+    debug_bucket = args.get('debug_bucket', notification.get('bucket_name'))
+
+    # Accept either the part's key or the artifact's key
+    stem = Path(key).stem
+    if not stem.endswith('-alignment'):
+        stem = f'{stem}-alignment'
+    artifact_key = f'{stem}.json'
+    plot_key = f'{stem}.png'
+
+    body = cos.get_object(Bucket=debug_bucket, Key=artifact_key)['Body']
+    artifact = json.loads(body.read())
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        file_path = str(Path(tmpdir, plot_key))
+        render_alignment(artifact, file_path)
+        cos.upload_file(file_path, debug_bucket, plot_key)
+
+    ret = {"status": "ok",
+           "key": key,
+           "artifact_key": artifact_key,
+           "plot_key": plot_key,
+           "offset": artifact.get('offset'),
+    }
+
+    return ret
+
+
+def plot_alignment(ax, artifact):
+    """
+    Plot the per hop length and smoothed error curves of each feature, the
+    overall error, and the candidate offsets on ax. For the landmark engine,
+    plot the votes for each offset instead.
+
+    :param ax: matplotlib axes to plot on
+    :param artifact: result from calculate_alignment.calc_alignment
+    :type artifact: dict
+    """
+    if 'votes' in artifact:
+        # From the landmark engine, votes for each offset instead of errors
+        ax.bar(artifact['vote_times'], artifact['votes'], color='k', label='Votes')
+        ax.axvline(x=artifact['offset'], color='r', linestyle='--')
+        ax.legend()
+        return
+
+    if 'times' not in artifact:
+        return
+
+    times = artifact['times']
+
+    for name, label, color in FEATURE_STYLES:
+        if name in artifact['fused']:
+            for errors in artifact['curves'][name]:
+                ax.plot(times, errors, color=color, alpha=0.3)
+            ax.plot(times, artifact['fused'][name], label=label, color=color)
+
+    ax.plot(times, artifact['total'], label='Overall', color='k', linewidth=5)
+
+    for offset in artifact['offsets']:
+        alpha = 1 if offset == artifact['offset'] else 0.2
+        ax.axvline(x=offset, color='r', alpha=alpha, linestyle='--')
+    ax.legend()
+
+
+def render_alignment(artifact, file_path):
+    """
+    Render a debug artifact saved by calculate_alignment into a PNG
+
+    :param artifact: debug artifact
+    :type artifact: dict
+    :param file_path: path to write the PNG to
+    :type file_path: str
+    """
+    # Only imported here so nothing on the alignment path pays for it
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig = plt.figure(figsize=(20, 6))
+    ax = fig.add_subplot(1, 1, 1)
+
+    plot_alignment(ax, artifact)
+
+    # Plot the output
+    offset_ms = artifact.get('offset', 0)
+    title = f"Alignment: {artifact.get('rendition_key', '')}"
+    if 'confidence' in artifact:
+        title += f" (confidence {artifact['confidence']:.2f})"
+    ax.set_title(title)
+    ax.set_ylabel("votes" if "votes" in artifact else "difference")
+    ax.set_xlabel(f"milliseconds behind: {artifact.get('reference_key', '')}")
+
+    x_bounds = ax.get_xlim()
+    ax.annotate(text=f'{offset_ms:.0f} ms',
+                xy =(((offset_ms-x_bounds[0])/(x_bounds[1]-x_bounds[0])),0.99),
+                xycoords='axes fraction', verticalalignment='top',
+                horizontalalignment='left' , rotation = 270)
+
+    fig.savefig(file_path)
+    plt.close(fig)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Render calculate_alignment debug artifacts to PNGs")
+    parser.add_argument('artifacts', nargs='+', help="-alignment.json files")
+    parser.add_argument('--output-dir', help="directory for the PNGs, defaults to next to each artifact")
+    args = parser.parse_args()
+
+    for artifact_path in args.artifacts:
+        artifact_path = Path(artifact_path)
+        output_dir = Path(args.output_dir or artifact_path.parent)
+        file_path = output_dir / artifact_path.with_suffix('.png').name
+        render_alignment(json.load(artifact_path.open()), str(file_path))
+        print("Rendered:", file_path)
@@ -8,6 +8,11 @@ from pathlib import Path
 import ffmpeg
 
 from choirless_lib import mqtt_status, create_signed_url, create_cos_client
+from choirless_lib import PartMetadata, COSBlobStore, part_volume
+from choirless_lib import get_codec_profile
+
+# Codec profile the composited rows are written with
+CODEC_PROFILE = 'mpeg2_q1'
 
 helper = lambda x: {'tag': f"{x['compositor']}-{x['row_num']}"}
 @mqtt_status(helper)
@@ -85,6 +90,9 @@ def main(args):
                              geo,
                              dst_bucket)
 
+    # Adjustments convert_format left for us to make to each part
+    part_metadata = PartMetadata(COSBlobStore(cos, src_bucket))
+
     # Calculate the max row length, needed for volume compensation
     # on uneven rows
     max_row_len = 0
@@ -120,7 +128,8 @@ def main(args):
         part_url = get_input_url(part_key)
 
         # process the spec
-        video, audio = process_spec(part_url, spec)
+        video, audio = process_spec(part_url, spec,
+                                    load_part_metadata(part_metadata, part_key))
 
         audio_inputs.append(audio)
         # Get co-ords for video
@@ -169,6 +178,8 @@ def main(args):
     if len(streams_and_filename) == 0:
         return {'error': 'no parts to process'}
 
+    profile = get_codec_profile(args.get('codec_profile', CODEC_PROFILE))
+
     kwargs = {}
     if 'duration' in args:
         kwargs['t'] = int(args['duration'])
@@ -177,15 +188,10 @@ def main(args):
     streams_and_filename.append(output_url)
     
     pipeline = ffmpeg.output(*streams_and_filename,
-                             format='nut',
-                             pix_fmt='yuv420p',
-                             acodec='pcm_s16le',
-                             vcodec='mpeg2video',
                              method='PUT',
                              r=25,
                              seekable=0,
-                             qscale=1,
-                             qmin=1,
+                             **profile.output_args(),
                              **kwargs
     )
     
@@ -207,6 +213,16 @@ def main(args):
     return ret
 
 
+def load_part_metadata(part_metadata, part_key):
+    # The metadata only adjusts a part, so the row is still rendered
+    # without it if it can't be read
+    try:
+        return part_metadata.load(part_key)
+    except Exception as e:
+        print(f"Could not load part metadata: key {part_key}", e)
+        return {}
+
+
 def specs_for_row(specs, row):
     for spec in specs:
         x, y = spec.get('position', [-1, -1])
@@ -232,16 +248,27 @@ def calc_bounding_box(specs):
     return top, bottom            
 
 
-def process_spec(part_url, spec):
+def process_spec(part_url, spec, metadata=None):
+    metadata = metadata or {}
+
+    # Calc the offset in seconds, falling back on the one calculate_alignment
+    # left with the part
+    offset = spec.get('offset', metadata.get('offset_ms', 0))
+    offset = float(offset) / 1000
+
+    # Seek the input to the offset, rather than decoding everything before
+    # it only to throw it away. Seeking needs range requests, so the input
+    # has to be seekable. Forcing the input frame rate would undo the seek,
+    # and converted parts are 25 fps already
+    if offset > 0:
+        input_kwargs = {'ss': offset}
+    else:
+        input_kwargs = {'seekable': 0, 'r': 25}
+
     # main stream input
     stream = ffmpeg.input(part_url,
-                          seekable=0,
-                          r=25,
-                          thread_queue_size=64)
-    
-    # Calc the offset in seconds
-    offset = spec.get('offset', 0)
-    offset = float(offset) / 1000
+                          thread_queue_size=64,
+                          **input_kwargs)
 
     # Get the part spec and input
     # video
@@ -249,9 +276,6 @@ def process_spec(part_url, spec):
         width, height = spec['size']
         
         video = stream.video
-        if offset > 0:
-            video = video.filter('trim',
-                             start=offset)
         video = video.filter('setpts', 'PTS-STARTPTS')
         video = video.filter('scale', width, height,
                              force_original_aspect_ratio='decrease',
@@ -262,10 +286,14 @@ def process_spec(part_url, spec):
 
     # audio
     audio = stream.audio
-    if offset > 0:
-        audio = audio.filter('atrim',
-                             start=offset)
     audio = audio.filter('asetpts', 'PTS-STARTPTS')
+
+    # gain measured when the part was converted, if not already applied
+    gain = part_volume(metadata)
+    if gain is not None:
+        audio = audio.filter('volume',
+                             volume=gain)
+
     pan = float(spec.get('pan', 0))
     volume = float(spec.get('volume', 1))
     audio = audio.filter('volume',
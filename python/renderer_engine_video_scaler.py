@@ -10,6 +10,12 @@ from ibm_botocore.client import Config
 
 import ffmpeg
 
+from choirless_lib import get_codec_profile
+
+# Codec profile the scaled videos are written with. They are always
+# Matroska, as the compositor looks for them by their .mkv name
+CODEC_PROFILE = 'huffyuv'
+
 
 def main(args):
 
@@ -35,7 +41,8 @@ def main(args):
 
         stream = ffmpeg.input(str(file_path))
         video = stream.video.filter('scale', width, height)
-        out = ffmpeg.output(video, str(new_path), vcodec='huffyuv')
+        profile = get_codec_profile(args.get('codec_profile', CODEC_PROFILE))
+        out = ffmpeg.output(video, str(new_path), **profile.video)
         stdout, stderr = out.run()
 
         cos.upload_file(str(new_path), dst_bucket, f'{new_path.name}')
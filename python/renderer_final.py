@@ -12,6 +12,10 @@ import hashlib
 import ffmpeg
 
 from choirless_lib import mqtt_status, create_signed_url, create_cos_client
+from choirless_lib import get_codec_profile
+
+# Codec profile the mix is written with
+CODEC_PROFILE = 'mpeg2_q1'
 
 # first step to ensure we have all parts
 # then call process()
@@ -160,6 +164,8 @@ def process(args):
     output_key = f'{choir_id}+{song_id}+{def_id}-preprod.nut'
     output_url = get_output_url(output_key)
 
+    profile = get_codec_profile(args.get('codec_profile', CODEC_PROFILE))
+
     kwargs = {}
     if 'duration' in args:
         kwargs['t'] = int(args['duration'])
@@ -170,15 +176,10 @@ def process(args):
     pipeline = ffmpeg.output(audio,
                              video,
                              output_url,
-                             format='nut',
-                             pix_fmt='yuv420p',
-                             acodec='pcm_s16le',
-                             vcodec='mpeg2video',
                              method='PUT',
                              r=25,
                              seekable=0,
-                             qscale=1,
-                             qmin=1,
+                             **profile.output_args(),
                              **kwargs
     )
 
@@ -0,0 +1,85 @@
+import time
+
+import pytest
+import requests
+
+from api_stand_in import start_stand_in
+from choirless_lib import APIClient, create_api_client
+
+PARTS = [{'choirId': 'c1', 'songId': 's1', 'partId': 'p1', 'partType': 'backing'},
+         {'choirId': 'c1', 'songId': 's1', 'partId': 'p2', 'partType': 'rendition'}]
+
+
+@pytest.fixture
+def stand_in(request):
+    server = start_stand_in(parts=PARTS, **getattr(request, 'param', {}))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def songparts_hits(server):
+    return server.hits[('GET', 'choir/songparts')]
+
+
+def test_songparts_cached_until_ttl(stand_in):
+    api = APIClient(stand_in.url, 'key', songparts_ttl=0.5)
+    assert api.get_songparts('c1', 's1') == PARTS
+    api.get_songparts('c1', 's1')
+    assert songparts_hits(stand_in) == 1
+
+    time.sleep(0.6)
+    api.get_songparts('c1', 's1')
+    assert songparts_hits(stand_in) == 2
+
+
+def test_songpart_update_invalidates_cache(stand_in):
+    api = APIClient(stand_in.url, 'key')
+    api.get_songparts('c1', 's1')
+    api.post_songpart('c1', 's1', 'p2', offset=120)
+    api.get_songparts('c1', 's1')
+
+    assert songparts_hits(stand_in) == 2
+    assert stand_in.posted == [('choir/songpart', {'offset': 120, 'choirId': 'c1',
+                                                   'songId': 's1', 'partId': 'p2'})]
+
+
+@pytest.mark.parametrize('stand_in', [{'failures': 2}], indirect=True)
+def test_retries_through_503s(stand_in):
+    api = APIClient(stand_in.url, 'key', backoff_factor=0.01)
+    api.post_songpart('c1', 's1', 'p2', offset=120)
+
+    assert stand_in.hits[('POST', 'choir/songpart')] == 3
+    assert len(stand_in.posted) == 1
+
+
+@pytest.mark.parametrize('stand_in', [{'failures': 1}], indirect=True)
+def test_render_not_retried(stand_in):
+    # Each render POST creates a record, so one that may have reached the
+    # API is never sent again
+    api = APIClient(stand_in.url, 'key', backoff_factor=0.01)
+    with pytest.raises(requests.exceptions.HTTPError):
+        api.post_render('c1', 's1', None, 'new')
+    assert stand_in.hits[('POST', 'render')] == 1
+
+    api.post_render('c1', 's1', None, 'new')
+    assert stand_in.hits[('POST', 'render')] == 2
+    assert stand_in.posted == [('render', {'choirId': 'c1', 'songId': 's1',
+                                           'partId': None, 'status': 'new'})]
+
+
+@pytest.mark.parametrize('stand_in', [{'delay': 2}], indirect=True)
+def test_slow_api_times_out(stand_in):
+    api = APIClient(stand_in.url, 'key', timeout=(1, 0.5), retries=1, backoff_factor=0)
+    t1 = time.time()
+    with pytest.raises(requests.exceptions.RequestException):
+        api.get_songparts('c1', 's1')
+    assert time.time() - t1 < 1.5
+
+
+def test_create_api_client():
+    args = {'CHOIRLESS_API_URL': 'http://localhost:1/', 'CHOIRLESS_API_KEY': 'key'}
+    assert create_api_client(args) is create_api_client(dict(args))
+
+    with pytest.raises(ValueError):
+        create_api_client({'CHOIRLESS_API_KEY': 'key'})
@@ -0,0 +1,284 @@
+import json
+
+import numpy as np
+import pytest
+
+import calculate_alignment
+from choirless_lib import FeatureStore, LocalBlobStore
+from calculate_alignment import calc_error_curve, calc_chroma_error_curve, parse_flag
+from calculate_alignment import contiguous_runs, fuse_errors, smooth_curves
+from calculate_alignment import feature_params, FEATURES_VERSION
+from calculate_alignment import gen_multi_hop_features, hop_lengths_for, StreamingFeatures
+from calculate_alignment import calc_alignment_landmarks, calc_offset, LANDMARK_HOP_LENGTH, PARAMS
+from calculate_alignment import calc_alignment, calc_confidence, CONFIDENCE_LOW, CONFIDENCE_HIGH
+from bench_alignment import load_source
+
+
+def measure_error(x0, x1, offset):
+    # The loop calc_error_curve replaced, one offset at a time
+    max_len = min(len(x0), len(x1))
+    diff = x0[:max_len] - np.roll(x1[:max_len], offset)
+    if len(diff) > 0:
+        return np.sum(diff**2) / len(diff)
+    return 0
+
+
+def measure_error_chroma(x0, x1, offset):
+    # The loop calc_chroma_error_curve replaced, one offset at a time
+    x0t = x0.transpose()
+    x1t = x1.transpose()
+    max_len = min(len(x0t), len(x1t))
+
+    x0a = np.argmax(x0t, axis=1) / 12
+    x1a = np.argmax(x1t, axis=1) / 12
+
+    diff = np.where(x0a[:max_len] == np.roll(x1a[:max_len], offset, 0), 0, 1)
+    if len(diff) > 0:
+        return np.nanmean(diff)
+    return 0
+
+
+# Few shifts are evaluated directly, many with an FFT
+@pytest.mark.parametrize('shifts', [[0, 3, -7], list(range(-600, 600, 7))])
+def test_error_curve_matches_loop(shifts):
+    rng = np.random.default_rng(0)
+    x0 = rng.random(1000)
+    x1 = np.roll(x0, 25) + 0.1 * rng.random(1000)
+    x1 = np.concatenate([x1, rng.random(200)])
+
+    expected = [measure_error(x0, x1, s) for s in shifts]
+    np.testing.assert_allclose(calc_error_curve(x0, x1, np.array(shifts)), expected,
+                               rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('shifts', [[0, 3, -7], list(range(-600, 600, 7))])
+def test_chroma_error_curve_matches_loop(shifts):
+    rng = np.random.default_rng(1)
+    x0 = rng.random((12, 1000))
+    x1 = np.concatenate([np.roll(x0, -40, axis=1), rng.random((12, 150))], axis=1)
+
+    expected = [measure_error_chroma(x0, x1, s) for s in shifts]
+    np.testing.assert_array_equal(calc_chroma_error_curve(x0, x1, np.array(shifts)), expected)
+
+
+@pytest.mark.parametrize('value, expected', [
+    (True, True), (False, False), (1, True), (0, False),
+    ('true', True), ('True', True), ('1', True), ('yes', True),
+    ('false', False), ('FALSE', False), ('0', False), ('no', False), ('', False),
+])
+def test_parse_flag(value, expected):
+    assert parse_flag({'debug_artifacts': value}, 'debug_artifacts') is expected
+
+
+def test_parse_flag_default():
+    assert parse_flag({}, 'debug_artifacts') is True
+    assert parse_flag({}, 'debug_artifacts', False) is False
+
+
+def test_fuse_errors_smooths_each_band_alone():
+    # Two bands around separate coarse candidates, as coarse_to_fine leaves
+    times = np.concatenate([np.arange(-500, -300, 10), np.arange(1000, 1200, 10)])
+    assert contiguous_runs(times) == [slice(0, 20), slice(20, 40)]
+
+    rng = np.random.default_rng(2)
+    hop_errors = [{'sf': rng.standard_normal(len(times))} for _ in range(3)]
+    _, fused, _ = fuse_errors(hop_errors, times)
+
+    curves = np.stack([e['sf'] for e in hop_errors])
+    np.testing.assert_allclose(fused['sf'][:20], smooth_curves(curves[:, :20]))
+    np.testing.assert_allclose(fused['sf'][20:], smooth_curves(curves[:, 20:]))
+
+
+def test_features_version_misses_the_feature_store(tmp_path, monkeypatch):
+    feature_store = FeatureStore(LocalBlobStore(tmp_path))
+    features = {512: (np.ones(10), np.ones(10), np.ones((12, 10)))}
+    feature_store.save('c+s+p.nut', 'etag', feature_params(22050, [512]), features)
+    assert feature_store.load('c+s+p.nut', 'etag', feature_params(22050, [512])) is not None
+
+    monkeypatch.setattr(calculate_alignment, 'FEATURES_VERSION', FEATURES_VERSION + 1)
+    assert feature_store.load('c+s+p.nut', 'etag', feature_params(22050, [512])) is None
+
+
+def rts_smooth(curves, transition_variance=1.0, observation_variance=1.0,
+               initial_variance=1.0):
+    # Kalman filter then Rauch-Tung-Striebel smoother, a point at a time,
+    # for the random walk smooth_curves models. The k curves at a point
+    # are one observation of their mean, with variance divided by k
+    k, n = curves.shape
+    observed = curves.mean(axis=0)
+    filtered, filtered_var = np.zeros(n), np.zeros(n)
+    predicted, predicted_var = np.zeros(n), np.zeros(n)
+    mean, var = 0.0, initial_variance
+    for t in range(n):
+        if t:
+            var += transition_variance
+        predicted[t], predicted_var[t] = mean, var
+        gain = var / (var + observation_variance / k)
+        mean += gain * (observed[t] - mean)
+        var *= 1 - gain
+        filtered[t], filtered_var[t] = mean, var
+
+    smoothed = filtered.copy()
+    for t in range(n - 2, -1, -1):
+        gain = filtered_var[t] / predicted_var[t + 1]
+        smoothed[t] = filtered[t] + gain * (smoothed[t + 1] - predicted[t + 1])
+    return smoothed
+
+
+@pytest.mark.parametrize('variances', [(1.0, 1.0, 1.0), (0.3, 2.0, 5.0)])
+def test_smooth_curves_matches_rts(variances):
+    curves = np.random.default_rng(3).standard_normal((3, 50))
+    np.testing.assert_allclose(smooth_curves(curves, *variances),
+                               rts_smooth(curves, *variances), atol=1e-12)
+
+
+def test_smooth_curves_single_point():
+    # Two observations of 3 and the prior of 0, all with variance 1
+    np.testing.assert_allclose(smooth_curves(np.full((2, 1), 3.0)), [2.0])
+
+
+def test_smooth_curves_constant():
+    curves = np.full((3, 40), 2.0)
+    smoothed = smooth_curves(curves)
+    np.testing.assert_allclose(smoothed, rts_smooth(curves), atol=1e-12)
+    # Pulled towards the prior of zero at the start only
+    assert np.all(np.diff(smoothed) >= 0)
+    np.testing.assert_allclose(smoothed[15:], 2.0, atol=1e-6)
+    np.testing.assert_array_equal(smooth_curves(np.zeros((3, 40))), 0)
+
+
+@pytest.fixture(scope='module')
+def tone():
+    sr = 22050
+    t = np.arange(4 * sr) / sr
+    noise = np.random.default_rng(4).standard_normal(len(t))
+    s = (0.3 * np.sin(2 * np.pi * 220 * t * (1 + 0.1 * np.sin(t))) * (1 + np.sin(3 * t))
+         + 0.05 * noise).astype(np.float32)
+    return s, sr
+
+
+# 500 samples is shorter than n_fft at 22050 Hz
+@pytest.mark.parametrize('block_frames', [500, 8192, 30000, None])
+def test_streaming_features_match_whole_signal(tone, block_frames, monkeypatch):
+    # Short enough that the tuning is estimated before the signal ends
+    monkeypatch.setattr(calculate_alignment, 'TUNING_SECONDS', 1)
+    s, sr = tone
+    hop_lengths = hop_lengths_for(sr)
+    whole = gen_multi_hop_features(s, sr, hop_lengths, cache=False)
+
+    extractor = StreamingFeatures(sr, hop_lengths)
+    block_frames = block_frames or len(s)
+    for i in range(0, len(s), block_frames):
+        extractor.add(s[i:i + block_frames])
+    streamed = extractor.finish()
+
+    assert sorted(streamed) == sorted(whole)
+    for hop_length in hop_lengths:
+        for name, expected, got in zip(('sf', 'cf', 'chroma'), whole[hop_length],
+                                       streamed[hop_length]):
+            np.testing.assert_array_equal(got, expected, err_msg=f'{name} at {hop_length}')
+
+
+@pytest.fixture(scope='module')
+def notes():
+    # A tune of short notes at random pitches, with a little noise
+    sr = 22050
+    rng = np.random.default_rng(5)
+    t = np.arange(int(0.1 * sr)) / sr
+    s = np.concatenate([np.sin(2 * np.pi * f * t) * np.hanning(len(t))
+                        for f in rng.uniform(200, 2000, 150)])
+    return (s + 0.01 * rng.standard_normal(len(s))).astype(np.float32), sr
+
+
+@pytest.mark.parametrize('delay_ms', [250, 430, -50])
+def test_landmarks_recover_delay(notes, delay_ms):
+    s0, sr = notes
+    n = int(delay_ms * sr / 1000)
+    s1 = np.concatenate([np.zeros(n, np.float32), s0]) if n >= 0 else s0[-n:]
+
+    result = calc_alignment_landmarks(s0, sr, s1, sr)
+    # To within a frame
+    assert abs(result['offset'] - delay_ms) <= 1000 * LANDMARK_HOP_LENGTH / sr
+    assert result['confidence'] == 1.0
+
+
+def test_landmarks_engine_in_calc_offset(notes):
+    s0, sr = notes
+    s1 = np.concatenate([np.zeros(int(0.25 * sr), np.float32), s0])
+    offset = calc_offset(s0, sr, s1, sr, **dict(PARAMS, engine='landmarks'))
+    assert abs(offset - 250) <= 1000 * LANDMARK_HOP_LENGTH / sr
+
+
+def test_landmarks_on_silence(capsys):
+    silence = np.zeros(5 * 22050, np.float32)
+    result = calc_alignment_landmarks(silence, 22050, silence, 22050)
+
+    assert "No landmarks matched" in capsys.readouterr().out
+    assert result['offset'] == 0
+    assert result['confidence'] == 0.0
+    assert result['offsets'] == []
+    assert result['matches'] == 0
+
+
+class RecordingCOS:
+    # Enough of a COS client for main to look up ETags and save artifacts
+
+    def __init__(self):
+        self.objects = {}
+
+    def head_object(self, Bucket, Key):
+        return {'ETag': f'"{Key}-etag"'}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body
+
+
+def test_debug_artifact_records_params_used(notes, tmp_path, monkeypatch):
+    s0, sr = notes
+    signals = {'c+s+reference.nut': s0,
+               'c+s+p.nut': np.concatenate([np.zeros(int(0.25 * sr), np.float32), s0])}
+    cos = RecordingCOS()
+    monkeypatch.setenv('__OW_ACTION_NAME', '/choirless/calculate_alignment')
+    monkeypatch.setattr(calculate_alignment, 'create_cos_client', lambda args: cos)
+    monkeypatch.setattr(calculate_alignment, 'audio_source',
+                        lambda args, bucket, key, *rest: lambda: (signals[key], sr))
+
+    ret = calculate_alignment.main({'key': 'c+s+p.nut', 'bucket': 'converted',
+                                    'debug_bucket': 'debug', 'alignment_engine': 'landmarks',
+                                    'analysis_sample_rate': sr, 'result_store': 'false',
+                                    'feature_store_dir': str(tmp_path / 'features'),
+                                    'part_metadata_dir': str(tmp_path / 'meta')})
+    assert abs(ret['offset'] - 250) <= 1000 * LANDMARK_HOP_LENGTH / sr
+
+    artifact = json.loads(cos.objects[('debug', 'c+s+p-alignment.json')])
+    assert artifact['params'] == dict(PARAMS, engine='landmarks')
+    assert artifact['engine'] == 'landmarks'
+
+
+def test_confidence_of_a_clean_pair():
+    s0, sr = load_source({'synthetic': 1}, 30)
+    s1, _ = load_source({'synthetic': 1, 'offset': 250}, 30)
+    result = calc_alignment(s0, sr, s1, sr, **PARAMS)
+
+    assert abs(result['offset'] - 250) <= 10
+    assert min(result['prominence'], result['margin']) > CONFIDENCE_HIGH
+    assert result['confidence'] == 1.0
+
+
+def test_confidence_of_an_unrelated_pair():
+    s0, sr = load_source({'synthetic': 0}, 30)
+    s1, _ = load_source({'synthetic': 100, 'offset': 250}, 30)
+    result = calc_alignment(s0, sr, s1, sr, **PARAMS)
+
+    assert min(result['prominence'], result['margin']) < CONFIDENCE_LOW
+    assert result['confidence'] == 0.0
+
+
+def test_confidence_of_a_flat_curve():
+    times = np.arange(-100, 600, 10)
+    prominence, margin, confidence = calc_confidence(times, np.zeros(len(times)), [200], 200)
+    assert max(prominence, margin) < CONFIDENCE_LOW
+    assert confidence == 0.0
+
+    # No candidates at all
+    assert calc_confidence(times, np.zeros(len(times)), [], 0) == (0.0, 0.0, 0.0)
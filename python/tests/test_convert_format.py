@@ -0,0 +1,98 @@
+import math
+import shutil
+
+import ffmpeg
+import numpy as np
+import pytest
+
+from convert_format import plan_segments, convert
+
+
+@pytest.mark.parametrize('duration, segment_seconds, expected', [
+    # The short last segment is folded into the one before
+    (10, 3, [(0, 75), (3, 75), (6, None)]),
+    # An exact multiple
+    (9, 3, [(0, 75), (3, 75), (6, None)]),
+    # A frame over
+    (9.01, 3, [(0, 75), (3, 75), (6, None)]),
+    # Over half a segment over, so it is kept
+    (10.6, 3, [(0, 75), (3, 75), (6, 75), (9, None)]),
+    # Shorter than a segment
+    (2, 3, [(0, None)]),
+])
+def test_plan_segments(duration, segment_seconds, expected):
+    assert plan_segments(duration, segment_seconds) == expected
+
+
+@pytest.mark.parametrize('duration', [7.3, 60, 61.99, 180.02])
+@pytest.mark.parametrize('segment_seconds, fps', [(20, 25), (2.01, 25), (3, 30)])
+def test_plan_segments_cover_every_frame(duration, segment_seconds, fps):
+    segments = plan_segments(duration, segment_seconds, fps)
+    total_frames = math.ceil(duration * fps)
+
+    # Every segment starts on a frame, where its first keyframe will be,
+    # and each starts where the one before ends
+    starts = [round(start * fps) for start, _ in segments]
+    assert [start * fps for start, _ in segments] == pytest.approx(starts)
+    assert starts[0] == 0
+    for (start, frames), next_start in zip(segments, starts[1:]):
+        assert round(start * fps) + frames == next_start
+
+    # The last runs to the end, and is at least half a segment long
+    assert segments[-1][1] is None
+    if len(segments) > 1:
+        assert total_frames - starts[-1] >= segments[0][1] / 2
+
+
+SOURCE_FPS = 30
+
+
+def source(path, duration):
+    # Media at another frame rate, as it might come from a phone, with
+    # intra only video so it starts at zero like the probe below says.
+    # Each frame is a different grey, far from those either side of it
+    video = (ffmpeg.input(f'color=size=160x120:rate={SOURCE_FPS}:duration={duration}',
+                          format='lavfi')
+             .filter('geq', lum='mod(N*37,256)', cb=128, cr=128))
+    audio = ffmpeg.input(f'sine=frequency=440:sample_rate=48000:duration={duration}',
+                         format='lavfi')
+    (ffmpeg.output(video, audio, path, vcodec='mjpeg', acodec='pcm_s16le')
+     .global_args('-loglevel', 'error')
+     .run())
+    return {'streams': [{'codec_type': 'video'},
+                        {'codec_type': 'audio', 'sample_rate': '48000', 'channels': 1}],
+            'format': {'duration': str(duration), 'start_time': '0'}}
+
+
+def frames(path):
+    # The grey of every frame of the video
+    out, _ = (ffmpeg.input(path).video
+              .filter('scale', 80, 60)
+              .output('pipe:', format='rawvideo', pix_fmt='gray')
+              .global_args('-loglevel', 'error')
+              .run(capture_stdout=True))
+    return np.frombuffer(out, np.uint8).reshape(-1, 60 * 80).mean(axis=1)
+
+
+@pytest.mark.skipif(not shutil.which('ffmpeg'), reason="needs ffmpeg")
+# A short last segment, and an exact multiple of the segment length
+@pytest.mark.parametrize('duration', [7.3, 6])
+def test_segments_join_to_the_whole(tmp_path, duration):
+    input_path = str(tmp_path / 'c+s+p.mkv')
+    probe = source(input_path, duration)
+
+    outputs = {}
+    for execution in ['serial', 'parallel']:
+        outputs[execution] = str(tmp_path / f'{execution}.nut')
+        convert(input_path, outputs[execution], probe, passes=1, execution=execution,
+                max_workers=2, segment_seconds=2)
+
+    # Every frame the fps filter makes of the source. Converting serially
+    # can end a frame short, where -shortest cuts the video at the audio
+    serial, parallel = frames(outputs['serial']), frames(outputs['parallel'])
+    assert len(parallel) == math.ceil(duration * 25)
+    assert len(serial) in (len(parallel), len(parallel) - 1)
+
+    # The same frames of the source were picked, none dropped or repeated
+    # at the joins, so only the encodes differ
+    assert np.abs(serial - parallel[:len(serial)]).max() < 3
@@ -0,0 +1,16 @@
+from ibm_botocore.exceptions import ClientError
+
+from renderer_compositor_child import load_part_metadata
+from choirless_lib import PartMetadata, COSBlobStore
+
+
+class FailingCOS:
+
+    def get_object(self, Bucket, Key):
+        raise ClientError({'Error': {'Code': 'InternalError'}}, 'GetObject')
+
+
+def test_unreadable_metadata_is_left_out(capsys):
+    part_metadata = PartMetadata(COSBlobStore(FailingCOS(), 'converted'))
+    assert load_part_metadata(part_metadata, 'c+s+p.nut') == {}
+    assert "Could not load part metadata: key c+s+p.nut" in capsys.readouterr().out
@@ -0,0 +1,59 @@
+import pytest
+
+import calculate_alignment
+from calculate_alignment import PARAMS, SAMPLE_RATE, result_params, use_streaming, parse_max_duration
+from choirless_lib import ResultStore, LocalBlobStore
+
+
+class HeadOnlyCOS:
+    # Enough of a COS client for main to look up ETags, and nothing else
+
+    def head_object(self, Bucket, Key):
+        return {'ETag': f'"{Key}-etag"'}
+
+
+def refuse_to_decode(*args, **kwargs):
+    def source():
+        raise RuntimeError("decoded")
+    return source
+
+
+@pytest.fixture
+def args(tmp_path, monkeypatch):
+    monkeypatch.setenv('__OW_ACTION_NAME', '/choirless/calculate_alignment')
+    monkeypatch.setattr(calculate_alignment, 'create_cos_client', lambda args: HeadOnlyCOS())
+    monkeypatch.setattr(calculate_alignment, 'audio_source', refuse_to_decode)
+    monkeypatch.setattr(calculate_alignment, 'feature_source', refuse_to_decode)
+    return {'key': 'c+s+p.nut', 'bucket': 'converted',
+            'result_store_dir': str(tmp_path / 'results'),
+            'part_metadata_dir': str(tmp_path / 'meta'),
+            'debug_artifacts': 'false'}
+
+
+@pytest.fixture
+def stored(args):
+    # The result main would have saved for the default params
+    params = dict(PARAMS)
+    streaming = use_streaming({}, params)
+    result_store = ResultStore(LocalBlobStore(args['result_store_dir']))
+    result_store.save('"c+s+reference.nut-etag"', 'c+s+p.nut', '"c+s+p.nut-etag"',
+                      result_params(params, SAMPLE_RATE, parse_max_duration({}, streaming), streaming),
+                      {'offset': 120, 'confidence': 0.9, 'needs_review': False})
+
+
+def test_stored_result_skips_decoding(args, stored):
+    ret = calculate_alignment.main(args)
+    assert ret['offset'] == 120
+    assert ret['cached']
+
+
+@pytest.mark.parametrize('changed', [{'alignment_engine': 'landmarks'},
+                                     {'max_duration': 60}])
+def test_changed_params_miss_stored_result(args, stored, changed):
+    with pytest.raises(RuntimeError, match="decoded"):
+        calculate_alignment.main(dict(args, **changed))
+
+
+def test_result_store_off(args, stored):
+    with pytest.raises(RuntimeError, match="decoded"):
+        calculate_alignment.main(dict(args, result_store='false'))
@@ -0,0 +1,80 @@
+import shutil
+from fractions import Fraction
+
+import ffmpeg
+import pytest
+
+from trim_clip import trim, next_keyframe
+from choirless_lib import get_codec_profile
+
+pytestmark = pytest.mark.skipif(not (shutil.which('ffmpeg') and shutil.which('ffprobe')),
+                                reason="needs ffmpeg and ffprobe")
+
+DURATION = 6
+SAMPLE_RATE = 44100
+
+
+@pytest.fixture(scope='module')
+def part(tmp_path_factory):
+    # Six seconds of a converted part, with a keyframe every second
+    path = str(tmp_path_factory.mktemp('trim') / 'c+s+p.nut')
+    profile = get_codec_profile('h264_slow')
+    video = ffmpeg.input(f'testsrc=size=160x120:rate=25:duration={DURATION}', format='lavfi')
+    audio = ffmpeg.input(f'sine=frequency=440:sample_rate={SAMPLE_RATE}:duration={DURATION}',
+                         format='lavfi')
+    (ffmpeg.output(video, audio, path, pix_fmt='yuv420p', g=25, keyint_min=25, sc_threshold=0,
+                   **profile.output_args())
+     .global_args('-loglevel', 'error')
+     .run())
+    return path
+
+
+def packets(path, stream):
+    # (pts, duration) of each packet of a stream, in seconds
+    out, _ = (ffmpeg.input(path)
+              .output('pipe:', format='framecrc', map=f'0:{stream}', c='copy')
+              .global_args('-loglevel', 'error')
+              .run(capture_stdout=True))
+    lines = out.decode().splitlines()
+    tb = Fraction(next(l for l in lines if l.startswith('#tb')).split(':')[1].strip())
+    fields = [[f.strip() for f in l.split(',')] for l in lines if not l.startswith('#')]
+    return [(float(int(f[2]) * tb), float(int(f[3]) * tb)) for f in fields]
+
+
+def frame_md5s(path):
+    out, _ = (ffmpeg.input(path).video
+              .output('pipe:', format='framemd5')
+              .global_args('-loglevel', 'error')
+              .run(capture_stdout=True))
+    return [l.split(',')[-1].strip() for l in out.decode().splitlines()
+            if not l.startswith('#')]
+
+
+def test_next_keyframe(part):
+    assert next_keyframe(part, 1.4) == pytest.approx(2.0)
+    assert next_keyframe(part, 2.0) == pytest.approx(2.0)
+    assert next_keyframe(part, 5.5) is None
+
+
+# Between keyframes, on one, and after the last
+@pytest.mark.parametrize('offset, head_frames', [(1.4, 15), (2.0, 0), (5.5, 12)])
+def test_trim(part, tmp_path, offset, head_frames):
+    output = str(tmp_path / 'trimmed.nut')
+    trim(part, output, offset, get_codec_profile('h264_slow'))
+
+    video = packets(output, 'v')
+    first_frame = round(offset * 25)
+    assert len(video) == DURATION * 25 - first_frame
+    # Starts at zero and runs on a frame at a time, across the join too.
+    # Packets are in decode order, so B-frames come before their pts
+    pts = sorted(pts for pts, _ in video)
+    assert pts[0] == 0
+    assert pts == pytest.approx([i / 25 for i in range(len(video))])
+
+    audio = packets(output, 'a')
+    audio_duration = audio[-1][0] + audio[-1][1]
+    assert audio_duration == pytest.approx(DURATION - offset, abs=1 / 25)
+
+    # The frames after the head are the part's own, in step with the audio
+    md5s = frame_md5s(output)
+    assert md5s[head_frames:] == frame_md5s(part)[first_frame + head_frames:]
@@ -1,3 +1,5 @@
+import math
+import tempfile
 import time
 from functools import partial
 from pathlib import Path
@@ -5,14 +7,23 @@ from pathlib import Path
 import ffmpeg
 
 from choirless_lib import mqtt_status, create_signed_url
+from choirless_lib import create_part_metadata, part_volume
+from choirless_lib import get_codec_profile
 
 SAMPLE_RATE = 44100
 
+# Codec profile of parts converted before convert_format kept theirs in
+# the part's metadata
+CODEC_PROFILE = 'h264_slow'
+
+# Seconds after the offset to look for a keyframe in, a little more than
+# x264's longest gap between keyframes at 25 fps
+KEYFRAME_WINDOW = 12
+
 
 @mqtt_status()
 def main(args):
 
-    offset = float(args.get('offset')) / 1000
     key = args.get('rendition_key')
 
     src_bucket = args['converted_bucket']
@@ -42,22 +53,22 @@ def main(args):
 
     output_key = key # named the same
 
-    kwargs = {}
+    # Apply any gain convert_format left to us
+    metadata = create_part_metadata(args, src_bucket).load(key)
+    volume = part_volume(metadata)
+    if volume is not None:
+        print("Volume gain to apply:", volume)
+
+    # Falling back on the offset calculate_alignment left with the part
+    offset = float(args.get('offset', metadata.get('offset_ms', 0))) / 1000
+
+    # Anything re-encoded has to match how the rest of the part was encoded,
+    # for the two to be joined
+    profile = get_codec_profile(metadata.get('codec_profile',
+                                             args.get('codec_profile', CODEC_PROFILE)))
 
-    stream = ffmpeg.input(get_input_url(key),
-                          ss=offset)
-    pipeline = ffmpeg.output(stream,
-                             get_output_url(output_key),
-                             vcodec='libx264',
-                             acodec='pcm_f32le',
-                             format='nut',
-                             method='PUT',
-                             seekable=0)
-    
-    cmd = pipeline.compile()
-    print("ffmpeg command to run: ", cmd)
     t1 = time.time()
-    pipeline.run()
+    trim(get_input_url(key), get_output_url(output_key), offset, profile, volume)
     t2 = time.time()
     
     ret = {'status': 'ok',
@@ -67,3 +78,153 @@ def main(args):
            }
 
     return ret
+
+
+def trim(input_url, output_url, offset, profile, volume=None):
+    """
+    Trim the start off a converted part. Only the video up to the first
+    keyframe after the offset is re-encoded, the rest is copied, so only a
+    few seconds of it are encoded again however long the part is.
+
+    :param input_url: URL (e.g. a signed COS GET URL) or path of the part
+    :type input_url: str
+    :param output_url: URL (e.g. a signed COS PUT URL) or path to write to
+    :type output_url: str
+    :param offset: seconds to trim
+    :type offset: float
+    :param profile: codec profile the part was written with
+    :type profile: CodecProfile
+    :param volume: argument for the volume filter to apply to the audio
+    """
+    keyframe = next_keyframe(input_url, offset) if offset > 0 else 0
+    print(f"Trimming {offset} s, next keyframe at {keyframe} s")
+
+    # Frames from the offset up to the keyframe, or to the end if there
+    # isn't one, are re-encoded
+    first_frame = math.ceil(round(offset * 25, 6))
+    head_frames = None if keyframe is None else round(keyframe * 25) - first_frame
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # The concat demuxer matches streams up by index, so the head and
+        # tail are both written with just their video
+        lines = []
+        if head_frames is None or head_frames > 0:
+            head_path = str(Path(tmpdir, 'head.nut'))
+            encode_head(input_url, offset, head_frames, head_path, profile)
+            lines.append(f"file '{head_path}'\n")
+            if head_frames is not None:
+                lines.append(f"duration {head_frames / 25:.6f}\n")
+        if keyframe is not None:
+            tail_path = str(Path(tmpdir, 'tail.nut'))
+            copy_tail(input_url, keyframe, tail_path)
+            lines.append(f"file '{tail_path}'\n")
+        list_path = Path(tmpdir, 'trim.txt')
+        list_path.write_text(''.join(lines))
+
+        # The packets are joined as they are, the head having been encoded
+        # with the same settings as the tail
+        video = ffmpeg.input(str(list_path),
+                             format='concat',
+                             safe=0,
+                             auto_convert=0)
+
+        # The audio is PCM, so decoding and writing it again costs little
+        audio = ffmpeg.input(input_url,
+                             ss=offset).audio
+        if volume is not None:
+            audio = audio.filter('volume', volume)
+
+        pipeline = ffmpeg.output(video.video,
+                                 audio,
+                                 output_url,
+                                 vcodec='copy',
+                                 method='PUT',
+                                 seekable=0,
+                                 **profile.output_args(video=False))
+
+        cmd = pipeline.compile()
+        print("ffmpeg command to run: ", cmd)
+        pipeline.run()
+
+
+def next_keyframe(url, offset, window=KEYFRAME_WINDOW):
+    """
+    Find the first keyframe of the video at or after offset
+
+    :param url: URL or path of the media
+    :type url: str
+    :param offset: seconds into the media
+    :type offset: float
+    :param window: seconds after offset to look in
+    :type window: float
+    :return: time of the keyframe in seconds, or None if there isn't one
+    :rtype: float
+    """
+    # Only the packets are read, nothing is decoded
+    probe = ffmpeg.probe(url,
+                         select_streams='v:0',
+                         read_intervals=f'{offset}%+{window}',
+                         show_entries='packet=pts_time,flags')
+    for packet in probe.get('packets', []):
+        pts_time = packet.get('pts_time', 'N/A')
+        if 'K' in packet.get('flags', '') and pts_time != 'N/A' \
+           and float(pts_time) >= offset:
+            return float(pts_time)
+    return None
+
+
+def copy_tail(input_url, keyframe, path):
+    """
+    Copy the video of a part from a keyframe, without re-encoding it
+
+    :param input_url: URL or path of the part
+    :type input_url: str
+    :param keyframe: time of the keyframe in seconds
+    :type keyframe: float
+    :param path: path to write the video to
+    :type path: str
+    """
+    # Seeking a copied stream lands on a keyframe, so this one exactly
+    stream = ffmpeg.input(input_url, ss=keyframe)
+    pipeline = ffmpeg.output(stream.video,
+                             path,
+                             format='nut',
+                             vcodec='copy')
+    pipeline = pipeline.global_args('-nostdin', '-loglevel', 'error')
+    pipeline.overwrite_output().run()
+
+
+def encode_head(input_url, offset, frames, path, profile):
+    """
+    Re-encode the video of a part from offset
+
+    :param input_url: URL or path of the part
+    :type input_url: str
+    :param offset: seconds into the part to start at
+    :type offset: float
+    :param frames: number of frames to encode, or None to run to the end
+    :type frames: int
+    :param path: path to write the video to
+    :type path: str
+    :param profile: codec profile to encode with
+    :type profile: CodecProfile
+    """
+    input_kwargs = {'ss': offset}
+    output_kwargs = {}
+    if frames is not None:
+        output_kwargs['frames:v'] = frames
+        # Stop reading shortly after the end of the head
+        input_kwargs['t'] = frames / 25 + 1
+
+    stream = ffmpeg.input(input_url, **input_kwargs)
+
+    # Start on the first frame after the offset, not a copy of it made to
+    # fill the gap back to the offset
+    video = stream.video.setpts('PTS-STARTPTS')
+    pipeline = ffmpeg.output(video,
+                             path,
+                             r=25,
+                             **profile.output_args(audio=False),
+                             **output_kwargs)
+    pipeline = pipeline.global_args('-nostdin', '-loglevel', 'error')
+    pipeline.overwrite_output().run()
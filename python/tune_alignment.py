@@ -1,9 +1,10 @@
+import argparse
+import os
 import numpy as np
-import librosa
-from surfboard.sound import Waveform
 import optuna
 from pathlib import Path
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from itertools import permutations, product
 from functools import partial
 import json
@@ -12,75 +13,175 @@ import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 
-from calculate_alignment import calc_offset, SAMPLE_RATE, PARAMS as EXISTING_PARAMS
+from alignment_dataset import build_dataset, load_part
+from render_alignment_debug import plot_alignment
+from calculate_alignment import calc_offset, gen_multi_hop_features, feature_cache, SAMPLE_RATE, HOP_LENGTHS, FEATURES_VERSION, PARAMS as EXISTING_PARAMS
 
-cache_dir = "/Users/matt/Downloads/choirless_videos"
+# Per hop length features of each part are kept as .npy files, in the order
+# gen_multi_hop_features returns them
+FEATURE_FILES = ['sf', 'cf', 'chroma']
 
 def main():
+    parser = argparse.ArgumentParser(description="Tune the calc_offset feature weights with optuna")
+    parser.add_argument('--cache-dir', default=os.environ.get('CHOIRLESS_CACHE_DIR'),
+                        required='CHOIRLESS_CACHE_DIR' not in os.environ,
+                        help="directory of converted .nut files, defaults to $CHOIRLESS_CACHE_DIR")
+    parser.add_argument('--dataset-dir', help="where to keep the decoded parts, defaults to <cache-dir>/dataset")
+    parser.add_argument('--feature-dir', help="where to keep precomputed features, defaults to <dataset-dir>/features")
+    parser.add_argument('--tune-data', default='tune_data')
+    parser.add_argument('--study-name', default='distributed-example')
+    parser.add_argument('--storage', default='sqlite:///example.db')
+    parser.add_argument('--trials', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=1,
+                        help="worker processes precomputing features, then each running trials against the shared study")
+    args = parser.parse_args()
+
+    dataset_dir = args.dataset_dir or str(Path(args.cache_dir, 'dataset'))
+    feature_dir = args.feature_dir or str(Path(dataset_dir, 'features'))
+
+    # Decode every part and calculate its features once, up front. Trials
+    # then only ever read them, memory mapped, so any number of worker
+    # processes share one copy through the page cache.
+    index = build_dataset(args.cache_dir, dataset_dir, args.tune_data)
+    parts = find_parts(index)
+    print("Precomputing features for parts:", len(parts))
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        list(executor.map(precompute_features,
+                          [index[p['key']] for p in parts],
+                          [dataset_dir] * len(parts),
+                          [feature_dir] * len(parts)))
 
+    starts = [0]
+    lengths = [30, 60, 120, 180]
+
+    valid_combos = load_combos(parts, feature_dir)
+    print("Number of parts:", len(valid_combos))
+    print("Starts:", starts)
+    print("Lengths:", lengths)
+    print("Total number of tests: ", len(valid_combos)*len(starts)*len(lengths))
+
+    study = optuna.load_study(study_name=args.study_name, storage=args.storage)
+
+    # Start with the existing weights as these may still be valid
+    study.enqueue_trial({k: v for k, v in EXISTING_PARAMS.items()
+                         if k.endswith('_weight')})
+
+    # Run that trial here first, so the workers do not race each other to it
+    run_trials(args.study_name, args.storage, 1,
+               parts, feature_dir, starts, lengths)
+    remaining = args.trials - 1
+
+    if args.workers > 1:
+        # Every worker loads the study from the shared storage and takes
+        # trials from it until the total is reached
+        n_trials = [remaining // args.workers + (i < remaining % args.workers)
+                    for i in range(args.workers)]
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            list(executor.map(run_trials,
+                              [args.study_name] * args.workers,
+                              [args.storage] * args.workers,
+                              n_trials,
+                              [parts] * args.workers,
+                              [feature_dir] * args.workers,
+                              [starts] * args.workers,
+                              [lengths] * args.workers))
+    else:
+        run_trials(args.study_name, args.storage, remaining,
+                   parts, feature_dir, starts, lengths)
+
+    study = optuna.load_study(study_name=args.study_name, storage=args.storage)
+
+    print(study.best_params)
+    print("Feature cache:", feature_cache.stats())
+
+    objective(valid_combos, starts, lengths, True, study.best_trial)
+
+
+def find_parts(index):
+    parts = []
+    for key, entry in sorted(index.items()):
+        parts.append({'song': f"{entry['choir_id']}+{entry['song_id']}",
+                      'key': key,
+                      'offset': entry['offset']})
+    return parts
+
+
+def feature_settings(entry):
+    # Everything the features of a part depend on, besides its audio
+    return {'features_version': FEATURES_VERSION,
+            'hop_lengths': HOP_LENGTHS,
+            'sr': entry['sr'],
+            'duration': entry['duration']}
+
+
+def precompute_features(entry, dataset_dir, feature_dir):
+    part_dir = Path(feature_dir, Path(entry['file']).stem)
+    # hop_lengths.json is written last, so only complete sets are reused,
+    # and only if they were calculated the same way
+    settings_path = Path(part_dir, 'hop_lengths.json')
+    if settings_path.exists() and \
+       json.load(settings_path.open()) == feature_settings(entry):
+        return
+
+    print("calculating features:", entry['file'])
+    s, sr = load_part(dataset_dir, entry)
+
+    # Written straight to disk, so not worth keeping in this worker's cache
+    features = gen_multi_hop_features(s, sr, HOP_LENGTHS, cache=False)
+
+    part_dir.mkdir(parents=True, exist_ok=True)
+    for hop_length, values in features.items():
+        for name, value in zip(FEATURE_FILES, values):
+            np.save(Path(part_dir, f'{name}_{hop_length}.npy'), value)
+    json.dump(feature_settings(entry), settings_path.open('w'))
+
+
+def load_features(key, feature_dir):
+    # Memory mapped, read only views of the precomputed features
+    part_dir = Path(feature_dir, key)
+    hop_lengths = json.load(Path(part_dir, 'hop_lengths.json').open())['hop_lengths']
+    return {hop_length: tuple(np.load(Path(part_dir, f'{name}_{hop_length}.npy'),
+                                      mmap_mode='r')
+                              for name in FEATURE_FILES)
+            for hop_length in hop_lengths}
+
+
+def load_combos(parts, feature_dir):
     data = defaultdict(list)
-    print("Loading audio files")
-    for json_file in Path('tune_data').glob('*.json'):
-        spec = json.load(json_file.open())
-        print("Loading JSON file:", json_file.name)
-        choir_id = spec['choir_id']
-        song_id = spec['song_id']
-
-        for part in spec['inputs']:
-            part_id = part['part_id']
-            offset = int(part['offset'])
-
-            filename = Path(cache_dir, f'{choir_id}+{song_id}+{part_id}.nut')
-            print("loading:", filename)
-
-            s, sr = librosa.load(str(filename),
-                                 sr=SAMPLE_RATE,
-                                 mono=True,
-                                 offset=0,
-                                 duration=180)
-
-            features = {'s': s,
-                        'sr': sr,
-                        'offset': int(offset),
-                        'filename': str(filename.name),
-            }
-        
-            data[f'{choir_id}+{song_id}'].append(features)
+    for part in parts:
+        data[part['song']].append({'features': load_features(part['key'], feature_dir),
+                                   'offset': part['offset'],
+                                   'filename': f"{part['key']}.nut",
+        })
 
     valid_combos = []
     for song_parts in data.values():
         for a, b in permutations(song_parts, 2):
             if a['offset'] == 0:
                 valid_combos.append([a, b, b['offset']])
+    return valid_combos
 
-    starts = [0]
-    lengths = [30, 60, 120, 180]
-                
-    print("Number of parts:", len(valid_combos))
-    print("Starts:", starts)
-    print("Lengths:", lengths)
-    print("Total number of tests: ", len(valid_combos)*len(starts)*len(lengths))
-    ob = partial(objective, valid_combos, starts, lengths, False)
 
-    study = optuna.load_study(study_name='distributed-example', storage='sqlite:///example.db')
+def run_trials(study_name, storage, n_trials, parts, feature_dir, starts, lengths):
+    # The pruner is not kept in the storage, so set it every time the
+    # study is loaded. Once a few trials have completed, a trial that has
+    # synced fewer tests than the median had by the same pair is stopped.
+    pruner = optuna.pruners.MedianPruner(n_startup_trials=5)
+    study = optuna.load_study(study_name=study_name, storage=storage, pruner=pruner)
 
-    # Start with the existing params as these may still be valid
-    study.enqueue_trial(EXISTING_PARAMS)
+    valid_combos = load_combos(parts, feature_dir)
+    ob = partial(objective, valid_combos, starts, lengths, False)
 
     study.optimize(ob,
-                   n_trials=100,
+                   n_trials=n_trials,
                    n_jobs=1)
 
-    print(study.best_params)
 
-    objective(valid_combos, starts, lengths, True, study.best_trial)
-
-                
 def objective(valid_combos, starts, lengths, debug, trial):
     chroma_weight = trial.suggest_discrete_uniform('chroma_weight', 0.0, 1.0, 0.1)
     sf_weight = trial.suggest_discrete_uniform('sf_weight', 0.0, 1.0, 0.1)
     cf_weight = trial.suggest_discrete_uniform('cf_weight', 0.0, 1.0, 0.1)
-    
+
     num_synced = 0
     num_parts = len(valid_combos)
     num_starts = len(starts) * len(lengths)
@@ -88,7 +189,7 @@ def objective(valid_combos, starts, lengths, debug, trial):
 
     if debug:
         fig = plt.figure(figsize=(8*num_starts, 4*num_parts))
-    
+
     for i, (a, b, actual_offset) in enumerate(valid_combos):
 
         for j, (start, length) in enumerate(product(starts, lengths)):
@@ -96,22 +197,27 @@ def objective(valid_combos, starts, lengths, debug, trial):
             if debug:
                 ax = fig.add_subplot(num_parts, num_starts, (i * num_starts) + j + 1)
                 ax.set_title(b['filename'])
+                curves = {}
             else:
                 ax = None
+                curves = None
 
-            offset = calc_offset(a['s'], a['sr'], b['s'], b['sr'],
-                                 ax=ax,
+            offset = calc_offset(None, SAMPLE_RATE, None, SAMPLE_RATE,
+                                 debug=curves,
                                  start_seconds=start,
                                  length_seconds=length,
                                  chroma_weight=chroma_weight,
                                  sf_weight=sf_weight,
                                  cf_weight=cf_weight,
+                                 features0=a['features'],
+                                 features1=b['features'],
             )
 
             diff = abs(actual_offset - offset)
             if debug:
                 print(b['filename'], int(actual_offset), int(offset), int(diff))
             if ax:
+                plot_alignment(ax, curves)
                 ax.axvline(x=int(actual_offset), color='g', linestyle='--')
 
             if diff <= 50:
@@ -124,12 +230,18 @@ def objective(valid_combos, starts, lengths, debug, trial):
                 if num_synced == total_tests:
                     trial.study.stop()
 
+        if not debug:
+            # Let the pruner stop weights that are already behind
+            trial.report(num_synced, i)
+            if trial.should_prune():
+                raise optuna.TrialPruned()
+
     if debug:
         fig.savefig('tune_sync.png', bbox_inches='tight')
-                
+
     return num_synced
-        
-    
+
+
 
 if __name__ == '__main__':
 